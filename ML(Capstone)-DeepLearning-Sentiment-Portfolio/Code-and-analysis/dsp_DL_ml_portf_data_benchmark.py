@@ -0,0 +1,273 @@
+# %% [markdown]
+# # DS210 - Optimizing Investment Portfolio to Adapt to Regime Change
+# ## Data Retrieval Benchmark
+# ### Irene Na
+
+# %% [markdown]
+# ## Set the environment
+
+# %%
+import pandas as pd
+import numpy as np
+import os
+import sys
+import time
+import shutil
+import argparse
+import platform
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from dsp_DL_ml_portf_data_retrieval import Data_NN, LocalSource, TREASURY_TICKERS, data_size
+
+# %% [markdown]
+# ## Overview:
+# - measures `Data_NN` end to end without WRDS credentials: synthetic CRSP (`dsp500list`, `dsf`, `msenames`), CCM (`ccmxpf_linktable`), JKP (`global_factor`) and Yahoo market tables with the real schemas are written as `LocalSource` fixtures, then a checkpoint is built (`prepare_data`) and read back (`retrieve_data`)
+# - scales are universe sizes (permnos ever in the index) over 25 years of business days; every permno gets one or two index stints, so the daily table grows with the universe
+# - the result is the per-stage report of `Data_NN.stage_report` (wall / CPU time, peak RSS, rows and bytes) tagged with the scale, the git commit and the versions, appended to one CSV so runs of different commits can be compared with `compare_benchmarks`
+# - every scale runs in a fresh process, so the memory of one scale does not show up in the next
+
+# %% [markdown]
+# ## Functions
+
+# %% [markdown]
+# ### Synthetic WRDS / Yahoo tables
+
+# %%
+BENCHMARK_SCALES = {'small': 500, 'medium': 3000, 'large': 10000}
+BENCHMARK_START = '2000-01-01'
+BENCHMARK_END = '2025-01-01'
+BENCHMARK_TRAIN_END = '2020-12-31'
+
+def _stint_rows(starts, ends):
+    '''(owner, position) of every day in the half-open index ranges [starts, ends)'''
+    lengths = ends - starts
+    owner = np.repeat(np.arange(len(starts)), lengths)
+    position = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) + np.repeat(starts, lengths)
+    return owner, position
+
+def make_synthetic_tables(n_permnos, start_date=BENCHMARK_START, end_date=BENCHMARK_END, char_chosen=None, seed=0):
+    '''synthetic versions of the tables Data_NN queries, with the WRDS column names and dtypes:
+    crsp_dsp500list (index stints), crsp_dsf (daily returns inside the stints), crsp_msenames (two name records per
+    permno), crsp_ccmxpf_linktable (a primary link, some secondary and non-L links), contrib_global_factor (monthly
+    characteristics around the stints, incl. the filter columns) and yahoo/<ticker> market series from 1990'''
+    rng = np.random.default_rng(seed)
+    char_chosen = list(char_chosen or Data_NN().char_chosen)
+    dates = pd.bdate_range(start_date, pd.Timestamp(end_date) - pd.Timedelta(days=1))
+    n_days = len(dates)
+    permnos = np.arange(10001, 10001 + n_permnos)
+    tables = {}
+
+    '''index membership: one stint of 1 year to the whole period, a second stint for a fifth of the permnos'''
+    first_start = rng.integers(0, n_days - 252, n_permnos)
+    first_end = np.minimum(first_start + rng.integers(252, n_days, n_permnos), n_days)
+    again = np.flatnonzero((rng.random(n_permnos) < 0.2) & (first_end < n_days - 300))
+    second_start = first_end[again] + rng.integers(20, 250, len(again))
+    second_end = np.minimum(second_start + rng.integers(60, n_days, len(again)), n_days)
+    stint_permno = np.concatenate([permnos, permnos[again]])
+    stint_start = np.concatenate([first_start, second_start])
+    stint_end = np.concatenate([first_end, second_end])
+    tables['crsp_dsp500list'] = pd.DataFrame({'permno': stint_permno.astype(float),
+                                              'start': dates[stint_start], 'ending': dates[stint_end - 1]})
+
+    '''daily returns inside the stints'''
+    owner, day = _stint_rows(stint_start, stint_end)
+    ret = rng.normal(0.0004, 0.02, len(owner))
+    ret[rng.random(len(owner)) < 0.005] = np.nan
+    tables['crsp_dsf'] = pd.DataFrame({'permno': stint_permno[owner].astype(float), 'date': dates[day], 'ret': ret,
+                                       'vol': rng.integers(10**3, 10**7, len(owner)).astype(float)})\
+        .sort_values(['permno', 'date']).reset_index(drop=True)
+
+    '''names: the name / ticker changes once per permno, the last record is open ended'''
+    split = dates[rng.integers(1, n_days - 1, n_permnos)].to_numpy()
+    idx = np.arange(n_permnos)
+    tables['crsp_msenames'] = pd.DataFrame({
+        'comnam': np.concatenate([[f'COMPANY {i} INC' for i in idx], [f'COMPANY {i} CORP' for i in idx]]),
+        'ncusip': np.concatenate([[f'{i:07d}0' for i in idx], [f'{i:07d}1' for i in idx]]),
+        'namedt': np.concatenate([np.full(n_permnos, np.datetime64('1980-01-01', 'ns')), split + np.timedelta64(1, 'D')]),
+        'nameendt': np.concatenate([split, np.full(n_permnos, np.datetime64(pd.Timestamp(end_date)))]),
+        'permno': np.tile(permnos, 2).astype(float),
+        'shrcd': 11.0, 'exchcd': rng.choice([1.0, 3.0], 2 * n_permnos),
+        'hsiccd': np.tile(rng.integers(1000, 9999, n_permnos), 2).astype(float),
+        'ticker': np.concatenate([[f'T{i}' for i in idx], [f'U{i}' for i in idx]])})
+
+    '''CCM links: a primary link for every permno, a secondary one for some, and non-L links that the query drops'''
+    gvkeys = np.array([f'{100000 + i:06d}' for i in idx])
+    secondary = idx[idx % 5 == 0]
+    dropped = idx[idx % 7 == 0]
+    link_end = np.where(idx % 4 == 0, np.datetime64('2010-06-30'), np.datetime64('NaT'))
+    tables['crsp_ccmxpf_linktable'] = pd.DataFrame({
+        'gvkey': np.concatenate([gvkeys, gvkeys[secondary], gvkeys[dropped]]),
+        'liid': np.concatenate([np.full(n_permnos, '01'), np.full(len(secondary), '02'), np.full(len(dropped), '01')]),
+        'lpermno': np.concatenate([permnos, permnos[secondary], permnos[dropped]]).astype(float),
+        'linktype': np.concatenate([np.full(n_permnos, 'LC'), np.full(len(secondary), 'LU'), np.full(len(dropped), 'NU')]),
+        'linkprim': np.concatenate([np.full(n_permnos, 'P'), np.full(len(secondary), 'C'), np.full(len(dropped), 'N')]),
+        'linkdt': np.concatenate([np.full(n_permnos, np.datetime64('1970-01-01')),
+                                  np.full(len(secondary), np.datetime64('2005-01-01')),
+                                  np.full(len(dropped), np.datetime64('1970-01-01'))]),
+        'linkenddt': np.concatenate([link_end, np.full(len(secondary), np.datetime64('NaT')),
+                                     np.full(len(dropped), np.datetime64('NaT'))])})
+
+    '''monthly characteristics from a year before the first stint to the end of the last one'''
+    eoms = pd.date_range(start_date, end_date, freq='ME')
+    month_of = np.searchsorted(eoms, dates)
+    first_month = np.maximum(month_of[first_start] - 12, 0)
+    last_month = np.full(n_permnos, 0)
+    np.maximum.at(last_month, np.searchsorted(permnos, stint_permno), month_of[stint_end - 1] + 1)
+    owner, month = _stint_rows(first_month, np.minimum(last_month, len(eoms)))
+    n_rows = len(owner)
+    char_data = pd.DataFrame({'id': [f'crsp_{p}' for p in permnos[owner]], 'eom': eoms[month], 'excntry': 'USA',
+                              'gvkey': gvkeys[owner], 'permno': permnos[owner].astype(float),
+                              'size_grp': rng.choice(['mega', 'large', 'small'], n_rows),
+                              'me': rng.lognormal(9, 1.5, n_rows), 'ret_exc_lead1m': rng.normal(0.005, 0.08, n_rows)})
+    for col in char_chosen:
+        char_data[col] = rng.normal(0, 1, n_rows)
+        char_data.loc[rng.random(n_rows) < 0.03, col] = np.nan
+    if 'ope_be' in char_data.columns:
+        char_data.loc[rng.random(n_rows) < 0.005, 'ope_be'] = 50.0
+    for col in ['common', 'exch_main', 'primary_sec', 'obs_main']:
+        char_data[col] = (rng.random(n_rows) > 0.002).astype(int)
+    tables['contrib_global_factor'] = char_data.sort_values(['eom', 'permno']).reset_index(drop=True)
+
+    '''market series (flat OHLCV like market_series returns)'''
+    mkt_dates = pd.bdate_range('1990-01-01', pd.Timestamp(end_date) - pd.Timedelta(days=1), name='Date')
+    for ticker in ['^GSPC'] + list(TREASURY_TICKERS.values()):
+        close = (1000 if ticker == '^GSPC' else 3) * np.cumprod(1 + rng.normal(0.0003, 0.01, len(mkt_dates)))
+        tables[f'yahoo/{ticker}'] = pd.DataFrame({'Close': close, 'High': close * 1.01, 'Low': close * 0.99,
+                                                  'Open': close, 'Volume': 1e9}, index=mkt_dates)
+    return tables
+
+def write_synthetic_fixtures(fixture_dir, n_permnos, seed=0, **kwargs):
+    '''generate the synthetic tables and write them as LocalSource fixtures (skipped if fixture_dir is complete);
+    returns fixture_dir'''
+    done_file = os.path.join(fixture_dir, '_complete')
+    if os.path.exists(done_file):
+        return fixture_dir
+    shutil.rmtree(fixture_dir, ignore_errors=True)
+    os.makedirs(os.path.join(fixture_dir, 'yahoo'))
+    for name, df in make_synthetic_tables(n_permnos, seed=seed, **kwargs).items():
+        df.to_parquet(os.path.join(fixture_dir, f'{name}.parquet'))
+    open(done_file, 'w').close()
+    return fixture_dir
+
+# %% [markdown]
+# ### Benchmark runs
+
+# %%
+def git_commit():
+    '''short hash of the checked out commit (with "+dirty" for local changes), or "unknown" outside git'''
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=here, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no', '.'], cwd=here,
+                               capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit + ('+dirty' if dirty else '')
+
+def benchmark_scale(n_permnos, work_dir='benchmark', seed=0, repeat=1, **data_nn_kwargs):
+    '''build a checkpoint from the synthetic fixtures of n_permnos and read it back, `repeat` times;
+    returns the stage records of all runs (one row per stage and run)'''
+    work_dir = os.path.abspath(work_dir)
+    fixture_dir = write_synthetic_fixtures(os.path.join(work_dir, 'fixtures', f'{n_permnos}_{seed}'), n_permnos, seed=seed)
+    checkpoint_name = f'checkpoint_{n_permnos}'
+    reports = []
+    for run in range(repeat):
+        data_obj = Data_NN(BENCHMARK_START, BENCHMARK_TRAIN_END, end_date=BENCHMARK_END,
+                           source=LocalSource(fixture_dir), show_plots=False, data_dir=work_dir, **data_nn_kwargs)
+        shutil.rmtree(data_obj.checkpoint_path(checkpoint_name), ignore_errors=True)
+
+        print (f'Benchmark {n_permnos} permnos, run {run+1}/{repeat}: build..')
+        with data_obj.stages.stage('build'):
+            data_obj.retrieve_data(checkpoint_name)
+        print (f'Benchmark {n_permnos} permnos, run {run+1}/{repeat}: read back..')
+        with data_obj.stages.stage('read_back'):
+            data_obj.retrieve_data(checkpoint_name)
+            with data_obj.stages.stage('load_tables') as stage:
+                stage['outputs'] = data_size([data_obj.data_dic[x] for x in ['sp500_used', 'train_sp500', 'test_sp500', 'mkt_daily']])
+
+        report = data_obj.stage_report()
+        report.insert(0, 'run', run)
+        reports.append(report)
+        shutil.rmtree(data_obj.checkpoint_path(checkpoint_name), ignore_errors=True)
+    return pd.concat(reports, ignore_index=True)
+
+def run_benchmark(scales=BENCHMARK_SCALES, work_dir='benchmark', results_file='benchmark_results.csv', seed=0,
+                  repeat=1, isolate=True, **data_nn_kwargs):
+    '''run benchmark_scale for every scale ({label: n_permnos}) and append the stage records, tagged with the scale,
+    commit, date and versions, to work_dir/results_file. isolate runs each scale in a fresh process.
+    data_nn_kwargs go to Data_NN (e.g. streaming=True, n_jobs=4)'''
+    os.makedirs(work_dir, exist_ok=True)
+    tags = {'commit': git_commit(), 'run_at': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(), 'pandas': pd.__version__, 'numpy': np.__version__,
+            'settings': ' '.join(f'{k}={v}' for k, v in sorted(data_nn_kwargs.items()))}
+    results = []
+    for label, n_permnos in scales.items():
+        start = time.perf_counter()
+        if isolate:
+            with ProcessPoolExecutor(max_workers=1) as pool:
+                report = pool.submit(benchmark_scale, n_permnos, work_dir, seed, repeat, **data_nn_kwargs).result()
+        else:
+            report = benchmark_scale(n_permnos, work_dir, seed, repeat, **data_nn_kwargs)
+        print (f'Benchmark {label} ({n_permnos} permnos) done in {time.perf_counter()-start:.1f}s')
+        results.append(report.assign(scale=label, n_permnos=n_permnos, **tags))
+    results = pd.concat(results, ignore_index=True)
+
+    path = os.path.join(work_dir, results_file)
+    results.to_csv(path, mode='a', header=not os.path.exists(path), index=False)
+    return results
+
+def compare_benchmarks(results, base_commit, new_commit, metric='wall_s', threshold=1.2):
+    '''stage by stage comparison of two commits in the benchmark results (a frame or the results csv):
+    the median of `metric` over the runs of each commit, their ratio, and whether it is above threshold'''
+    if isinstance(results, str):
+        results = pd.read_csv(results)
+    used = results[results['commit'].isin([base_commit, new_commit])]
+    table = used.groupby(['scale', 'n_permnos', 'stage', 'commit'], sort=False)[metric].median().unstack('commit')
+    table = table[[base_commit, new_commit]].rename(columns={base_commit: f'{metric}_base', new_commit: f'{metric}_new'})
+    table['ratio'] = table[f'{metric}_new'] / table[f'{metric}_base']
+    table['regression'] = table['ratio'] > threshold
+    return table.reset_index()
+
+# %% [markdown]
+# ### Execution Main
+
+# %%
+def benchmark_main(argv=None):
+    parser = argparse.ArgumentParser(description='Data_NN benchmark on synthetic WRDS / Yahoo data')
+    parser.add_argument('--scales', nargs='+', default=list(BENCHMARK_SCALES),
+                        help='scale labels (small / medium / large) or numbers of permnos')
+    parser.add_argument('--work-dir', default='benchmark')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--streaming', action='store_true')
+    parser.add_argument('--n-jobs', type=int, default=1)
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'), help='compare two commits of the results instead')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        table = compare_benchmarks(os.path.join(args.work_dir, 'benchmark_results.csv'), *args.compare)
+        print(table.to_string(index=False))
+        return table
+    scales = {x: BENCHMARK_SCALES[x] if x in BENCHMARK_SCALES else int(x) for x in args.scales}
+    results = run_benchmark(scales, work_dir=args.work_dir, seed=args.seed, repeat=args.repeat,
+                            streaming=args.streaming, n_jobs=args.n_jobs)
+    summary = results.groupby(['scale', 'stage'], sort=False)[['wall_s', 'cpu_s', 'peak_rss_mb', 'rows_out']].median()
+    print(summary.to_string())
+    return results
+
+if __name__ == '__main__':
+    benchmark_main(sys.argv[1:])
+
+# %% [markdown]
+# ### Examples:
+
+# %%
+# Run the three scales and compare against an earlier commit
+# python dsp_DL_ml_portf_data_benchmark.py --scales small medium large --repeat 3
+# python dsp_DL_ml_portf_data_benchmark.py --compare 338d370 <new commit>
+
+# %%
+# From a notebook, one scale in this process with the streaming build
+# results = run_benchmark({'small': 500}, isolate=False, streaming=True, partition_size=100)
@@ -0,0 +1,160 @@
+# %% [markdown]
+# # DS210 - Optimizing Investment Portfolio to Adapt to Regime Change
+# ## Data Retrieval Command Line
+# ### Irene Na
+
+# %% [markdown]
+# ## Set the environment
+
+# %%
+import os
+import sys
+import argparse
+import importlib
+
+from dsp_DL_ml_portf_data_retrieval import Data_NN, LocalSource, read_checkpoint_manifest, verify_checkpoint
+
+# %% [markdown]
+# ## Overview:
+# - runs the checkpoint jobs without a notebook: `build`, `refresh`, `verify` and `benchmark` (the last one is `dsp_DL_ml_portf_data_benchmark.py`)
+# - every path is explicit (`--data-dir`, default the working directory); the working directory is never changed and no plots are drawn
+# - importing the retrieval module is cheap: WRDS, Yahoo and the plotting libraries are only imported once a build needs them, so `verify` (or a worker that only reads checkpoints) never loads them
+# - `--profile-stages` runs stages of a build / refresh under cProfile (stats in `--profile-dir`); `--profiler module:function` uses another profiler instead, such as a sampling profiler: the function is called with the profile dir and returns the `profiler(stage_path)` factory `StageTimer` takes
+# - the exit code is 0 on success and 1 if `verify` finds a problem
+
+# %% [markdown]
+# ## Functions
+
+# %%
+def _source(args):
+    return LocalSource(args.fixtures) if args.fixtures else None
+
+def _profiler(args):
+    '''the profiler factory named by --profiler ('module:function', called with --profile-dir); None for cProfile'''
+    if args.profiler is None:
+        return None
+    module_name, _, function_name = args.profiler.partition(':')
+    return getattr(importlib.import_module(module_name), function_name)(args.profile_dir)
+
+def data_nn_from_checkpoint(checkpoint_dir, **kwargs):
+    '''Data_NN with the build parameters recorded in a checkpoint's manifest (so a refresh continues the same panel);
+    kwargs override them or add other settings'''
+    manifest = read_checkpoint_manifest(checkpoint_dir)
+    if manifest is None:
+        raise ValueError(f'{checkpoint_dir} is a pickle checkpoint, run convert_checkpoint first')
+    build = manifest.get('build', {})
+    params = {x: build[x] for x in ['start_date', 'train_end_date', 'end_date', 'char_chosen', 'abnormal_threshold',
+                                    'cleaning_rules', 'daily_metric_windows', 'char_max_staleness', 'panel_dtypes'] if x in build}
+    if 'daily_metric_reducers' in build:
+        params['daily_metric_reducers'] = tuple(build['daily_metric_reducers'])
+    return Data_NN(**{**params, **kwargs})
+
+def build_command(args):
+    data_obj = Data_NN(args.start_date, args.train_end_date, end_date=args.end_date, checkpoint_format=args.format,
+                       source=_source(args), streaming=args.streaming, partition_size=args.partition_size,
+                       n_jobs=args.n_jobs, cache_dir=args.cache_dir, panel_tensor=not args.no_tensor,
+                       show_plots=False, data_dir=args.data_dir, profile_stages=args.profile_stages,
+                       profile_dir=args.profile_dir, profiler=_profiler(args))
+    if args.rebuild and args.checkpoint:
+        data_obj.prepare_data(args.start_date, args.checkpoint)
+    data_obj.retrieve_data(args.checkpoint)
+    print (f'Checkpoint {data_obj.checkpoint_path()} is ready')
+    _report(data_obj, args)
+    return 0
+
+def refresh_command(args):
+    data_obj = data_nn_from_checkpoint(os.path.join(args.data_dir, args.checkpoint), source=_source(args),
+                                       n_jobs=args.n_jobs, show_plots=False, data_dir=args.data_dir,
+                                       profile_stages=args.profile_stages, profile_dir=args.profile_dir,
+                                       profiler=_profiler(args))
+    data_obj.update_checkpoint(args.checkpoint, end_date=args.end_date)
+    _report(data_obj, args)
+    return 0
+
+def verify_command(args):
+    status = 0
+    for checkpoint in args.checkpoints:
+        problems = verify_checkpoint(os.path.join(args.data_dir, checkpoint))
+        print (f'{checkpoint}: ' + ('ok' if not problems else f'{len(problems)} problem(s)'))
+        for problem in problems:
+            print (f'  - {problem}')
+        status = status or int(bool(problems))
+    return status
+
+def benchmark_command(args):
+    from dsp_DL_ml_portf_data_benchmark import benchmark_main
+    benchmark_main(args.benchmark_args)
+    return 0
+
+def _report(data_obj, args):
+    report = data_obj.stage_report(args.report)
+    if args.verbose:
+        print (report.to_string(index=False))
+
+# %% [markdown]
+# ### Execution Main
+
+# %%
+def cli_main(argv=None):
+    parser = argparse.ArgumentParser(description='build, refresh, verify and benchmark Data_NN checkpoints')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    build = commands.add_parser('build', help='build a checkpoint (or find it in the parameter-keyed cache)')
+    build.add_argument('checkpoint', nargs='?', help='checkpoint name; without it the cache in --cache-dir is used')
+    build.add_argument('--start-date', default='2000-01-01')
+    build.add_argument('--train-end-date', default='2020-12-31')
+    build.add_argument('--end-date', default='2025-01-01')
+    build.add_argument('--format', choices=['arrow', 'pickle'], default='arrow')
+    build.add_argument('--streaming', action='store_true')
+    build.add_argument('--partition-size', type=int, default=250)
+    build.add_argument('--cache-dir', default='checkpoint_cache')
+    build.add_argument('--no-tensor', action='store_true', help='do not store the dense panel tensor')
+    build.add_argument('--rebuild', action='store_true', help='rebuild a named checkpoint that already exists')
+
+    refresh = commands.add_parser('refresh', help='append the data published since a checkpoint was built')
+    refresh.add_argument('checkpoint')
+    refresh.add_argument('--end-date', default=None)
+
+    for command in [build, refresh]:
+        command.add_argument('--data-dir', default='.')
+        command.add_argument('--fixtures', default=None, help='read the raw tables from LocalSource fixtures instead of WRDS / Yahoo')
+        command.add_argument('--n-jobs', type=int, default=1)
+        command.add_argument('--report', default=None, help='save the stage report (.json or .csv)')
+        command.add_argument('--verbose', action='store_true', help='print the stage report')
+        command.add_argument('--profile-stages', nargs='+', default=None, help='stages to profile (e.g. rolling_metrics)')
+        command.add_argument('--profile-dir', default='stage_profiles')
+        command.add_argument('--profiler', default=None, help='module:function returning the profiler factory (default cProfile)')
+
+    verify = commands.add_parser('verify', help='check stored checkpoints against their manifests')
+    verify.add_argument('checkpoints', nargs='+')
+    verify.add_argument('--data-dir', default='.')
+
+    commands.add_parser('benchmark', help='run dsp_DL_ml_portf_data_benchmark.py with the remaining arguments')
+
+    # the benchmark options are parsed by the benchmark itself
+    args, benchmark_args = parser.parse_known_args(argv)
+    if benchmark_args and args.command != 'benchmark':
+        parser.error(f'unrecognized arguments: {" ".join(benchmark_args)}')
+    args.benchmark_args = benchmark_args
+    return {'build': build_command, 'refresh': refresh_command, 'verify': verify_command,
+            'benchmark': benchmark_command}[args.command](args)
+
+if __name__ == '__main__':
+    sys.exit(cli_main(sys.argv[1:]))
+
+# %% [markdown]
+# ### Examples:
+
+# %%
+# Build a named checkpoint in the data folder, then check it
+# python dsp_DL_ml_portf_data_cli.py build data_checkpoint1 --data-dir ../data-used --train-end-date 2020-12-31
+# python dsp_DL_ml_portf_data_cli.py verify data_checkpoint1 --data-dir ../data-used
+
+# %%
+# Refresh it with the data published since, and benchmark the small scale
+# python dsp_DL_ml_portf_data_cli.py refresh data_checkpoint1 --data-dir ../data-used
+# python dsp_DL_ml_portf_data_cli.py benchmark --scales small
+
+# %%
+# Profile the rolling metrics of a build with cProfile (stats in stage_profiles/)
+# python dsp_DL_ml_portf_data_cli.py build data_checkpoint1 --data-dir ../data-used --rebuild --profile-stages rolling_metrics
@@ -11,17 +11,53 @@
 # !pip install  --upgrade openpyxl -- quiet
 # !pip install yfinance --quiet
 
-import wrds
 import pandas as pd
 import numpy as np
 import os
-import matplotlib.pyplot as plt
+import sys
 import pickle
-import seaborn as sns
-import os 
-import yfinance as yf
-
-import openpyxl
+import importlib
+import json
+import glob
+import hashlib
+import time
+import queue
+import asyncio
+import shutil
+import socket
+import threading
+import weakref
+import cProfile
+import functools
+import inspect
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import shared_memory, resource_tracker
+from collections.abc import MutableMapping
+from datetime import datetime
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+class _LazyModule:
+    '''a module imported on first use: the data sources and plotting libraries take seconds to import and reading 
+    a checkpoint needs none of them'''
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+wrds = _LazyModule('wrds')
+yf = _LazyModule('yfinance')
+plt = _LazyModule('matplotlib.pyplot')
+sns = _LazyModule('seaborn')
+openpyxl = _LazyModule('openpyxl')
+fsspec = _LazyModule('fsspec')
 # print(openpyxl.__version__) 
 
 # %% [markdown]
@@ -35,16 +71,15 @@ import openpyxl
 
 # %%
 def check_na_by_col(df, df_name, figsize=(8,4), rotate_x = False):
-    (100*df.apply(lambda x: sum(x.isnull()))/len(df)).rename('Percentage of Missing Value by Columns').sort_values(ascending=False).to_frame()\
+    (100*df.isna().mean()).rename('Percentage of Missing Value by Columns').sort_values(ascending=False).to_frame()\
     .plot(title=f'{df_name} % of Missing Value by Columns', figsize=figsize)
     if rotate_x:
         plt.xticks(rotation=45)
     plt.show()
 
-def prelim_check_data(data_tc, file_name, checkpoint_name=None):
+def prelim_check_data(data_tc, file_name, checkpoint_name=None, data_dir='.'):
     if checkpoint_name:
-        with open(f'./{checkpoint_name}/{file_name}.pkl','rb') as f:
-            data_tc = pickle.load(f)
+        data_tc = load_checkpoint_table(os.path.join(data_dir, checkpoint_name), file_name)
 
     print('\nData shape:')
     display(data_tc.shape)
@@ -84,19 +119,95 @@ def prelim_check_data(data_tc, file_name, checkpoint_name=None):
     print ('The head of the data is:')
     display(data_tc.head())
 
-def mmd_cal(df):
-    df['cum_rtn']=(1+df['return']).cumprod()
-    df['drawdown'] = (df['cum_rtn']-df['cum_rtn'].cummax())/df['cum_rtn'].cummax()
-    df['max_drawdown'] =  df['drawdown'].cummin()
+def mmd_cal(df, state=None):
+    '''cumulative return, drawdown and max drawdown of df['return']; with `state` (see mmd_state) the 
+    series continues from a previous run, giving the same values as computing over the whole history'''
+    if state is None:
+        df['cum_rtn']=(1+df['return']).cumprod()
+        df['drawdown'] = (df['cum_rtn']-df['cum_rtn'].cummax())/df['cum_rtn'].cummax()
+        df['max_drawdown'] =  df['drawdown'].cummin()
+        return df
+    df['cum_rtn'], df['drawdown'], df['max_drawdown'] = continue_mmd(df['return'].to_numpy(dtype='float64'), state)[:3]
     return df
 
+def continue_mmd(returns, state=None):
+    '''cum_rtn, drawdown and max_drawdown arrays of `returns` continued from state (None: from the start), plus the
+    new running (cum_rtn, peak, max_drawdown). NaN returns are skipped like cumprod / cummax / cummin skip them: the 
+    value there is NaN and the running values carry over, so continuing gives the same floats as one full pass'''
+    state = state or {}
+    start = [state.get('cum_rtn'), state.get('peak'), state.get('max_drawdown')]
+    start = [np.nan if x is None else x for x in start]
+    valid = ~np.isnan(returns)
+    # the running values are accumulated with the previous value as the first element, exactly as in a sequential pass
+    cum_rtn = np.multiply.accumulate(np.r_[1.0 if np.isnan(start[0]) else start[0], np.where(valid, 1+returns, 1.0)])[1:]
+    cum_rtn[~valid] = np.nan
+    peak = np.fmax.accumulate(np.r_[start[1], cum_rtn])[1:]
+    drawdown = (cum_rtn-peak)/peak
+    max_drawdown = np.fmin.accumulate(np.r_[start[2], drawdown])[1:]
+    max_drawdown[~valid] = np.nan
+    if valid.any():
+        last = np.flatnonzero(valid)[-1]
+        start = [cum_rtn[last], peak[last], max_drawdown[last]]
+    return cum_rtn, drawdown, max_drawdown, start
+
+def mmd_state(df, state=None):
+    '''running state at the end of a mmd_cal output: last close, cumulative return, peak and max drawdown'''
+    if df['cum_rtn'].notna().sum() == 0:
+        return state
+    return {'date': df['cum_rtn'].last_valid_index().strftime('%Y-%m-%d'),
+            'close': float(df['Close'].dropna().iloc[-1]),
+            'cum_rtn': float(df['cum_rtn'].dropna().iloc[-1]),
+            'peak': float(df['cum_rtn'].max() if state is None else max(state['peak'], df['cum_rtn'].max())),
+            'max_drawdown': float(df['max_drawdown'].dropna().iloc[-1])}
+
+class MarketMetricsUpdater:
+    '''running return, cumulative return, drawdown and max drawdown of an index, kept as the mmd_state dict (date, close,
+    cum_rtn, peak, max_drawdown) and moved forward by new bars instead of recomputing the history:
+    - update(date, close) applies one bar in O(1); a bar with the same date as the last update (an intraday update 
+      of today's close) replaces that bar
+    - append(closes) applies a batch of bars (a Series of closes by date) with vectorized running cumprod / max / min
+    both give the same values as mmd_cal over the whole history (a missing close repeats the previous one, like pct_change)'''
+
+    def __init__(self, state=None):
+        self.state = dict(state) if state else None
+        # state before the last update(), to replace that bar
+        self._before_last = None
+        self._revisable = False
+
+    def update(self, date, close):
+        date = pd.Timestamp(date).strftime('%Y-%m-%d')
+        if self.state is not None and date <= self.state['date']:
+            if date < self.state['date'] or not self._revisable:
+                raise ValueError(f'bar of {date} is not after the last applied bar ({self.state["date"]})')
+            self.state = self._before_last
+        before_last = self.state
+        metrics = self.append(pd.Series([close], index=[pd.Timestamp(date)])).iloc[0].to_dict()
+        self._before_last, self._revisable = before_last, True
+        return metrics
+
+    def append(self, closes):
+        '''metrics of the new bars (columns return, cum_rtn, drawdown, max_drawdown, indexed like closes)'''
+        closes = closes.astype('float64')
+        previous = np.nan if self.state is None else self.state['close']
+        filled = pd.concat([pd.Series([previous]), closes], ignore_index=True).ffill().to_numpy()
+        returns = filled[1:]/filled[:-1] - 1
+        cum_rtn, drawdown, max_drawdown, running = continue_mmd(returns, self.state)
+        self._revisable = False
+        if len(closes) and not np.isnan(filled[-1]):
+            self.state = {'date': closes.index[-1].strftime('%Y-%m-%d'), 'close': float(filled[-1]),
+                          'cum_rtn': float(running[0]) if not np.isnan(running[0]) else None,
+                          'peak': float(running[1]) if not np.isnan(running[1]) else None,
+                          'max_drawdown': float(running[2]) if not np.isnan(running[2]) else None}
+        return pd.DataFrame({'return': returns, 'cum_rtn': cum_rtn, 'drawdown': drawdown, 'max_drawdown': max_drawdown},
+                            index=closes.index)
+
 def block_distribution_plot(df, cols_to_plot, variable_names, n_per_row):
     # Distribution check
     # cols_to_plot = numerical_columns
     n = len(cols_to_plot)
     # n_per_row = 4
 
-    fig1, ax1 = plt.subplots(n//n_per_row, n_per_row, figsize=(15,7))
+    fig1, ax1 = plt.subplots(-(-n//n_per_row), n_per_row, figsize=(15,7), squeeze=False)
 
     for i, col in enumerate(cols_to_plot):
         ax1[i//n_per_row, i%n_per_row].hist(df[col], color='skyblue', bins=30)
@@ -114,7 +225,7 @@ def block_time_series_plot(df, cols_to_plot, variable_names, n_per_row):
     n = len(cols_to_plot)
     # n_per_row = 4
 
-    fig1, ax1 = plt.subplots(n//n_per_row, n_per_row, figsize=(15,7))
+    fig1, ax1 = plt.subplots(-(-n//n_per_row), n_per_row, figsize=(15,7), squeeze=False)
 
     for i, col in enumerate(cols_to_plot):
         t_series = df.groupby('date')[col].mean()
@@ -128,182 +239,1987 @@ def block_time_series_plot(df, cols_to_plot, variable_names, n_per_row):
     plt.show()
 
 # %% [markdown]
-# ## Classes
+# ### Data quality profile
+# - `profile_panel` summarizes a panel without plotting: per-date stock counts, non-missing counts and sums of every numerical column (one groupby), per-column missing rates / min / max, and histogram counts of all columns (one bincount)
+# - the profile is a few small tables stored with the checkpoint (`profile_daily`, `profile_columns`, `profile_hist`); profiles of permno partitions add up with `combine_profiles`
+# - `render_profile` draws the old build plots (missing values, stock count per day, distributions, daily averages) from a profile; builds only call it in an interactive (IPython / Jupyter) session unless `show_plots` says otherwise
 
 # %%
-class Data_NN:
-    '''this is the class to prepare and retreive NN (DL) used data
-    the class will check the existence of checkpoint data first, 
-    if not exist, then retrieve new version of data'''
+PROFILE_BINS = 30
+
+def _histogram_edges(columns_profile, columns, bins=PROFILE_BINS):
+    return {col: np.linspace(columns_profile.loc[col, 'min'], columns_profile.loc[col, 'max'], bins + 1) for col in columns
+            if np.isfinite(columns_profile.loc[col, 'min'])}
+
+def profile_panel(df, numerical_columns, date_col='date', id_col='permno', bins=PROFILE_BINS, edges=None):
+    '''data quality profile of a (date, security) panel, returned as a dict of small tables:
+    daily: per date the stock count and the non-missing count and sum of each numerical column
+    columns: per column (all columns) the row count, non-missing count, missing rate and min / max
+    hist: counts of each numerical column on `bins` equal-width bins between its min and max, or on the given
+    edges ({column: bin edges}, used to profile partitions on common bins); bins=None skips the histograms'''
+    numerical_columns = [x for x in numerical_columns if x in df.columns]
+    # sums in float64, so partition profiles add up to the profile of the whole (float32) panel
+    values = df[numerical_columns].astype('float64').assign(**{date_col: df[date_col], id_col: df[id_col]})
+    by_date = values.groupby(date_col)
+    daily = pd.concat([by_date[id_col].count().rename('stock_count'),
+                       by_date[numerical_columns].count().add_suffix('__count'),
+                       by_date[numerical_columns].sum().add_suffix('__sum')], axis=1)
+
+    columns = pd.DataFrame({'rows': len(df), 'count': df.count()})
+    columns['na_rate'] = 1 - columns['count'] / max(len(df), 1)
+    columns['min'] = df[numerical_columns].min()
+    columns['max'] = df[numerical_columns].max()
+    columns = columns.rename_axis('column')
+    profile = {'daily': daily, 'columns': columns}
+
+    if bins is not None or edges is not None:
+        profile['hist'] = profile_histogram(df, edges if edges is not None else _histogram_edges(columns, numerical_columns, bins))
+    return profile
+
+def profile_histogram(df, edges):
+    '''counts of the columns of df on the given equal-width bin edges ({column: edges}) as a long table 
+    (column, left, right, count); values outside the edges are not counted'''
+    hist_columns = [x for x in edges if x in df.columns]
+    n_bins = np.array([len(edges[col]) - 1 for col in hist_columns], dtype=np.intp)
+    lo = np.array([edges[col][0] for col in hist_columns], dtype=float)
+    hi = np.array([edges[col][-1] for col in hist_columns], dtype=float)
+    # a constant column is binned on (min - 0.5, max + 0.5), as np.histogram does
+    lo, hi = np.where(lo == hi, lo - 0.5, lo), np.where(lo == hi, hi + 0.5, hi)
+
+    # every value gets the number of its bin among the bins of all columns (the bins of column j start at 
+    # bin_start[j]), so one bincount counts all columns
+    values = df[hist_columns].to_numpy(dtype=float)
+    keep = (values >= lo) & (values <= hi)
+    value_col = np.broadcast_to(np.arange(len(hist_columns)), values.shape)[keep]
+    x = values[keep]
+    index = ((x - lo[value_col]) / (hi - lo)[value_col] * n_bins[value_col]).astype(np.intp)
+    index[index == n_bins[value_col]] -= 1
+    # values that the division rounds into a neighbouring bin are moved back by comparing with the bin edges 
+    # (same correction as np.histogram)
+    bin_start = np.r_[0, np.cumsum(n_bins)]
+    bin_edges = np.concatenate([np.linspace(lo[j], hi[j], n_bins[j] + 1) for j in range(len(hist_columns))] + [[]])
+    edge_start = bin_start[:-1] + np.arange(len(hist_columns))
+    index -= x < bin_edges[edge_start[value_col] + index]
+    index += (x >= bin_edges[edge_start[value_col] + index + 1]) & (index != n_bins[value_col] - 1)
+    counts = np.bincount(bin_start[value_col] + index, minlength=bin_start[-1])
+    return pd.DataFrame({'column': np.repeat(hist_columns, n_bins),
+                         'left': np.concatenate([edges[col][:-1] for col in hist_columns] + [[]]),
+                         'right': np.concatenate([edges[col][1:] for col in hist_columns] + [[]]),
+                         'count': counts})
+
+def combine_profiles(profiles):
+    '''profile of a panel from the profiles of its (permno) partitions; histograms must use the same edges'''
+    daily = pd.concat([x['daily'] for x in profiles]).groupby(level=0).sum()
+    columns = pd.concat([x['columns'] for x in profiles]).groupby(level=0, sort=False)\
+        .agg({'rows': 'sum', 'count': 'sum', 'min': 'min', 'max': 'max'})
+    columns['na_rate'] = 1 - columns['count'] / columns['rows'].clip(lower=1)
+    profile = {'daily': daily, 'columns': columns[['rows', 'count', 'na_rate', 'min', 'max']]}
+    if all('hist' in x for x in profiles):
+        profile['hist'] = pd.concat([x['hist'] for x in profiles]).groupby(['column', 'left', 'right'], sort=False, as_index=False)['count'].sum()
+    return profile
+
+def profile_daily_means(profile):
+    '''average of every profiled column per date'''
+    daily = profile['daily']
+    columns = [x[:-len('__sum')] for x in daily.columns if x.endswith('__sum')]
+    return pd.DataFrame({col: daily[f'{col}__sum'] / daily[f'{col}__count'].where(daily[f'{col}__count'] > 0) for col in columns})
+
+def render_profile(profile, name, n_per_row=4):
+    '''draw the data check plots from a profile: missing values by column, stock count per day,
+    distributions and daily averages of the numerical columns'''
+    (100*profile['columns']['na_rate']).rename('Percentage of Missing Value by Columns').sort_values(ascending=False).to_frame()\
+        .plot(title=f'{name} % of Missing Value by Columns', figsize=(8,3))
+    plt.xticks(rotation=45)
+    plt.show()
 
-    '''note: if you will create the data with new checkpoint name, you will
-    need to put in WRDS user name, password, and "Y"'''
+    profile['daily']['stock_count'].rename('Stock_count_per_day').plot(title=f'Stock Count Per Day in {name} Data', figsize=(8,4))
+    plt.show()
+
+    means = profile_daily_means(profile)
+    cols_to_plot = list(means.columns)
+    if 'hist' in profile:
+        hist = profile['hist']
+        fig1, ax1 = plt.subplots(-(-len(cols_to_plot)//n_per_row), n_per_row, figsize=(15,7), squeeze=False)
+        for i, col in enumerate(cols_to_plot):
+            bars = hist[hist['column'] == col]
+            ax1[i//n_per_row, i%n_per_row].bar(bars['left'], bars['count'], width=bars['right']-bars['left'], align='edge', color='skyblue')
+            ax1[i//n_per_row, i%n_per_row].set_title(col)
+            ax1[i//n_per_row, i%n_per_row].set_ylabel('count')
+            ax1[i//n_per_row, i%n_per_row].set_xlabel('value_range')
+        plt.suptitle('Distribution Plots for Numerical Variables')
+        plt.subplots_adjust(top=0.90, bottom=0.01, hspace=0.8)
+        plt.show()
+
+    fig1, ax1 = plt.subplots(-(-len(cols_to_plot)//n_per_row), n_per_row, figsize=(15,7), squeeze=False)
+    for i, col in enumerate(cols_to_plot):
+        ax1[i//n_per_row, i%n_per_row].plot(means[col])
+        ax1[i//n_per_row, i%n_per_row].set_title(col)
+        ax1[i//n_per_row, i%n_per_row].set_ylabel('Average value')
+        ax1[i//n_per_row, i%n_per_row].set_xlabel('Time')
+    plt.suptitle('Time Series Plots for Numerical Variables (Average Per Day)')
+    plt.subplots_adjust(top=0.90, bottom=0.01, hspace=0.8, wspace=0.3)
+    plt.show()
+
+def _interactive_session():
+    '''True inside IPython / Jupyter, where the build shows its plots by default'''
+    try:
+        from IPython import get_ipython
+    except ImportError:
+        return False
+    return get_ipython() is not None
+
+PROFILE_TABLES = ['profile_daily', 'profile_columns', 'profile_hist']
+
+def save_profile(profile, checkpoint_dir, manifest, checkpoint_format='arrow'):
+    '''store the profile tables with a checkpoint (profile_daily, profile_columns, profile_hist)'''
+    for table_name in PROFILE_TABLES:
+        if table_name[len('profile_'):] in profile:
+            save_checkpoint_table(profile[table_name[len('profile_'):]], checkpoint_dir, table_name, manifest, checkpoint_format)
+
+def load_profile(checkpoint_dir):
+    '''profile stored with a checkpoint, see save_profile'''
+    manifest = read_checkpoint_manifest(checkpoint_dir)
+    stored = manifest['tables'] if manifest is not None else [x[:-len('.pkl')] for x in os.listdir(checkpoint_dir)]
+    return {table_name[len('profile_'):]: load_checkpoint_table(checkpoint_dir, table_name, manifest=manifest)
+            for table_name in PROFILE_TABLES if table_name in stored}
+
+# %% [markdown]
+# ### Checkpoint storage
+# - DataFrames are stored as uncompressed Arrow IPC (Feather v2) files so they can be memory-mapped and read column by column
+# - small python objects (dicts) stay as pickles
+# - tables of a streaming build are partitioned by permno: one Feather file per partition in a `{table}/` folder, read back as one table
+# - a `manifest.json` in the checkpoint folder lists every table, its file and its columns
+# - checkpoints without a manifest are the old all-pickle format; they are still readable and can be converted with `convert_checkpoint`
+# - `verify_checkpoint` checks a stored checkpoint against its manifest without loading the tables (file sizes, Arrow row counts and columns, split ranges, tensor shape)
+
+# %%
+CHECKPOINT_MANIFEST = 'manifest.json'
+CHECKPOINT_FORMAT_VERSION = 1
+
+def read_checkpoint_manifest(checkpoint_dir):
+    '''return the manifest dict of a checkpoint folder, or None for a legacy (pickle only) checkpoint'''
+    manifest_path = os.path.join(checkpoint_dir, CHECKPOINT_MANIFEST)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+def write_checkpoint_manifest(checkpoint_dir, manifest):
+    manifest['format_version'] = CHECKPOINT_FORMAT_VERSION
+    manifest['updated'] = datetime.now().isoformat(timespec='seconds')
+    # swapped in, so a reader never sees a partly written manifest
+    manifest_path = os.path.join(checkpoint_dir, CHECKPOINT_MANIFEST)
+    with open(f'{manifest_path}.{os.getpid()}-{threading.get_ident()}', 'w') as f:
+        json.dump(manifest, f, indent=2, default=str)
+    os.replace(f.name, manifest_path)
+
+def _frame_to_table(df):
+    '''convert a DataFrame to an Arrow table, keeping the index and keeping NaN in float columns as NaN
+    (instead of nulls) so float columns can be handed to pandas straight from the memory map'''
+    table = pa.Table.from_pandas(df, preserve_index=True)
+    for i, field in enumerate(table.schema):
+        if pa.types.is_floating(field.type) and table.column(i).null_count > 0:
+            table = table.set_column(i, field, pc.fill_null(table.column(i), float('nan')))
+    return table
+
+def save_checkpoint_table(obj, checkpoint_dir, table_name, manifest, checkpoint_format='arrow'):
+    '''save one table of a checkpoint and record it in the manifest (the manifest is written by the caller)'''
+    if isinstance(obj, pd.DataFrame) and checkpoint_format == 'arrow':
+        table = _frame_to_table(obj)
+        file_name = f'{table_name}.feather'
+        # write next to the old file and swap, so readers that still memory-map the old version are not affected
+        feather.write_feather(table, os.path.join(checkpoint_dir, file_name + '.tmp'), compression='uncompressed')
+        os.replace(os.path.join(checkpoint_dir, file_name + '.tmp'), os.path.join(checkpoint_dir, file_name))
+        manifest.setdefault('tables', {})[table_name] = {
+            'file': file_name,
+            'kind': 'arrow',
+            'rows': len(obj),
+            'columns': list(map(str, obj.columns)),
+            'index_columns': [x for x in table.schema.pandas_metadata['index_columns'] if isinstance(x, str)]}
+    else:
+        file_name = f'{table_name}.pkl'
+        with open(os.path.join(checkpoint_dir, file_name + '.tmp'), 'wb') as f:
+            pickle.dump(obj, f)
+        os.replace(os.path.join(checkpoint_dir, file_name + '.tmp'), os.path.join(checkpoint_dir, file_name))
+        manifest.setdefault('tables', {})[table_name] = {'file': file_name, 'kind': 'pickle'}
+    manifest['tables'][table_name]['bytes'] = os.path.getsize(os.path.join(checkpoint_dir, file_name))
+
+def save_checkpoint_partition(df, checkpoint_dir, table_name, part, manifest, shift_index=True):
+    '''save one permno partition of a partitioned table as {table_name}/part-00000.feather, ... and add it to the
+    manifest entry (kind 'arrow_partitioned'); load_checkpoint_table reads the partitions back in order as one table.
+    shift_index: df is numbered 0..len(df)-1; its index is shifted (in place) to follow the rows already saved, so the 
+    combined table has the row labels of a table built in one piece'''
+    os.makedirs(os.path.join(checkpoint_dir, table_name), exist_ok=True)
+    if shift_index and table_name in manifest.get('tables', {}):
+        df.index = df.index + manifest['tables'][table_name]['rows']
+    table = _frame_to_table(df)
+    file_name = f'{table_name}/part-{part:05d}.feather'
+    feather.write_feather(table, os.path.join(checkpoint_dir, file_name + '.tmp'), compression='uncompressed')
+    os.replace(os.path.join(checkpoint_dir, file_name + '.tmp'), os.path.join(checkpoint_dir, file_name))
+    entry = manifest.setdefault('tables', {}).setdefault(table_name, {
+        'files': [],
+        'kind': 'arrow_partitioned',
+        'rows': 0,
+        'columns': list(map(str, df.columns)),
+        'index_columns': [x for x in table.schema.pandas_metadata['index_columns'] if isinstance(x, str)],
+        'bytes': 0})
+    entry['files'].append(file_name)
+    entry['rows'] += len(df)
+    entry['bytes'] += os.path.getsize(os.path.join(checkpoint_dir, file_name))
+
+def _table_date_column(entry):
+    '''the column used for date-range projection: 'date' for the security panels, the (Date) index for market data'''
+    if 'date' in entry.get('columns', []):
+        return 'date'
+    if len(entry.get('index_columns', [])) == 1:
+        return entry['index_columns'][0]
+    return None
+
+def load_checkpoint_table(checkpoint_dir, table_name, columns=None, start_date=None, end_date=None, manifest=None, rows=None):
+    '''load one table of a checkpoint; for Arrow tables the file is memory-mapped and only `columns`
+    (plus the index) are read, and rows outside [start_date, end_date] (or outside the `rows` slice) are dropped 
+    before converting to pandas. Partitioned tables (streaming builds) are read partition by partition and concatenated.
+    Legacy pickle checkpoints are loaded whole and then projected'''
+    if manifest is None:
+        manifest = read_checkpoint_manifest(checkpoint_dir)
+    entry = (manifest or {}).get('tables', {}).get(table_name, {'file': f'{table_name}.pkl', 'kind': 'pickle'})
+    date_filter = start_date is not None or end_date is not None
+
+    if entry['kind'] in ['arrow', 'arrow_partitioned']:
+        date_col = _table_date_column(entry)
+        read_columns = None
+        if columns is not None:
+            read_columns = list(columns) + [x for x in entry['index_columns'] if x not in columns]
+            if date_filter and date_col not in read_columns:
+                read_columns.append(date_col)
+        files = entry['files'] if entry['kind'] == 'arrow_partitioned' else [entry['file']]
+        tables = [feather.read_table(os.path.join(checkpoint_dir, x), columns=read_columns, memory_map=True) for x in files]
+        # a column that is empty in one partition (all null) takes the type it has in the others
+        table = tables[0] if len(tables) == 1 else pa.concat_tables(tables, promote_options='permissive')
+        if rows is not None:
+            start, stop, _ = rows.indices(table.num_rows)
+            table = table.slice(start, max(stop - start, 0))
+        if date_filter:
+            mask = pa.array(np.ones(table.num_rows, dtype=bool))
+            if start_date is not None:
+                mask = pc.and_(mask, pc.greater_equal(table.column(date_col), pd.Timestamp(start_date)))
+            if end_date is not None:
+                mask = pc.and_(mask, pc.less_equal(table.column(date_col), pd.Timestamp(end_date)))
+            table = table.filter(mask)
+        df = table.to_pandas(split_blocks=True)
+        if columns is not None and date_col not in columns and date_col in df.columns:
+            df = df.drop(columns=[date_col])
+        return df
+
+    with open(os.path.join(checkpoint_dir, entry['file']), 'rb') as f:
+        obj = pickle.load(f)
+    if isinstance(obj, pd.DataFrame):
+        if rows is not None:
+            obj = obj.iloc[rows]
+        if date_filter:
+            dates = obj['date'] if 'date' in obj.columns else obj.index.to_series()
+            obj = obj[dates.between(start_date or dates.min(), end_date or dates.max()).values]
+        if columns is not None:
+            obj = obj[list(columns)]
+    return obj
+
+def remove_checkpoint_table(checkpoint_dir, table_name, manifest):
+    '''delete the file(s) of a table and its manifest entry (the manifest is written by the caller)'''
+    entry = manifest.get('tables', {}).pop(table_name, None)
+    if entry is None:
+        return
+    if entry['kind'] == 'arrow_partitioned':
+        shutil.rmtree(os.path.join(checkpoint_dir, table_name), ignore_errors=True)
+    elif os.path.exists(os.path.join(checkpoint_dir, entry['file'])):
+        os.remove(os.path.join(checkpoint_dir, entry['file']))
+
+def convert_checkpoint(checkpoint_dir, remove_pickles=False):
+    '''convert a legacy pickle checkpoint to the columnar format in place (one step)'''
+    manifest = read_checkpoint_manifest(checkpoint_dir) or {}
+    for path in sorted(glob.glob(os.path.join(checkpoint_dir, '*.pkl'))):
+        table_name = os.path.splitext(os.path.basename(path))[0]
+        if manifest.get('tables', {}).get(table_name, {}).get('kind') == 'arrow':
+            continue
+        with open(path, 'rb') as f:
+            obj = pickle.load(f)
+        save_checkpoint_table(obj, checkpoint_dir, table_name, manifest)
+        if remove_pickles and isinstance(obj, pd.DataFrame):
+            os.remove(path)
+        print(f'converted {table_name} ({manifest["tables"][table_name]["kind"]})')
+    write_checkpoint_manifest(checkpoint_dir, manifest)
+    return manifest
+
+def verify_checkpoint(checkpoint_dir):
+    '''check a checkpoint against its manifest: every table file is there with the recorded size, the Arrow tables 
+    have the recorded rows and columns (read from the memory-mapped files), the split views and date offsets fit 
+    sp500_used and the tensor has the recorded shape. Pickle checkpoints are only checked to unpickle.
+    Returns the problems found, an empty list if there are none'''
+    if not os.path.isdir(checkpoint_dir):
+        return [f'{checkpoint_dir} does not exist']
+    manifest = read_checkpoint_manifest(checkpoint_dir)
+    problems = []
+    if manifest is None:
+        paths = sorted(glob.glob(os.path.join(checkpoint_dir, '*.pkl')))
+        if not paths:
+            problems.append('no manifest and no pickled tables')
+        for path in paths:
+            try:
+                with open(path, 'rb') as f:
+                    pickle.load(f)
+            except Exception as e:
+                problems.append(f'{os.path.basename(path)}: does not unpickle ({e})')
+        return problems
+
+    tables = manifest.get('tables', {})
+    for table_name, entry in tables.items():
+        files = entry['files'] if entry['kind'] == 'arrow_partitioned' else [entry['file']]
+        missing = [x for x in files if not os.path.exists(os.path.join(checkpoint_dir, x))]
+        if missing:
+            problems.append(f'{table_name}: missing {", ".join(missing)}')
+            continue
+        size = sum(os.path.getsize(os.path.join(checkpoint_dir, x)) for x in files)
+        if 'bytes' in entry and size != entry['bytes']:
+            problems.append(f'{table_name}: {size} bytes, the manifest says {entry["bytes"]}')
+        if entry['kind'] == 'pickle':
+            continue
+        try:
+            parts = [feather.read_table(os.path.join(checkpoint_dir, x), memory_map=True) for x in files]
+        except (OSError, pa.ArrowException) as e:
+            problems.append(f'{table_name}: unreadable ({e})')
+            continue
+        rows = sum(x.num_rows for x in parts)
+        if rows != entry['rows']:
+            problems.append(f'{table_name}: {rows} rows, the manifest says {entry["rows"]}')
+        missing_columns = [x for x in entry['columns'] if any(x not in part.column_names for part in parts)]
+        if missing_columns:
+            problems.append(f'{table_name}: missing columns {missing_columns}')
+
+    for view_name, view in manifest.get('splits', {}).get('views', {}).items():
+        rows = tables.get(view['table'], {}).get('rows')
+        if rows is None or not 0 <= view['start'] <= view['stop'] <= rows:
+            problems.append(f'split {view_name}: rows [{view["start"]}, {view["stop"]}) are not in {view["table"]}')
+    if 'sp500_used_offsets' in tables and not problems:
+        offsets = load_checkpoint_table(checkpoint_dir, 'sp500_used_offsets', manifest=manifest)
+        dates = load_checkpoint_table(checkpoint_dir, 'sp500_used', columns=['date'], manifest=manifest)['date']
+        if not offsets.equals(date_offsets(dates)):
+            problems.append('sp500_used_offsets do not match the dates of sp500_used (is it still sorted by date?)')
+    if 'tensor' in manifest:
+        tensor_dir = os.path.join(checkpoint_dir, manifest['tensor']['dir'])
+        try:
+            shape = list(np.load(os.path.join(tensor_dir, 'values.npy'), mmap_mode='r').shape)
+            if shape != manifest['tensor']['shape']:
+                problems.append(f'tensor: shape {shape}, the manifest says {manifest["tensor"]["shape"]}')
+            for file_name in ['mask.npy', 'dates.npy', 'permnos.npy']:
+                np.load(os.path.join(tensor_dir, file_name), mmap_mode='r')
+        except (OSError, ValueError) as e:
+            problems.append(f'tensor: unreadable ({e})')
+    return problems
+
+# %% [markdown]
+# ### Date-sorted panel splits
+# - sp500_used is stored sorted by date (permno order within a date) together with `sp500_used_offsets`, the first and one-past-last row of every date
+# - a time split is then a range of rows: train_sp500 / test_sp500 and train_mkt / test_mkt are recorded in the manifest as row ranges of sp500_used / mkt_daily and handed out as views (`iloc` slices), so no row is stored twice, and moving the split only rewrites the manifest
+# - ranges cover the dates in (after, through]: the train part ends on train_end_date and the test part starts the day after, for the market data too
+# - `walk_forward_folds` gives expanding or rolling train / test windows as row ranges of the same panel
+
+# %%
+SPLIT_VIEWS = {'train_sp500': 'sp500_used', 'test_sp500': 'sp500_used', 'train_mkt': 'mkt_daily', 'test_mkt': 'mkt_daily'}
+
+def date_offsets(dates):
+    '''first and one-past-last row of every date of a date-sorted column (or index), as a frame (date, start, stop)'''
+    dates = np.asarray(dates)
+    starts = np.flatnonzero(np.r_[True, dates[1:] != dates[:-1]]) if len(dates) else np.zeros(0, dtype=np.int64)
+    return pd.DataFrame({'date': dates[starts], 'start': starts, 'stop': np.r_[starts[1:], len(dates)].astype(np.int64)})
+
+def row_range(offsets, after=None, through=None):
+    '''slice of the rows of a date-sorted table dated in (after, through]; None leaves that side open'''
+    dates = offsets['date'].to_numpy()
+    bounds = np.r_[offsets['start'].to_numpy(), offsets['stop'].to_numpy()[-1:]] if len(dates) else np.zeros(1, dtype=np.int64)
+    first = 0 if after is None else np.searchsorted(dates, np.datetime64(pd.Timestamp(after)), side='right')
+    last = len(dates) if through is None else np.searchsorted(dates, np.datetime64(pd.Timestamp(through)), side='right')
+    return slice(int(bounds[first]), int(bounds[max(first, last)]))
+
+def split_rows(offsets, train_end_date):
+    '''(train, test) row ranges: the dates up to and including train_end_date, and the dates after it'''
+    return row_range(offsets, through=train_end_date), row_range(offsets, after=train_end_date)
+
+def split_views(sp500_used_offsets, mkt_offsets, train_end_date):
+    '''train / test row ranges of sp500_used and mkt_daily at train_end_date, as recorded in the manifest'''
+    views = {}
+    for view_name, table_name in SPLIT_VIEWS.items():
+        train, test = split_rows(sp500_used_offsets if table_name == 'sp500_used' else mkt_offsets, train_end_date)
+        rows = train if view_name.startswith('train') else test
+        views[view_name] = {'table': table_name, 'start': rows.start, 'stop': rows.stop}
+    return {'train_end_date': train_end_date, 'views': views}
+
+def update_ticker_maps(train_sp500, ticker_permno_dic, permno_ticker_dic):
+    '''add the (ticker, permno) pairs of train_sp500 to the maps, in (permno, date) order; a later pair overwrites 
+    an earlier one (for lookups that depend on the date use the identifier index)'''
+    train_sp500 = train_sp500[['ticker','permno']].iloc[np.argsort(train_sp500['permno'].to_numpy(), kind='stable')]
+    for ticker, permno in train_sp500.set_index(['ticker','permno']).index.unique():
+        ticker_permno_dic[ticker] = permno
+        permno_ticker_dic[permno] = ticker
+
+def walk_forward_folds(offsets, first_train_end, test_months=12, train_months=None, step_months=None):
+    '''walk-forward folds over a date-sorted table. Fold k trains up to first_train_end + k*step_months (default 
+    step: test_months) on all earlier dates (train_months=None, expanding window) or on the last train_months months 
+    (rolling window), and tests on the next test_months months. Returns a list of dicts with the fold dates and the
+    train / test row ranges'''
+    last_date = pd.Timestamp(offsets['date'].iloc[-1])
+    step_months = step_months or test_months
+    first_train_end = pd.Timestamp(first_train_end)
+    # a month-end first_train_end keeps every fold boundary on a month end (2001-06-30 -> 2001-12-31, not 2001-12-30)
+    def months_after(n):
+        return first_train_end + (pd.offsets.MonthEnd(n) if first_train_end.is_month_end else pd.DateOffset(months=n))
+    folds = []
+    train_end = first_train_end
+    while train_end < last_date:
+        k = len(folds)*step_months
+        train_after = None if train_months is None else months_after(k - train_months)
+        test_end = months_after(k + test_months)
+        folds.append({'fold': len(folds), 'train_after': train_after, 'train_end': train_end, 'test_end': test_end,
+                      'train': row_range(offsets, after=train_after, through=train_end),
+                      'test': row_range(offsets, after=train_end, through=test_end)})
+        train_end = months_after(len(folds)*step_months)
+    return folds
+
+def sort_partitioned_by_date(checkpoint_dir, table_name, manifest, date_col='date', batch_rows=1000000):
+    '''rewrite a partitioned table (streaming build) as one file sorted by date. The sort is stable, so rows keep the
+    partition (permno) order within a date, and the row labels are renumbered 0..n-1. The partitions are memory-mapped
+    and gathered batch_rows at a time, so only the dates and the sort order are held in memory. Returns the date offsets'''
+    entry = manifest['tables'][table_name]
+    tables = [feather.read_table(os.path.join(checkpoint_dir, x), memory_map=True) for x in entry['files']]
+    # one dictionary per categorical column for the whole file
+    table = pa.concat_tables(tables, promote_options='permissive').unify_dictionaries()
+    dates = table.column(date_col).to_numpy()
+    order = np.argsort(dates, kind='stable')
+    index_position = table.schema.get_field_index(entry['index_columns'][0]) if entry['index_columns'] else None
+
+    file_name = f'{table_name}.feather'
+    with pa.ipc.new_file(os.path.join(checkpoint_dir, file_name + '.tmp'), table.schema) as writer:
+        for start in range(0, len(order), batch_rows):
+            batch = table.take(order[start:start+batch_rows])
+            if index_position is not None:
+                batch = batch.set_column(index_position, table.schema.field(index_position),
+                                         pa.array(np.arange(start, start + batch.num_rows), type=table.schema.field(index_position).type))
+            writer.write_table(batch)
+    del tables, table
+    shutil.rmtree(os.path.join(checkpoint_dir, table_name), ignore_errors=True)
+    os.replace(os.path.join(checkpoint_dir, file_name + '.tmp'), os.path.join(checkpoint_dir, file_name))
+    manifest['tables'][table_name] = {'file': file_name, 'kind': 'arrow', 'rows': entry['rows'], 'columns': entry['columns'],
+                                      'index_columns': entry['index_columns'],
+                                      'bytes': os.path.getsize(os.path.join(checkpoint_dir, file_name))}
+    return date_offsets(dates[order])
+
+# %% [markdown]
+# ### Dense panel tensor
+# - sp500_used laid out as a (trading date, permno, feature) array for the DL dataset, with a validity mask (the permno has a row on that date) and the date / permno index vectors
+# - stored as .npy files in the checkpoint's panel_tensor folder and opened memory-mapped: the lookback window of a rebalance date is a slice of the first axis, i.e. a view, instead of a filter of the long panel
+# - dates without a row for a permno are NaN with mask False; a row with a missing feature is NaN with mask True
+
+# %%
+PANEL_TENSOR_DIR = 'panel_tensor'
+PANEL_TENSOR_DTYPE = 'float32'
+
+def build_panel_tensor(tensor_dir, read_columns, offsets, features, dtype=PANEL_TENSOR_DTYPE, feature_block=8):
+    '''write the dense tensor of a date-sorted panel. read_columns(names) returns those columns of the panel (a frame, 
+    in its row order) and offsets are its date offsets (date_offsets). Features are copied feature_block at a time, so 
+    only a few columns of the panel are in memory at once. The files are written next to tensor_dir and swapped in at 
+    the end, so a reader that has the old tensor mapped keeps a valid copy. Returns the manifest entry'''
+    permnos = read_columns(['permno'])['permno'].to_numpy()
+    permno_index = np.unique(permnos)
+    date_pos = np.repeat(np.arange(len(offsets)), (offsets['stop'] - offsets['start']).to_numpy())
+    permno_pos = np.searchsorted(permno_index, permnos)
+    shape = (len(offsets), len(permno_index))
+
+    tmp_dir = tensor_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    np.save(os.path.join(tmp_dir, 'dates.npy'), offsets['date'].to_numpy())
+    np.save(os.path.join(tmp_dir, 'permnos.npy'), permno_index)
+    mask = np.lib.format.open_memmap(os.path.join(tmp_dir, 'mask.npy'), mode='w+', dtype=bool, shape=shape)
+    mask[date_pos, permno_pos] = True
+    mask.flush()
+    values = np.lib.format.open_memmap(os.path.join(tmp_dir, 'values.npy'), mode='w+', dtype=dtype, 
+                                       shape=shape + (len(features),))
+    values[:] = np.nan
+    for start in range(0, len(features), feature_block):
+        names = list(features[start:start+feature_block])
+        values[date_pos, permno_pos, start:start+len(names)] = read_columns(names).to_numpy(dtype=dtype)
+    values.flush()
+    del mask, values
+
+    shutil.rmtree(tensor_dir, ignore_errors=True)
+    os.rename(tmp_dir, tensor_dir)
+    return {'dir': os.path.basename(tensor_dir), 'features': list(features), 'shape': list(shape) + [len(features)], 
+            'dtype': str(np.dtype(dtype))}
+
+class PanelTensor:
+    '''memory-mapped dense tensor of a checkpoint (see build_panel_tensor): values[t, i, k] is feature k of permno 
+    permnos[i] on dates[t], and mask[t, i] whether that permno has a row on that date'''
+
+    def __init__(self, checkpoint_dir, manifest=None):
+        manifest = manifest or read_checkpoint_manifest(checkpoint_dir)
+        entry = manifest['tensor']
+        tensor_dir = os.path.join(checkpoint_dir, entry['dir'])
+        self.features = entry['features']
+        self.dates = np.load(os.path.join(tensor_dir, 'dates.npy'))
+        self.permnos = np.load(os.path.join(tensor_dir, 'permnos.npy'))
+        self.mask = np.load(os.path.join(tensor_dir, 'mask.npy'), mmap_mode='r')
+        self.values = np.load(os.path.join(tensor_dir, 'values.npy'), mmap_mode='r')
 
-    def __init__(self, start_date='2000-01-01', train_end_date='2020-12-31'):
-        self.checkpoint_name = ''
-        self.data_dic = {}
-        self.start_date=start_date
-        self.train_end_date = train_end_date
-         
     def __repr__(self):
-        return f'\nThe checkpoint name of this data is {self.checkpoint_name}, \nand data_dic keys are {list(self.data_dic.keys())}'
-    
-    def set_directory(self, data_directory_path):
-        #IN: note this directory_path should be where the data is at
-        self.dir = data_directory_path
-        os.chdir(data_directory_path)
+        return (f'PanelTensor({len(self.dates)} dates x {len(self.permnos)} permnos x {len(self.features)} features, '
+                f'{pd.Timestamp(self.dates[0]).date()} to {pd.Timestamp(self.dates[-1]).date()})')
 
-    def check_checkpoint(self, checkpoint_name):
-        if checkpoint_name in os.listdir():
-            self.checkpoint_name = checkpoint_name
-            return True
+    def date_position(self, date):
+        '''position of the last trading date on or before date (-1 if date is before the first one)'''
+        return int(np.searchsorted(self.dates, np.datetime64(pd.Timestamp(date)), side='right')) - 1
+
+    def feature_position(self, *features):
+        '''positions of features along the last axis'''
+        return [self.features.index(x) for x in features]
+
+    def window_at(self, position, lookback):
+        '''(values, mask) of the lookback trading dates ending at date position `position` (inclusive), as views of 
+        the mapped arrays; fewer dates near the start of the panel'''
+        start = max(position + 1 - lookback, 0)
+        return self.values[start:position+1], self.mask[start:position+1]
+
+    def window(self, end_date, lookback):
+        '''(values, mask) of the lookback trading dates ending on end_date (or the last trading date before it)'''
+        return self.window_at(self.date_position(end_date), lookback)
+
+# %% [markdown]
+# ### Indexed panel queries
+# - a date-sorted sp500_used already has a date index (`sp500_used_offsets`); the permno index is the row order sorted by (permno, date) (`sp500_used_permno_rows`) plus the first and one-past-last position of every permno in it (`sp500_used_permno_offsets`), both written with the checkpoint
+# - `PanelQuery` answers cross-section (all rows of a date), history (rows of a permno between two dates) and as-of (last row on or before a date per permno) queries with binary searches on these indexes, then takes only those rows (and only the requested columns) from the memory-mapped file
+
+# %%
+PERMNO_INDEX_TABLES = ['sp500_used_permno_offsets', 'sp500_used_permno_rows']
+
+def permno_index(permnos):
+    '''(permno offsets, rows) of a date-sorted permno column: rows lists the row numbers in (permno, date) order and 
+    the offsets frame (permno, start, stop) gives the range of each permno in it'''
+    permnos = np.asarray(permnos)
+    rows = np.argsort(permnos, kind='stable')
+    sorted_permnos = permnos[rows]
+    starts = np.flatnonzero(np.r_[True, sorted_permnos[1:] != sorted_permnos[:-1]]) if len(rows) else np.zeros(0, dtype=np.int64)
+    offsets = pd.DataFrame({'permno': sorted_permnos[starts], 'start': starts, 
+                            'stop': np.r_[starts[1:], len(rows)].astype(np.int64)})
+    return offsets, pd.DataFrame({'row': rows.astype(np.int64)})
+
+class PanelQuery:
+    '''point-in-time queries on the (date-sorted, columnar) sp500_used of a checkpoint without loading the panel:
+    - cross_section(date): the rows of one date, a contiguous slice of the file
+    - history(permno, start_date, end_date): the rows of one permno, in date order
+    - asof(date, permnos): the last row on or before date of each permno
+    dates and permnos are located by binary search on the stored indexes (built here if the checkpoint predates them),
+    and `columns` restricts the columns read from the memory-mapped file'''
+
+    def __init__(self, checkpoint_dir, manifest=None, table_name='sp500_used'):
+        manifest = manifest or read_checkpoint_manifest(checkpoint_dir)
+        if manifest is None or f'{table_name}_offsets' not in manifest['tables'] or manifest['tables'][table_name]['kind'] != 'arrow':
+            raise ValueError(f'{checkpoint_dir} has no date-sorted columnar {table_name}, run convert_checkpoint / resplit_checkpoint first')
+        self.entry = manifest['tables'][table_name]
+        self.table = feather.read_table(os.path.join(checkpoint_dir, self.entry['file']), memory_map=True)
+        offsets = load_checkpoint_table(checkpoint_dir, f'{table_name}_offsets', manifest=manifest)
+        self.dates = offsets['date'].to_numpy()
+        self.date_bounds = np.r_[offsets['start'].to_numpy(), len(self.table)].astype(np.int64)
+        if all(x in manifest['tables'] for x in PERMNO_INDEX_TABLES):
+            permno_offsets, rows = [load_checkpoint_table(checkpoint_dir, x, manifest=manifest) for x in PERMNO_INDEX_TABLES]
         else:
-            return False 
-        
-    def retrieve_data(self, checkpoint_name):
-        if self.check_checkpoint(checkpoint_name):
-            with open(f'./{checkpoint_name}/data_useful_info_dic.pkl','rb') as f:
-                data_useful_info_dic = pickle.load(f)
-            with open(f'./{checkpoint_name}/sp500_used.pkl','rb') as f:
-                sp500_used = pickle.load(f)
-            # Data at mkt level
-            with open(f'./{checkpoint_name}/mkt_daily.pkl','rb') as f:
-                mkt_daily = pickle.load(f)
-
-            # train/test split data
-            with open(f'./{checkpoint_name}/train_sp500.pkl','rb') as f:
-                train_sp500 = pickle.load(f)
-
-            with open(f'./{checkpoint_name}/test_sp500.pkl','rb') as f:
-                test_sp500 = pickle.load(f)
-
-            with open(f'./{checkpoint_name}/train_mkt.pkl','rb') as f:
-                train_mkt = pickle.load(f)
-            
-            with open(f'./{checkpoint_name}/test_mkt.pkl','rb') as f:
-                test_mkt = pickle.load(f)
-            
-            with open(f'./{checkpoint_name}/ticker_permno_dic.pkl','rb') as f:
-                ticker_permno_dic = pickle.load(f)
-            
-            with open(f'./{checkpoint_name}/permno_ticker_dic.pkl','rb') as f:
-                permno_ticker_dic = pickle.load(f)
-
-            self.data_dic= {'data_useful_info_dic': data_useful_info_dic,
-                    'sp500_used': sp500_used,
-                    'mkt_daily':mkt_daily,
-                    'train_sp500': train_sp500,
-                    'test_sp500': test_sp500,
-                    'train_mkt': train_mkt,
-                    'test_mkt': test_mkt,
-                    'ticker_permno_dic': ticker_permno_dic,
-                    'permno_ticker_dic': permno_ticker_dic}
-        
+            permno_offsets, rows = permno_index(self.table.column('permno').to_numpy())
+        self.permnos = permno_offsets['permno'].to_numpy()
+        self.permno_bounds = np.r_[permno_offsets['start'].to_numpy(), len(self.table)].astype(np.int64)
+        self.rows = rows['row'].to_numpy()
+        # (permno position, date position) of the rows in permno order, as one sortable key
+        date_position = np.repeat(np.arange(len(self.dates), dtype=np.int64), np.diff(self.date_bounds))
+        permno_position = np.repeat(np.arange(len(self.permnos), dtype=np.int64), np.diff(self.permno_bounds))
+        self.keys = permno_position * len(self.dates) + date_position[self.rows]
+
+    def __repr__(self):
+        return f'PanelQuery({len(self.table)} rows, {len(self.dates)} dates, {len(self.permnos)} permnos)'
+
+    def _date_position(self, date, side='right'):
+        '''number of trading dates on or before date (side='right') / before date (side='left')'''
+        return int(np.searchsorted(self.dates, np.datetime64(pd.Timestamp(date)), side=side))
+
+    def _to_pandas(self, table, columns):
+        if columns is not None:
+            table = table.select(list(columns) + [x for x in self.entry['index_columns'] if x not in columns])
+        return table.to_pandas(split_blocks=True)
+
+    def cross_section(self, date, columns=None):
+        '''rows dated exactly date (empty if it is not a trading date)'''
+        first, last = self._date_position(date, side='left'), self._date_position(date)
+        start, stop = self.date_bounds[first], self.date_bounds[last]
+        return self._to_pandas(self.table.slice(start, stop - start), columns)
+
+    def history(self, permno, start_date=None, end_date=None, columns=None):
+        '''rows of permno dated in [start_date, end_date], in date order'''
+        i = int(np.searchsorted(self.permnos, permno))
+        if i == len(self.permnos) or self.permnos[i] != permno:
+            return self._to_pandas(self.table.slice(0, 0), columns)
+        first = i*len(self.dates) + (0 if start_date is None else self._date_position(start_date, side='left'))
+        last = i*len(self.dates) + (len(self.dates) if end_date is None else self._date_position(end_date))
+        start, stop = np.searchsorted(self.keys, [first, last])
+        return self._to_pandas(self.table.take(self.rows[start:stop]), columns)
+
+    def asof(self, date, permnos=None, columns=None):
+        '''the last row on or before date of each of permnos (all permnos of the panel if None), in permno order; 
+        permnos without a row by then are left out'''
+        if permnos is None:
+            i = np.arange(len(self.permnos))
         else:
-            self.prepare_data(self.start_date, checkpoint_name)
-            self.checkpoint_name = checkpoint_name
+            i = np.searchsorted(self.permnos, np.unique(permnos))
+            i = i[i < len(self.permnos)]
+            i = i[np.isin(self.permnos[i], permnos)]
+        position = np.searchsorted(self.keys, i*len(self.dates) + self._date_position(date), side='left') - 1
+        found = position >= self.permno_bounds[i]
+        return self._to_pandas(self.table.take(self.rows[position[found]]), columns)
 
-            with open(f'./{checkpoint_name}/data_useful_info_dic.pkl','rb') as f:
-                data_useful_info_dic = pickle.load(f)
-            with open(f'./{checkpoint_name}/sp500_used.pkl','rb') as f:
-                sp500_used = pickle.load(f)
-            # Data at mkt level
-            with open(f'./{checkpoint_name}/mkt_daily.pkl','rb') as f:
-                mkt_daily = pickle.load(f)
-
-            # train/test split data
-            with open(f'./{checkpoint_name}/train_sp500.pkl','rb') as f:
-                train_sp500 = pickle.load(f)
-
-            with open(f'./{checkpoint_name}/test_sp500.pkl','rb') as f:
-                test_sp500 = pickle.load(f)
-
-            with open(f'./{checkpoint_name}/train_mkt.pkl','rb') as f:
-                train_mkt = pickle.load(f)
-            
-            with open(f'./{checkpoint_name}/test_mkt.pkl','rb') as f:
-                test_mkt = pickle.load(f)
-
-            with open(f'./{checkpoint_name}/ticker_permno_dic.pkl','rb') as f:
-                ticker_permno_dic = pickle.load(f)
-            
-            with open(f'./{checkpoint_name}/permno_ticker_dic.pkl','rb') as f:
-                permno_ticker_dic = pickle.load(f)
-
-            self.data_dic= {'data_useful_info_dic': data_useful_info_dic,
-                    'sp500_used': sp500_used,
-                    'mkt_daily':mkt_daily,
-                    'train_sp500': train_sp500,
-                    'test_sp500': test_sp500,
-                    'train_mkt': train_mkt,
-                    'test_mkt': test_mkt,
-                    'ticker_permno_dic': ticker_permno_dic,
-                    'permno_ticker_dic': permno_ticker_dic}
+# %% [markdown]
+# ### Compact panel schema
+# - sp500_used is kept with compact dtypes: returns, characteristics and daily metrics as float32 (about 7 significant digits), names and identifiers as categoricals (dictionary-encoded in the Arrow files) and permno as int32
+# - volume stays float64, daily share volumes go beyond the integers float32 holds exactly
+# - the schema is applied as soon as sp500_used is formed, so the rolling metrics and the cleaning see the same values in a full build and in an incremental refresh
 
+# %%
+PANEL_DTYPES = {'permno': 'int32',
+                'company_name': 'category',
+                'ncusip': 'category',
+                'ticker': 'category',
+                'gvkey': 'category',
+                'industry_code': 'category',
+                'volume': 'float64'}
+PANEL_FLOAT_DTYPE = 'float32'
+
+def to_plain_float(df):
+    '''nullable Float64 columns (as WRDS returns them) to numpy float64, in one astype'''
+    casts = {col: 'float64' for col, dtype in df.dtypes.items() if dtype == 'Float64'}
+    return df.astype(casts) if casts else df
+
+def compact_panel(df, dtypes=PANEL_DTYPES, float_dtype=PANEL_FLOAT_DTYPE):
+    '''cast the columns named in dtypes, and every other float64 column to float_dtype, in one astype'''
+    casts = {col: dtype for col, dtype in dtypes.items() if col in df.columns}
+    casts.update({col: float_dtype for col, dtype in df.dtypes.items() if col not in casts and dtype == 'float64'})
+    casts = {col: dtype for col, dtype in casts.items() if df[col].dtype != dtype}
+    return df.astype(casts) if casts else df
+
+def memory_mb(df):
+    return df.memory_usage(deep=True).sum() / 2**20
 
-    def prepare_data(self, start_date, checkpoint_name):
-        '''establish connection'''
-        wrds_db = wrds.Connection()
+# %% [markdown]
+# ### Checkpoint cache
+# - a checkpoint records the parameters it was built with (`build` in the manifest) and a key: the hash of those parameters and of `PIPELINE_VERSION`
+# - `Data_NN.retrieve_data()` without a checkpoint name looks the key up in a cache folder; a hit is reused, a miss is built
+# - the train/test boundary is not part of the key: a cached panel with another `train_end_date` is re-split in place instead of rebuilt. Readers of the cache split it at their own `train_end_date` (views and permno-ticker maps in `LazyDataDic`), so a re-split for another date does not change what a running reader sees
+# - the cache keeps the least recently used checkpoints only up to a count and / or size limit
+# - a process reading a checkpoint pins it (a marker in its `_readers` folder, see `pin_checkpoint`); eviction skips pinned checkpoints of running processes and checkpoints whose lock is held (being built, refreshed or re-split), and takes the lock itself while it removes one
 
-        '''Downloading the JKP data (Firm Characteristic Data) from WRDS'''
-        print ('Downloading the JKP data (Firm Characteristic Data) from WRDS...')
-        #IN: second version where the first five factors are based on paper
-        char_chosen =['market_equity','be_me','at_gr1','ope_be','ret_12_1', # FF-5-factor
-                    'ret_6_1','ret_3_1', # other mmt
-                    'ret_60_12', 'ret_1_0'] # reversal
+# %%
+# bump when a change to the build code changes the stored tables, so cached checkpoints of the old code are not reused
+PIPELINE_VERSION = 2
+CHECKPOINT_LAST_USED = 'last_used'
+CHECKPOINT_READERS = '_readers'
+
+def checkpoint_key(build_params):
+    '''short content hash of the build parameters (plus PIPELINE_VERSION), used as the cached checkpoint's name'''
+    payload = json.dumps({**build_params, 'pipeline_version': PIPELINE_VERSION}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+def touch_checkpoint(checkpoint_dir):
+    '''mark a checkpoint as used now (for the LRU eviction)'''
+    path = os.path.join(checkpoint_dir, CHECKPOINT_LAST_USED)
+    with open(path, 'a'):
+        pass
+    os.utime(path)
+
+def pin_checkpoint(checkpoint_dir, owner=None):
+    '''mark a checkpoint as read by this process, so evict_checkpoints leaves it alone until unpin_checkpoint, until
+    owner (if given) is garbage collected or until the process ends; returns the marker to pass to unpin_checkpoint'''
+    readers_dir = os.path.join(checkpoint_dir, CHECKPOINT_READERS)
+    os.makedirs(readers_dir, exist_ok=True)
+    marker = os.path.join(readers_dir, f'{os.getpid()}-{threading.get_ident()}-{time.time_ns()}')
+    with open(marker, 'w') as f:
+        json.dump({'pid': os.getpid(), 'host': socket.gethostname()}, f)
+    if owner is not None:
+        weakref.finalize(owner, unpin_checkpoint, marker)
+    return marker
+
+def unpin_checkpoint(marker):
+    if marker is not None:
+        try:
+            os.remove(marker)
+        except FileNotFoundError:
+            pass
+
+def checkpoint_pinned(checkpoint_dir):
+    '''whether a running process has pinned the checkpoint; markers of processes that are gone are removed'''
+    readers_dir = os.path.join(checkpoint_dir, CHECKPOINT_READERS)
+    pinned = False
+    for name in (os.listdir(readers_dir) if os.path.isdir(readers_dir) else []):
+        marker = os.path.join(readers_dir, name)
+        try:
+            with open(marker) as f:
+                reader = json.load(f)
+        except (OSError, ValueError):
+            # being written, or left half written (then stale after a while, like a lock)
+            try:
+                gone = time.time() - os.path.getmtime(marker) > CHECKPOINT_LOCK_STALE_AGE
+            except OSError:
+                continue
+        else:
+            gone = _process_is_gone(reader)
+        if gone:
+            unpin_checkpoint(marker)
+        else:
+            pinned = True
+    return pinned
+
+def checkpoint_bytes(checkpoint_dir):
+    return sum(os.path.getsize(os.path.join(root, x)) for root, _, files in os.walk(checkpoint_dir) for x in files)
+
+def evict_checkpoints(cache_dir, max_checkpoints=None, max_bytes=None, keep=()):
+    '''remove the least recently used checkpoints of cache_dir until at most max_checkpoints are left and they take
+    at most max_bytes; checkpoints named in keep, pinned by a running process or locked by another one are never 
+    removed. Returns the removed names'''
+    cached = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if not os.path.isdir(path) or name.endswith('.building') or '.old-' in name:
+            continue
+        stamp = os.path.join(path, CHECKPOINT_LAST_USED)
+        cached.append((os.path.getmtime(stamp if os.path.exists(stamp) else path), name, checkpoint_bytes(path)))
+
+    count, total = len(cached), sum(x[2] for x in cached)
+    removed = []
+    for _, name, size in sorted(cached):
+        if not ((max_checkpoints is not None and count > max_checkpoints) or (max_bytes is not None and total > max_bytes)):
+            break
+        if name in keep:
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            with checkpoint_lock(path, timeout=0):
+                if checkpoint_pinned(path):
+                    continue
+                shutil.rmtree(path)
+        except TimeoutError:
+            # being built or changed by another process
+            continue
+        print(f'Evicted checkpoint {name} from {cache_dir}')
+        removed.append(name)
+        count, total = count - 1, total - size
+    return removed
+
+# %% [markdown]
+# ### Remote checkpoints
+# - a checkpoint can also be read from an fsspec URL (`s3://bucket/checkpoints/data_checkpoint1`, `gcs://...`, `memory://...`, `file://...`; the protocol's fsspec package, e.g. `s3fs`, has to be installed)
+# - `RemoteCheckpoint` mirrors the files it needs into a local disk cache: the tables (every partition file of a partitioned table) are fetched concurrently with asyncio, a bounded number at a time, and the local copies are memory-mapped as usual
+# - only the manifest (or, for a pickle checkpoint, the file listing) is read on every open; it identifies the version of the remote checkpoint, so repeated runs read the cached files and a refreshed checkpoint is fetched again under a new version
+# - the cache holds one folder per checkpoint version and is kept under a byte limit by evicting the least recently used versions (`evict_checkpoints`); a `RemoteCheckpoint` pins its folder until it is closed and fetches under the folder's lock, so versions other processes have open or are fetching are not evicted
+# - `Data_NN` methods on a checkpoint URL (`query`, `panel_tensor`, `identifier_index`, `serve_checkpoint`, `plot_profile`) fetch only the tables they read; `checkpoint_path` is the local mirror and fetches nothing
+# - the local mirror is a read cache: changes to it are not written back
+
+# %%
+REMOTE_CACHE_DIR = 'remote_checkpoint_cache'
+REMOTE_CACHE_BYTES = 20 * 2**30
+PANEL_TENSOR_FILES = ['values.npy', 'mask.npy', 'dates.npy', 'permnos.npy']
+
+def is_remote_checkpoint(checkpoint_name):
+    return '://' in str(checkpoint_name)
+
+def _run_async(coroutine):
+    '''run a coroutine to the end, also from a notebook (where an event loop is already running) by using a helper thread'''
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        return pool.submit(asyncio.run, coroutine).result()
+
+class RemoteCheckpoint:
+    '''local disk cache of a checkpoint stored under an fsspec URL. fetch(table_names) copies the files of those tables
+    (all of them by default) to local_dir and returns it, so local_dir can be read as a checkpoint folder.
+    local_dir is pinned (see pin_checkpoint) until close'''
+
+    def __init__(self, url, cache_dir=REMOTE_CACHE_DIR, max_cache_bytes=REMOTE_CACHE_BYTES, max_concurrency=8,
+                 storage_options=None):
+        self.url = url.rstrip('/')
+        self.fs, self.root = fsspec.core.url_to_fs(self.url, **(storage_options or {}))
+        self.cache_dir = cache_dir
+        self.max_cache_bytes = max_cache_bytes
+        self.max_concurrency = max_concurrency
+        try:
+            manifest_bytes = self.fs.cat_file(f'{self.root}/{CHECKPOINT_MANIFEST}')
+            self.manifest = json.loads(manifest_bytes)
+            version = manifest_bytes
+        except FileNotFoundError:
+            # pickle checkpoint: its version is the file listing
+            self.manifest = None
+            listing = sorted((os.path.basename(x['name']), x['size'], *[str(x[k]) for k in ['mtime', 'created', 'LastModified', 'ETag'] if k in x])
+                             for x in self.fs.ls(self.root, detail=True) if x['type'] == 'file')
+            if not listing:
+                raise FileNotFoundError(f'no checkpoint at {url}')
+            self.pickles = [x[0] for x in listing if x[0].endswith('.pkl')]
+            version = json.dumps(listing).encode()
+        self.name = hashlib.sha256(self.url.encode()).hexdigest()[:12] + '-' + hashlib.sha256(version).hexdigest()[:12]
+        self.local_dir = os.path.join(cache_dir, self.name)
+        with checkpoint_lock(self.local_dir):
+            os.makedirs(self.local_dir, exist_ok=True)
+            self.pin = pin_checkpoint(self.local_dir, owner=self)
+            if self.manifest is not None:
+                with open(os.path.join(self.local_dir, CHECKPOINT_MANIFEST), 'wb') as f:
+                    f.write(manifest_bytes)
+
+    def table_files(self, table_name):
+        '''files of one table (views resolve to the table they are cut from); [] for a table the checkpoint does not have'''
+        if self.manifest is None:
+            return [f'{table_name}.pkl'] if f'{table_name}.pkl' in self.pickles else []
+        view = self.manifest.get('splits', {}).get('views', {}).get(table_name)
+        entry = self.manifest.get('tables', {}).get(view['table'] if view else table_name)
+        if entry is None:
+            return []
+        return entry['files'] if entry['kind'] == 'arrow_partitioned' else [entry['file']]
+
+    def fetch(self, table_names=None, tensor=None):
+        '''make the files of table_names (default: every table) local, fetching the missing ones concurrently;
+        tensor: also fetch the panel tensor (default: when all tables are fetched). Returns local_dir'''
+        if table_names is None:
+            table_names = list(self.manifest['tables']) if self.manifest is not None else [x[:-4] for x in self.pickles]
+            tensor = True if tensor is None else tensor
+        files = list(dict.fromkeys(x for table_name in table_names for x in self.table_files(table_name)))
+        if tensor and self.manifest is not None and 'tensor' in self.manifest:
+            files += [f"{self.manifest['tensor']['dir']}/{x}" for x in PANEL_TENSOR_FILES]
+        with checkpoint_lock(self.local_dir):
+            missing = [x for x in files if not os.path.exists(os.path.join(self.local_dir, x))]
+            if missing:
+                start = time.perf_counter()
+                _run_async(self._fetch_files(missing))
+                print (f'Fetched {len(missing)} file(s) of {self.url} in {time.perf_counter() - start:.1f}s')
+            touch_checkpoint(self.local_dir)
+        evict_checkpoints(self.cache_dir, max_bytes=self.max_cache_bytes, keep=[self.name])
+        return self.local_dir
+
+    def close(self):
+        '''unpin local_dir, so it can be evicted (also done when the RemoteCheckpoint is garbage collected)'''
+        unpin_checkpoint(self.pin)
+        self.pin = None
+
+    async def _fetch_files(self, file_names):
+        # the fsspec calls block (async filesystems such as s3fs run them on their own IO loop), so each one runs in 
+        # a thread of a pool of max_concurrency, which also bounds how many are in flight
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as pool:
+            await asyncio.gather(*[loop.run_in_executor(pool, self._fetch_file, x) for x in file_names])
+
+    def _fetch_file(self, file_name):
+        local_path = os.path.join(self.local_dir, file_name)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        # downloaded next to the file and renamed, so a reader never maps a partial file
+        part_path = f'{local_path}.part-{os.getpid()}-{threading.get_ident()}'
+        self.fs.get_file(f'{self.root}/{file_name}', part_path)
+        os.replace(part_path, local_path)
+
+# %% [markdown]
+# ### Parallel per-permno kernels
+# - the per-security steps (characteristic forward fill, rolling windows, outlier forward fill) run on rows sorted by permno and never combine rows of different permnos
+# - with `n_jobs > 1` the sorted rows are cut into `n_jobs` shards at permno boundaries. The input arrays are copied once into shared memory; each worker process runs the same kernel on its shard and writes its rows of shared output arrays, so no DataFrame is pickled
+# - every permno is computed by the same code on the same values as in the serial path, so the results are bit-identical and come back in the original row order
+# - scaling: the kernels are vectorized numpy and mostly memory-bandwidth bound, so the speed-up grows with the number of physical cores until the memory bandwidth is saturated (usually well below the core count of a large build machine); hyper-threads add little. The fixed costs are starting the worker processes (once, the pool is reused) and copying inputs and outputs through shared memory, so inputs below `PARALLEL_MIN_ROWS` rows stay serial
+# - the workers import this module, so with the spawn start method (Windows, macOS) it has to be imported from a file rather than run as a notebook
+
+# %%
+PARALLEL_MIN_ROWS = 500000
+_PROCESS_POOLS = {}
+
+def _resolve_n_jobs(n_jobs):
+    '''number of worker processes for n_jobs as in joblib (None = 1, -1 = all cores, -2 = all but one, ...)'''
+    if n_jobs is None:
+        return 1
+    if n_jobs < 0:
+        return max(1, (os.cpu_count() or 1) + 1 + n_jobs)
+    return max(1, n_jobs)
+
+def _process_pool(n_workers):
+    if n_workers not in _PROCESS_POOLS:
+        _PROCESS_POOLS[n_workers] = ProcessPoolExecutor(max_workers=n_workers)
+    return _PROCESS_POOLS[n_workers]
+
+def _shard_bounds(new_group, n_shards):
+    '''row bounds cutting group-sorted rows into at most n_shards pieces of similar size, only at group starts'''
+    starts = np.flatnonzero(new_group)
+    targets = np.arange(1, n_shards) * len(new_group) / n_shards
+    cuts = starts[np.minimum(np.searchsorted(starts, targets), len(starts) - 1)]
+    return np.unique(np.concatenate([[0], cuts, [len(new_group)]]))
+
+def _shared_array(shape, dtype, blocks):
+    '''new array in a shared memory block (appended to blocks); returns the array and its (block name, shape, dtype) spec'''
+    dtype = np.dtype(dtype)
+    block = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+    blocks.append(block)
+    return np.ndarray(shape, dtype=dtype, buffer=block.buf), (block.name, shape, dtype.str)
+
+def _shard_worker(kernel, in_specs, out_specs, lo, hi, kwargs):
+    '''run kernel on rows [lo, hi) of the shared input arrays and write its results to the shared output arrays'''
+    blocks = {name: shared_memory.SharedMemory(name=spec[0]) for name, spec in {**in_specs, **out_specs}.items()}
+    try:
+        arrays = {name: np.ndarray(spec[1], dtype=spec[2], buffer=blocks[name].buf) for name, spec in {**in_specs, **out_specs}.items()}
+        results = kernel(**{name: arrays[name][lo:hi] for name in in_specs}, **kwargs)
+        for name, result in results.items():
+            arrays[name][lo:hi] = result
+        del arrays, results
+    finally:
+        for block in blocks.values():
+            block.close()
+
+def run_by_group(kernel, inputs, new_group, outputs, n_jobs=1, **kwargs):
+    '''run kernel(new_group=..., **inputs, **kwargs) -> {name: array} over rows sorted by group; the kernel must only 
+    combine rows of the same group. inputs: {name: numeric array, one row per row}; outputs: {name: (shape, dtype)}.
+    With n_jobs > 1 the rows are split into shards at group starts and run on a process pool through shared memory'''
+    n_workers = _resolve_n_jobs(n_jobs)
+    if n_workers == 1 or len(new_group) < PARALLEL_MIN_ROWS:
+        return kernel(new_group=new_group, **inputs, **kwargs)
+
+    bounds = _shard_bounds(new_group, n_workers)
+    blocks, in_specs, out_specs, results = [], {}, {}, {}
+    try:
+        for name, arr in {'new_group': new_group, **inputs}.items():
+            shared, in_specs[name] = _shared_array(arr.shape, arr.dtype, blocks)
+            shared[...] = arr
+        for name, (shape, dtype) in outputs.items():
+            results[name], out_specs[name] = _shared_array(shape, dtype, blocks)
+        pool = _process_pool(n_workers)
+        futures = [pool.submit(_shard_worker, kernel, in_specs, out_specs, lo, hi, kwargs) for lo, hi in zip(bounds[:-1], bounds[1:])]
+        for future in futures:
+            future.result()
+        return {name: result.copy() for name, result in results.items()}
+    finally:
+        # the views on the blocks have to go before the blocks can be closed
+        results = shared = None
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+def _ffill_kernel(values, new_group):
+    row = np.arange(len(values))
+    filled = np.empty_like(values)
+    for j in range(values.shape[1]):
+        source = np.maximum.accumulate(np.where(new_group | ~np.isnan(values[:, j]), row, 0))
+        filled[:, j] = values[source, j]
+    return {'filled': filled}
+
+def group_ffill(values, new_group, n_jobs=1):
+    '''forward fill NaN down each column of values (rows sorted by group) without crossing into the next group,
+    same as groupby(...).ffill()'''
+    values = np.asarray(values, dtype=float)
+    one_column = values.ndim == 1
+    values = values.reshape(len(values), -1)
+    filled = run_by_group(_ffill_kernel, {'values': values}, new_group, {'filled': (values.shape, values.dtype)}, n_jobs)['filled']
+    return filled[:, 0] if one_column else filled
+
+# %% [markdown]
+# ### Atomic builds and shared checkpoints
+# - a checkpoint is always built (or refreshed) in a `<name>.building` folder and renamed into place when complete, so a reader never sees a half-written checkpoint. An existing checkpoint is moved aside first and removed after; processes that still have its files memory-mapped keep reading the old data
+# - builds and changes hold the lock file `<name>.lock` (created exclusively); a second process that wants the same checkpoint waits for the lock, finds the finished checkpoint and reads it instead of building it again. A lock left behind by a process that no longer runs on this machine is taken over (on Windows stale lock files have to be deleted by hand). The owner (pid, host) is in the lock file from the moment it exists; a lock file that cannot be read and is older than `CHECKPOINT_LOCK_STALE_AGE` seconds is taken over as well
+# - `CheckpointServer` loads the tables of a checkpoint once and copies every column into a shared memory block; its `descriptor` (block names, dtypes, categories: a small picklable dict) is what is passed to the worker processes
+# - `attach_checkpoint(descriptor)` rebuilds the DataFrames in a worker on top of those blocks, read-only and without copying, so N workers need one copy of the data plus their own results
+# - string / categorical columns are shared as integer codes with the categories in the descriptor; dicts and other small objects travel in the descriptor itself, and the train / test tables are re-cut in the worker as views of the shared sp500_used / mkt_daily
+# - the server owns the blocks and unlinks them on close(); workers only detach
+
+# %%
+CHECKPOINT_LOCK_POLL = 1.0
+CHECKPOINT_LOCK_STALE_AGE = 60
+SHARED_TABLES = ['sp500_used', 'mkt_daily', 'data_useful_info_dic', 'ticker_permno_dic', 'permno_ticker_dic']
+_HELD_LOCKS = set()
+
+def _lock_is_stale(lock_path):
+    '''the lock was taken by a process that is gone (see _process_is_gone), or its owner cannot be read and it is 
+    older than CHECKPOINT_LOCK_STALE_AGE'''
+    try:
+        with open(lock_path) as f:
+            holder = json.load(f)
+    except OSError:
+        # gone already
+        return False
+    except ValueError:
+        # empty or cut short: left by a process that died while creating it (on a file system without hard links)
+        try:
+            return time.time() - os.path.getmtime(lock_path) > CHECKPOINT_LOCK_STALE_AGE
+        except OSError:
+            return False
+    return _process_is_gone(holder)
+
+def _process_is_gone(holder):
+    '''whether the process of holder ({'pid', 'host'}) is known to have ended: only checked for this machine on posix,
+    where os.kill(pid, 0) tests for a process without touching it'''
+    if os.name != 'posix' or holder.get('host') != socket.gethostname():
+        return False
+    try:
+        os.kill(holder['pid'], 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+def _create_lock(lock_path):
+    '''create lock_path with its owner already in it (FileExistsError if it exists): the owner is written to a private 
+    file which is then hard-linked to lock_path, so the lock file is never seen empty'''
+    owner = json.dumps({'pid': os.getpid(), 'host': socket.gethostname(), 'since': datetime.now().isoformat()})
+    owner_path = f'{lock_path}.{os.getpid()}-{threading.get_ident()}'
+    with open(owner_path, 'w') as f:
+        f.write(owner)
+    try:
+        os.link(owner_path, lock_path)
+        return
+    except FileExistsError:
+        raise
+    except OSError:
+        # no hard links on this file system: create exclusively and write
+        pass
+    finally:
+        os.remove(owner_path)
+    fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    with os.fdopen(fd, 'w') as f:
+        f.write(owner)
+
+@contextmanager
+def checkpoint_lock(checkpoint_dir, timeout=None, poll=CHECKPOINT_LOCK_POLL):
+    '''hold <checkpoint_dir>.lock while a checkpoint is built or changed; waits (up to timeout seconds) while another 
+    process holds it. Re-entrant within a thread, so a locked step can call other locked steps'''
+    lock_path = os.path.abspath(os.path.normpath(checkpoint_dir)) + '.lock'
+    key = (lock_path, threading.get_ident())
+    if key in _HELD_LOCKS:
+        yield
+        return
+    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    started, waiting = time.time(), False
+    while True:
+        try:
+            _create_lock(lock_path)
+            break
+        except FileExistsError:
+            if _lock_is_stale(lock_path):
+                print(f'Removing the stale lock {lock_path}')
+                try:
+                    os.remove(lock_path)
+                except FileNotFoundError:
+                    pass
+                continue
+            if timeout is not None and time.time() - started > timeout:
+                raise TimeoutError(f'{checkpoint_dir} is locked by another process ({lock_path})')
+            if not waiting:
+                print(f'Waiting for another process to finish with {checkpoint_dir}..')
+                waiting = True
+            time.sleep(poll)
+    _HELD_LOCKS.add(key)
+    try:
+        yield
+    finally:
+        _HELD_LOCKS.discard(key)
+        os.remove(lock_path)
+
+def publish_checkpoint(build_dir, checkpoint_dir):
+    '''move a complete build into place by renames; an existing checkpoint is moved aside first and removed after'''
+    old_dir = None
+    if os.path.exists(checkpoint_dir):
+        old_dir = f'{os.path.normpath(checkpoint_dir)}.old-{os.getpid()}'
+        shutil.rmtree(old_dir, ignore_errors=True)
+        os.rename(checkpoint_dir, old_dir)
+    os.rename(build_dir, checkpoint_dir)
+    if old_dir is not None:
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+def locked(method):
+    '''method decorator: run a method that builds or changes the checkpoint named by its checkpoint_name argument
+    under checkpoint_lock'''
+    signature = inspect.signature(method)
+    @functools.wraps(method)
+    def run(self, *args, **kwargs):
+        checkpoint_name = signature.bind(self, *args, **kwargs).arguments['checkpoint_name']
+        with checkpoint_lock(self.checkpoint_path(checkpoint_name)):
+            return method(self, *args, **kwargs)
+    return run
+
+def _attach_block(name):
+    '''open an existing shared memory block without registering it with this process' resource tracker, which would
+    unlink it (under the server) when the process exits'''
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # python < 3.13 has no track argument
+        register = resource_tracker.register
+        resource_tracker.register = lambda *args, **kwargs: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+class CheckpointServer:
+    '''the tables of a checkpoint in shared memory, for worker processes to attach to (see attach_checkpoint).
+    Pass `descriptor` to the workers and close the server (or use it as a context manager) once they are done.
+    The checkpoint is pinned (see pin_checkpoint) while it is served; train_end_date and remote as in LazyDataDic'''
+
+    def __init__(self, checkpoint_dir, table_names=SHARED_TABLES, train_end_date=None, remote=None):
+        self.blocks = []
+        self.pin = pin_checkpoint(checkpoint_dir, owner=self)
+        data_dic = LazyDataDic(checkpoint_dir, train_end_date=train_end_date, remote=remote)
+        self.descriptor = {'checkpoint_dir': os.path.abspath(checkpoint_dir), 'tables': {},
+                           'views': {x: view for x, view in data_dic.views.items() if view['table'] in table_names}}
+        try:
+            for table_name in table_names:
+                table = data_dic[table_name]
+                self.descriptor['tables'][table_name] = self._share_frame(table) if isinstance(table, pd.DataFrame) \
+                                                        else {'object': table}
+                data_dic.drop(table_name)
+        except BaseException:
+            self.close()
+            raise
+        print(f'Serving {checkpoint_dir} from shared memory ({self.nbytes() / 1e6:,.0f} MB)')
+
+    def _share_array(self, values):
+        shared, spec = _shared_array(values.shape, values.dtype, self.blocks)
+        shared[...] = values
+        return spec
+
+    def _share_column(self, values):
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            return {'codes': self._share_array(np.asarray(values.cat.codes)), 'dtype': values.dtype}
+        if values.dtype == object or isinstance(values.dtype, pd.StringDtype):
+            values = values.astype('category')
+            return {'codes': self._share_array(np.asarray(values.cat.codes)), 'dtype': values.dtype}
+        if isinstance(values.dtype, pd.api.extensions.ExtensionDtype):
+            # e.g. nullable integers: copied to each worker
+            return {'object': values}
+        return {'values': self._share_array(values.to_numpy())}
+
+    def _share_frame(self, df):
+        if isinstance(df.index, pd.RangeIndex):
+            index = {'range': (df.index.start, df.index.stop, df.index.step)}
+        else:
+            index = self._share_column(df.index.to_series())
+        return {'columns': [(x, self._share_column(df[x])) for x in df.columns], 'index': index, 'index_name': df.index.name}
+
+    def nbytes(self):
+        return sum(block.size for block in self.blocks)
+
+    def close(self):
+        '''free the shared memory; workers still attached keep their mapping until they close'''
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+        unpin_checkpoint(self.pin)
+        self.pin = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class SharedDataDic(dict):
+    '''the data_dic of a worker attached to a CheckpointServer: read-only DataFrames on the shared blocks'''
+
+    def __init__(self, descriptor):
+        super().__init__()
+        self.checkpoint_dir = descriptor['checkpoint_dir']
+        self.views = descriptor['views']
+        self._blocks = {}
+        for table_name, spec in descriptor['tables'].items():
+            self[table_name] = spec['object'] if 'object' in spec else self._frame(spec)
+        for view_name, view in self.views.items():
+            self[view_name] = self[view['table']].iloc[view['start']:view['stop']]
+
+    def _array(self, spec):
+        name, shape, dtype = spec
+        if name not in self._blocks:
+            self._blocks[name] = _attach_block(name)
+        values = np.ndarray(shape, dtype=dtype, buffer=self._blocks[name].buf)
+        values.flags.writeable = False
+        return values
+
+    def _column(self, spec):
+        if 'object' in spec:
+            return spec['object']
+        if 'codes' in spec:
+            return pd.Categorical.from_codes(self._array(spec['codes']), dtype=spec['dtype'], validate=False)
+        return self._array(spec['values'])
+
+    def _frame(self, spec):
+        if 'range' in spec['index']:
+            index = pd.RangeIndex(*spec['index']['range'], name=spec['index_name'])
+        else:
+            index = pd.Index(self._column(spec['index']), name=spec['index_name'], copy=False)
+        return pd.DataFrame({x: self._column(column) for x, column in spec['columns']}, index=index, copy=False)
+
+    def load(self, table_name, columns=None, start_date=None, end_date=None, cache=True):
+        '''column / date-range projection of a shared table (as LazyDataDic.load)'''
+        df = self[table_name]
+        if start_date is not None or end_date is not None:
+            dates = df['date'] if 'date' in df.columns else df.index.to_series()
+            df = df[dates.between(start_date or dates.min(), end_date or dates.max()).values]
+        return df if columns is None else df[list(columns)]
+
+    def close(self):
+        '''detach from the shared blocks; frames taken from this dict must be released first'''
+        self.clear()
+        for block in self._blocks.values():
+            try:
+                block.close()
+            except BufferError:
+                # still referenced by a frame held elsewhere: released with the process
+                pass
+        self._blocks = {}
+
+def attach_checkpoint(descriptor):
+    '''data_dic over the tables a CheckpointServer shares (its descriptor), without copying them'''
+    return SharedDataDic(descriptor)
+
+# %% [markdown]
+# ### Per-security rolling metrics
+# - the panel is sorted once by (permno, date); cumulative sums restart at every permno, so any window sum is `C[i] - C[i-n]`
+# - all windows and reducers are computed from the same cumulative arrays and written back in place (no groupby-apply, no merges)
+# - a window is only filled when all `n` observations are present, same as `rolling(n).sum()`
+
+# %%
+# window lengths (trading days) for the daily return metrics, named ret_{window}_d
+DAILY_METRIC_WINDOWS = {'12m': 21*12, '6m': 21*6, '3m': 21*3, '1m': 21}
+ROLLING_REDUCERS = ['sum', 'mean', 'std', 'compound']
+
+def _group_sort(df, group_col, date_col):
+    '''row order that sorts df by (group, date), and a flag marking the first row of each group in that order'''
+    groups = df[group_col].to_numpy()
+    dates = df[date_col].to_numpy()
+    if ((groups[1:] > groups[:-1]) | ((groups[1:] == groups[:-1]) & (dates[1:] >= dates[:-1]))).all():
+        order = np.arange(len(df))
+    else:
+        order = np.lexsort((dates, groups))
+    groups = groups[order]
+    new_group = np.ones(len(df), dtype=bool)
+    new_group[1:] = groups[1:] != groups[:-1]
+    return order, new_group
+
+def _group_cumsum(values, new_group):
+    '''cumulative sum that restarts at every group (each group only sees its own values)'''
+    return pd.Series(values).groupby(np.cumsum(new_group)).cumsum().to_numpy()
+
+def _rolling_names(windows, reducers, name_format):
+    return [name_format.format(window=label) + ('' if reducer == 'sum' else f'_{reducer}')
+            for label in windows for reducer in reducers]
+
+def _rolling_kernel(values, new_group, windows, reducers, name_format):
+    '''rolling window results for values sorted by group (in that order), NaN where the window is not full'''
+    valid = ~np.isnan(values)
+    values = np.where(valid, values, 0.0)
+
+    row = np.arange(len(values))
+    group_start = np.maximum.accumulate(np.where(new_group, row, 0))
+    pos_in_group = row - group_start
+
+    cum = {'count': _group_cumsum(valid.astype(np.int64), new_group),
+           'sum': _group_cumsum(values, new_group)}
+    if 'std' in reducers:
+        cum['sum_sq'] = _group_cumsum(values**2, new_group)
+    if 'compound' in reducers:
+        # a return of -1 (or below) wipes the position out: log1p would be -inf (or NaN) and carry on through the 
+        # cumulative sum, so such returns are counted instead and their windows compound to -1
+        total_loss = values <= -1
+        cum['loss'] = _group_cumsum(total_loss.astype(np.int64), new_group)
+        cum['log'] = _group_cumsum(np.log1p(np.where(total_loss, 0.0, values)), new_group)
+
+    def window_total(key, n):
+        lagged = np.where(pos_in_group >= n, cum[key][np.maximum(row - n, 0)], 0)
+        return cum[key] - lagged
+
+    out = {}
+    for label, n in windows.items():
+        full = (pos_in_group >= n - 1) & (window_total('count', n) == n)
+        total = window_total('sum', n)
+        results = {}
+        for reducer in reducers:
+            if reducer == 'sum':
+                results[name_format.format(window=label)] = total
+            elif reducer == 'mean':
+                results[f'{name_format.format(window=label)}_mean'] = total / n
+            elif reducer == 'std':
+                var = (window_total('sum_sq', n) - total**2 / n) / (n - 1) if n > 1 else np.full(len(total), np.nan)
+                results[f'{name_format.format(window=label)}_std'] = np.sqrt(np.maximum(var, 0))
+            elif reducer == 'compound':
+                results[f'{name_format.format(window=label)}_compound'] = np.where(window_total('loss', n) > 0, -1.0,
+                                                                                   np.expm1(window_total('log', n)))
+        for col, result in results.items():
+            out[col] = np.where(full, result, np.nan)
+    return out
+
+def rolling_group_metrics(df, windows=DAILY_METRIC_WINDOWS, value_col='return', group_col='permno', date_col='date',
+                          reducers=('sum',), name_format='ret_{window}_d', n_jobs=1):
+    '''add rolling window metrics of `value_col` per `group_col` to df in place, for every window in `windows`
+    ({label: n_rows}) and every reducer in `reducers` ('sum', 'mean', 'std', 'compound').
+    The 'sum' column is named name_format.format(window=label), the others get a _{reducer} suffix.
+    n_jobs: worker processes (see run_by_group). Returns the list of new column names'''
+    unknown = set(reducers) - set(ROLLING_REDUCERS)
+    if unknown:
+        raise ValueError(f'unknown reducers {unknown}, choose from {ROLLING_REDUCERS}')
+
+    order, new_group = _group_sort(df, group_col, date_col)
+    values = df[value_col].to_numpy(dtype=float)[order]
+    new_columns = _rolling_names(windows, reducers, name_format)
+    results = run_by_group(_rolling_kernel, {'values': values}, new_group,
+                           {col: ((len(values),), np.float64) for col in new_columns}, n_jobs,
+                           windows=windows, reducers=tuple(reducers), name_format=name_format)
+    for col in new_columns:
+        out = np.full(len(df), np.nan)
+        out[order] = results[col]
+        df[col] = out
+    return new_columns
+
+# %% [markdown]
+# ### Panel cleaning rules
+# - `cleaning_rules` maps numerical columns to a list of rules applied in order; the column is then forward filled per permno:
+#   - `{'rule': 'threshold', 'upper': x, 'lower': y}`: values above upper / below lower (either one optional) become NaN
+#   - `{'rule': 'winsorize', 'lower': 0.01, 'upper': 0.99}`: values are clipped to those quantiles of their date's cross-section
+#   - `{'rule': 'zscore', 'max_z': 5}`: values more than max_z standard deviations from their date's cross-sectional mean become NaN
+# - the cleaned columns are taken out as one array in (permno, date) order, cleaned there and written back to their columns: no merges, and the per-date statistics come from np.bincount and one sort by (date, value)
+# - the default is the original rule: opt_to_book_eq above `abnormal_threshold` is an outlier
+# - the per-date rules need the whole cross-section of a date, so the streaming build (one permno partition at a time) only takes threshold rules
+
+# %%
+CROSS_SECTIONAL_RULES = ['winsorize', 'zscore']
+
+def default_cleaning_rules(abnormal_threshold):
+    return {'opt_to_book_eq': [{'rule': 'threshold', 'upper': abnormal_threshold}]}
+
+def _threshold_rule(values, date_codes, n_dates, upper=None, lower=None):
+    outlier = np.zeros(len(values), dtype=bool)
+    if upper is not None:
+        outlier |= values > upper
+    if lower is not None:
+        outlier |= values < lower
+    values[outlier] = np.nan
+    return int(outlier.sum())
+
+def _date_quantiles(values, date_codes, n_dates, q):
+    '''quantile q (linear interpolation, as np.nanquantile) of the values of each date; NaN for a date without values'''
+    # NaN sorts last within a date, so the k values of a date are the first k of its block
+    sorted_values = values[np.lexsort((values, date_codes))]
+    starts = np.r_[0, np.cumsum(np.bincount(date_codes, minlength=n_dates))[:-1]]
+    counts = np.bincount(date_codes[~np.isnan(values)], minlength=n_dates)
+    position = q * (counts - 1)
+    below = np.floor(position).astype(np.int64)
+    above = np.ceil(position).astype(np.int64)
+    quantiles = np.full(n_dates, np.nan)
+    has = counts > 0
+    low, high = sorted_values[(starts + below)[has]], sorted_values[(starts + above)[has]]
+    quantiles[has] = low + (high - low) * (position - below)[has]
+    return quantiles
+
+def _winsorize_rule(values, date_codes, n_dates, lower=0.01, upper=0.99):
+    clipped = np.clip(values, _date_quantiles(values, date_codes, n_dates, lower)[date_codes],
+                      _date_quantiles(values, date_codes, n_dates, upper)[date_codes])
+    changed = int((clipped != values)[~np.isnan(values)].sum())
+    values[:] = clipped
+    return changed
+
+def _zscore_rule(values, date_codes, n_dates, max_z=5):
+    valid = ~np.isnan(values)
+    count = np.bincount(date_codes[valid], minlength=n_dates)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(date_codes[valid], values[valid], minlength=n_dates) / count
+        # sample standard deviation (ddof=1, as pandas std); dates with a single value have none and are left alone
+        std = np.sqrt(np.bincount(date_codes[valid], (values[valid] - mean[date_codes[valid]])**2, minlength=n_dates) / (count - 1))
+        outlier = np.abs(values - mean[date_codes]) > max_z * std[date_codes]
+    values[outlier] = np.nan
+    return int(outlier.sum())
+
+CLEANING_RULES = {'threshold': _threshold_rule, 'winsorize': _winsorize_rule, 'zscore': _zscore_rule}
+
+def clean_panel(df, cleaning_rules, group_col='permno', date_col='date', rows=None, ffill=True, n_jobs=1):
+    '''apply cleaning_rules ({column: [rule, ...]}, see above) to df in place, then forward fill the cleaned columns 
+    within each group (same as groupby(group_col).ffill()). rows: boolean mask of the rows the rules apply to (the 
+    others, e.g. already cleaned context rows of a refresh, only feed the forward fill). Returns the number of values 
+    each rule changed, as a frame (column, rule, changed)'''
+    columns = [x for x in cleaning_rules if x in df.columns]
+    for column in columns:
+        for rule in cleaning_rules[column]:
+            if rule['rule'] not in CLEANING_RULES:
+                raise ValueError(f"unknown cleaning rule {rule['rule']!r} for {column}, use one of {list(CLEANING_RULES)}")
+    order, new_group = _group_sort(df, group_col, date_col)
+    values = df[columns].to_numpy(dtype='float64')[order]
+    apply = np.ones(len(df), dtype=bool) if rows is None else np.asarray(rows)[order]
+    date_codes = np.unique(df[date_col].to_numpy()[order][apply], return_inverse=True)[1].ravel()
+    n_dates = int(date_codes.max()) + 1 if len(date_codes) else 0
+
+    log = []
+    for j, column in enumerate(columns):
+        cleaned = values[apply, j]
+        for rule in cleaning_rules[column]:
+            params = {k: v for k, v in rule.items() if k != 'rule'}
+            log.append({'column': column, 'rule': rule['rule'],
+                        'changed': CLEANING_RULES[rule['rule']](cleaned, date_codes, n_dates, **params)})
+        values[apply, j] = cleaned
+    if ffill and columns:
+        missing = np.isnan(values).sum(axis=0)
+        values = group_ffill(values, new_group, n_jobs)
+        log += [{'column': column, 'rule': 'ffill', 'changed': int(x)} 
+                for column, x in zip(columns, missing - np.isnan(values).sum(axis=0))]
+
+    restored = np.empty_like(values)
+    restored[order] = values
+    for j, column in enumerate(columns):
+        df[column] = restored[:, j]
+    return pd.DataFrame(log, columns=['column', 'rule', 'changed'])
+
+# %% [markdown]
+# ### Point-in-time joins
+# - monthly characteristics are attached to daily rows with an as-of join: each `(permno, date)` row gets the latest `eom` record on or before its date
+# - the msenames and CCM records are attached with an interval join: each `(permno, date)` row gets the record whose `[start, end]` window contains its date
+# - (permno, date) pairs are encoded into one sorted int64 key so the lookup is a `searchsorted`; no daily x permno grid and no permno-level cross product is built
+
+# %%
+def _to_days(dates):
+    return pd.to_datetime(dates).to_numpy().astype('datetime64[D]').astype(np.int64)
+
+def _group_date_keys(left_groups, left_days, right_groups, right_days):
+    '''encode (group, day) pairs of two tables into comparable int64 keys that sort by group, then day'''
+    codes, _ = pd.factorize(np.concatenate([np.asarray(left_groups), np.asarray(right_groups)]))
+    days = np.concatenate([left_days, right_days])
+    day_min = days.min() if len(days) else 0
+    span = (days.max() - day_min + 1) if len(days) else 1
+    keys = codes.astype(np.int64) * span + (days - day_min)
+    return keys[:len(left_days)], keys[len(left_days):], codes[:len(left_days)], codes[len(left_days):]
+
+def asof_join_characteristics(panel, char_data, char_columns, by='permno', on='date', char_on='eom',
+                              start_date=None, max_staleness=None, n_jobs=1):
+    '''attach to every row of `panel` the latest `char_data` record of the same `by` with char_on <= on.
+    Missing values are forward filled per column within each security first, so a gap falls back to the last 
+    reported value (same as the old reindex + groupby ffill on a daily grid).
+    start_date: records before this date are ignored (the old daily grid started at the first panel date)
+    max_staleness: optional limit (e.g. '93D') on how old the matched record may be; older matches are left empty
+    n_jobs: worker processes for the forward fill (see run_by_group)
+    Returns a copy of panel with a fresh RangeIndex and the columns [char_on] + char_columns added'''
+    chars = char_data[[by, char_on] + list(char_columns)].dropna(subset=[by])
+    char_days = _to_days(chars[char_on])
+    if start_date is not None:
+        keep = char_days >= _to_days([start_date])[0]
+        chars, char_days = chars[keep], char_days[keep]
+
+    panel_days = _to_days(panel[on])
+    panel_key, char_key, panel_code, char_code = _group_date_keys(panel[by].to_numpy(), panel_days,
+                                                                  chars[by].to_numpy(), char_days)
+    char_order = np.argsort(char_key, kind='stable')
+    chars = chars.iloc[char_order]
+    char_key, char_code, char_days = char_key[char_order], char_code[char_order], char_days[char_order]
+    char_new_group = np.ones(len(chars), dtype=bool)
+    char_new_group[1:] = char_code[1:] != char_code[:-1]
+    float_columns = [x for x in char_columns if chars[x].dtype.kind == 'f']
+    filled = chars.groupby(by, sort=False)[[x for x in char_columns if x not in float_columns]].ffill()
+    if float_columns:
+        filled_values = group_ffill(chars[float_columns].to_numpy(dtype=float), char_new_group, n_jobs)
+        for j, col in enumerate(float_columns):
+            filled[col] = filled_values[:, j]
+
+    pos = np.searchsorted(char_key, panel_key, side='right') - 1
+    matched = pos >= 0
+    matched[matched] = char_code[pos[matched]] == panel_code[matched]
+    if max_staleness is not None:
+        matched[matched] = (panel_days[matched] - char_days[pos[matched]]) <= pd.Timedelta(max_staleness).days
+    pos = np.where(matched, pos, 0)
+
+    joined = {}
+    for col in [char_on] + list(char_columns):
+        source = chars[col] if col == char_on else filled[col]
+        values = source.to_numpy()[pos] if len(source) else np.full(len(pos), np.nan)
+        if values.dtype.kind == 'f':
+            values[~matched] = np.nan
+        elif values.dtype.kind == 'M':
+            values[~matched] = np.datetime64('NaT')
+        else:
+            values = np.where(matched, values, None)
+        joined[col] = values
+    return pd.concat([panel.reset_index(drop=True), pd.DataFrame(joined)], axis=1)
+
+def interval_join(left, right, by='permno', on='date', start='namedt', end='nameendt'):
+    '''inner join of each `left` row with the `right` record of the same `by` whose [start, end] window contains 
+    left[on] (both ends inclusive); rows without such a record are dropped. When several windows contain the date
+    (e.g. overlapping CCM links) the record that comes first in `right` is used, the row the old 
+    merge-on-permno + date filter + drop_duplicates kept.
+    Records are sorted by (by, start); a row's candidates are found with searchsorted and walked backwards only 
+    while an earlier window can still reach its date, so memory stays at O(len(left) + len(right)).
+    Returns left's columns followed by right's (without `by`), with a fresh RangeIndex'''
+    right = right[right[by].notna() & right[start].notna() & right[end].notna()]
+    left_days = _to_days(left[on])
+    start_days, end_days = _to_days(right[start]), _to_days(right[end])
+    left_key, right_key, left_code, right_code = _group_date_keys(left[by].to_numpy(), left_days,
+                                                                  right[by].to_numpy(), start_days)
+    order = np.lexsort((np.arange(len(right)), right_key))
+    right_key, right_code, end_days = right_key[order], right_code[order], end_days[order]
+
+    # first record of each group and the running max of the window ends within the group (in start order)
+    new_group = np.ones(len(order), dtype=bool)
+    new_group[1:] = right_code[1:] != right_code[:-1]
+    group_first = np.maximum.accumulate(np.where(new_group, np.arange(len(order)), 0))
+    reach = pd.Series(end_days).groupby(np.cumsum(new_group)).cummax().to_numpy()
+
+    cand = np.searchsorted(right_key, left_key, side='right') - 1
+    best = np.full(len(left_key), len(right), dtype=np.int64)  # position in `right`, len(right) = no match
+    active = cand >= 0
+    active[active] = right_code[cand[active]] == left_code[active]
+    while active.any():
+        rows = np.flatnonzero(active)
+        k = cand[rows]
+        contains = end_days[k] >= left_days[rows]
+        best[rows[contains]] = np.minimum(best[rows[contains]], order[k[contains]])
+        more = (k > group_first[k]) & (reach[np.maximum(k - 1, 0)] >= left_days[rows])
+        cand[rows] = k - 1
+        active[rows] = more
+
+    matched = best < len(right)
+    right_columns = [x for x in right.columns if x != by]
+    return pd.concat([left.iloc[np.flatnonzero(matched)].reset_index(drop=True),
+                      right[right_columns].iloc[best[matched]].reset_index(drop=True)], axis=1)
+
+# %% [markdown]
+# ### Identifier index
+# - validity intervals of the tickers and ncusips of each permno (msenames `namedt` to `nameendt`) and of its gvkeys (CCM `linkdt` to `linkenddt`), as one table (id_type, value, start, end, permno) stored with the checkpoint as `identifier_index`
+# - `IdentifierIndex` keeps the intervals sorted by (identifier, start) and by (permno, start) as int64 keys, so "which permno was ticker X on date D" (and the reverse) is a searchsorted, for one query or a whole batch
+# - a reused ticker or a ticker change resolves to the security of that date; the ticker_permno_dic / permno_ticker_dic maps (still written, the notebooks read them) only hold the last pair seen in the train period
+# - an interval without an end date stays open; where intervals of one identifier overlap, the one that started last is used
+
+# %%
+IDENTIFIER_TYPES = {'ticker': ('msenames', 'namedt', 'nameendt'),
+                    'ncusip': ('msenames', 'namedt', 'nameendt'),
+                    'gvkey': ('ccm', 'linkdt', 'linkenddt')}
+
+def identifier_intervals(mse, ccm, permnos=None):
+    '''(id_type, value, start, end, permno) validity intervals of the msenames tickers / ncusips and the CCM gvkeys,
+    optionally only of `permnos`; end is NaT for an open interval'''
+    tables = {'msenames': mse, 'ccm': ccm}
+    frames = []
+    for id_type, (table_name, start, end) in IDENTIFIER_TYPES.items():
+        df = tables[table_name]
+        df = df[df['permno'].notna() & df[id_type].notna() & df[start].notna()]
+        if permnos is not None:
+            df = df[df['permno'].isin(permnos)]
+        frames.append(pd.DataFrame({'id_type': id_type,
+                                    'value': df[id_type].astype(str).str.strip().to_numpy(),
+                                    'start': pd.to_datetime(df[start]).to_numpy(),
+                                    'end': pd.to_datetime(df[end]).to_numpy(),
+                                    'permno': df['permno'].astype(np.int64).to_numpy()}))
+    intervals = pd.concat(frames, ignore_index=True).drop_duplicates()
+    intervals['id_type'] = intervals['id_type'].astype('category')
+    return intervals.sort_values(['id_type', 'value', 'start'], kind='stable').reset_index(drop=True)
+
+class _IntervalSearch:
+    '''intervals of keys sorted by (key, start) into int64 keys; find() gives for each (key, date) query the position 
+    of the interval of that key that contains the date and started last, or -1. As in interval_join, earlier intervals
+    are only visited while the running max of their ends can still reach the date'''
+
+    def __init__(self, keys, starts, ends):
+        keys = np.asarray(keys)
+        self.key_values = np.unique(keys)
+        codes = np.searchsorted(self.key_values, keys)
+        start_days = _to_days(starts)
+        self.day_min = int(start_days.min()) if len(start_days) else 0
+        self.day_max = int(start_days.max()) if len(start_days) else 0
+        # one spare day below day_min, so a query before every start falls into the previous key's block
+        self.span = self.day_max - self.day_min + 2
+        sort_keys = codes.astype(np.int64) * self.span + (start_days - self.day_min + 1)
+        self.order = np.argsort(sort_keys, kind='stable')
+        self.sort_keys = sort_keys[self.order]
+        self.codes = codes[self.order]
+        end_days = pd.to_datetime(pd.Series(ends)).to_numpy().astype('datetime64[D]')
+        self.end_days = np.where(np.isnat(end_days), np.iinfo(np.int64).max, end_days.astype(np.int64))[self.order]
+        new_key = np.r_[True, self.codes[1:] != self.codes[:-1]] if len(self.codes) else np.zeros(0, dtype=bool)
+        self.key_first = np.maximum.accumulate(np.where(new_key, np.arange(len(new_key)), 0))
+        self.reach = pd.Series(self.end_days).groupby(np.cumsum(new_key)).cummax().to_numpy()
+
+    def find(self, keys, dates):
+        keys = np.asarray(keys)
+        codes = np.minimum(np.searchsorted(self.key_values, keys), max(len(self.key_values) - 1, 0))
+        known = (self.key_values[codes] == keys) if len(self.key_values) else np.zeros(len(keys), dtype=bool)
+        days = _to_days(dates)
+        query = codes.astype(np.int64) * self.span + (np.clip(days, self.day_min - 1, self.day_max) - self.day_min + 1)
+        position = np.searchsorted(self.sort_keys, query, side='right') - 1
+        found = np.full(len(keys), -1, dtype=np.int64)
+        active = known & (position >= 0)
+        active[active] = self.codes[position[active]] == codes[active]
+        while active.any():
+            rows = np.flatnonzero(active)
+            k = position[rows]
+            contains = self.end_days[k] >= days[rows]
+            found[rows[contains]] = self.order[k[contains]]
+            more = ~contains & (k > self.key_first[k]) & (self.reach[np.maximum(k - 1, 0)] >= days[rows])
+            position[rows] = k - 1
+            active[rows] = more
+        return found
+
+class IdentifierIndex:
+    '''time-aware lookups between permnos and their tickers / ncusips / gvkeys (see identifier_intervals):
+    - permno(value, date, id_type) / permnos(values, dates, id_type): the permno an identifier belonged to on a date
+    - identifier(permno, date, id_type) / identifiers(permnos, dates, id_type): a permno's identifier on a date
+    the batch versions take arrays (or one date for all values) and are one vectorized binary search'''
+
+    def __init__(self, intervals):
+        self.intervals = intervals
+        self._by_value, self._by_permno = {}, {}
+        for id_type, df in intervals.groupby('id_type', observed=True, sort=False):
+            self._by_value[id_type] = (_IntervalSearch(df['value'].to_numpy(dtype=object), df['start'], df['end']), 
+                                       df['permno'].to_numpy())
+            self._by_permno[id_type] = (_IntervalSearch(df['permno'].to_numpy(), df['start'], df['end']),
+                                        df['value'].to_numpy(dtype=object))
+
+    @classmethod
+    def from_links(cls, mse, ccm, permnos=None):
+        return cls(identifier_intervals(mse, ccm, permnos))
+
+    def __repr__(self):
+        counts = self.intervals['id_type'].value_counts()
+        return f'IdentifierIndex({", ".join(f"{k}: {v} intervals" for k, v in counts.items())})'
+
+    def _lookup(self, searches, id_type, keys, dates):
+        if id_type not in searches:
+            raise KeyError(f'no {id_type} intervals, use one of {list(searches)}')
+        search, targets = searches[id_type]
+        keys = np.asarray(keys, dtype=object if searches is self._by_value else np.int64)
+        dates = np.broadcast_to(np.asarray(pd.to_datetime(dates)), keys.shape)
+        position = search.find(keys, dates)
+        return position, targets
+
+    def permnos(self, values, dates, id_type='ticker'):
+        '''permno that each of values (tickers / ncusips / gvkeys) belonged to on the matching date, <NA> if none'''
+        position, targets = self._lookup(self._by_value, id_type, values, dates)
+        return pd.arrays.IntegerArray(targets[np.maximum(position, 0)].astype(np.int64), position < 0)
+
+    def permno(self, value, date, id_type='ticker'):
+        result = self.permnos([value], date, id_type)[0]
+        return None if pd.isna(result) else int(result)
+
+    def identifiers(self, permnos, dates, id_type='ticker'):
+        '''id_type identifier of each permno on the matching date, None if it had none'''
+        position, targets = self._lookup(self._by_permno, id_type, permnos, dates)
+        return np.where(position >= 0, targets[np.maximum(position, 0)], None)
+
+    def identifier(self, permno, date, id_type='ticker'):
+        return self.identifiers([permno], date, id_type)[0]
+
+# %% [markdown]
+# ### Permno partitions
+# - a streaming build splits the securities into ranges of sorted permnos; partition `p` holds the permnos in `[part_starts[p], part_starts[p+1])`
+# - the large queries are read in chunks and every chunk is spilled to disk split by partition, so a partition can later be processed on its own
+# - every per-security step (merges, forward fills, rolling windows, cleaning) only looks at rows of the same permno, so running them partition by partition gives the same rows as running them on the whole panel
 
-        cty_chosen = ['USA']
+# %%
+def permno_partitions(permnos, partition_size):
+    '''first permno of each partition when the sorted unique permnos are cut into groups of partition_size'''
+    return np.unique(np.asarray(permnos, dtype=float))[::partition_size]
+
+def _permno_partition(permnos, part_starts):
+    # permnos below the first start go to partition 0, missing permnos to the last one
+    part = np.searchsorted(part_starts, permnos, side='right') - 1
+    return np.clip(part, 0, len(part_starts) - 1)
+
+def spill_by_permno(chunks, part_starts, spill_dir):
+    '''write an iterable of DataFrame chunks to spill_dir, one Feather file per (partition, chunk).
+    The folder is emptied first, so a retried fetch does not duplicate rows. Returns the rows spilled per partition'''
+    shutil.rmtree(spill_dir, ignore_errors=True)
+    os.makedirs(spill_dir)
+    rows = np.zeros(len(part_starts), dtype=np.int64)
+    for i, chunk in enumerate(chunks):
+        part = _permno_partition(chunk['permno'].to_numpy(dtype=float, na_value=np.nan), part_starts)
+        order = np.argsort(part, kind='stable')
+        bounds = np.searchsorted(part[order], np.arange(len(part_starts) + 1))
+        for p in np.flatnonzero(np.diff(bounds)):
+            piece = chunk.iloc[order[bounds[p]:bounds[p+1]]].reset_index(drop=True)
+            feather.write_feather(piece, os.path.join(spill_dir, f'part-{p:05d}-{i:06d}.feather'), compression='uncompressed')
+            rows[p] += len(piece)
+    return rows
+
+def read_spilled_partition(spill_dir, part):
+    '''all spilled rows of one partition, in the order they were fetched (empty frame if there are none)'''
+    files = sorted(glob.glob(os.path.join(spill_dir, f'part-{part:05d}-*.feather')))
+    if not files:
+        any_file = sorted(glob.glob(os.path.join(spill_dir, '*.feather')))[:1]
+        if not any_file:
+            raise ValueError(f'nothing was spilled to {spill_dir}')
+        return feather.read_table(any_file[0]).schema.empty_table().to_pandas()
+    return pd.concat([feather.read_feather(x) for x in files], ignore_index=True)
+
+# %% [markdown]
+# ### Stage instrumentation
+# - `StageTimer` records, for every named stage of a build (`fetch_raw`, `link_identifiers`, `char_asof_join`, `rolling_metrics`, `save_checkpoint`, ...), the wall time, CPU time of this process, peak resident memory during the stage and the rows / bytes of its inputs and outputs
+# - stages nest (`prepare_data/build_security_panel/rolling_metrics`); a stage that runs once per partition gets one record per run, `summary()` adds them up
+# - `Data_NN` methods are marked as stages with the `staged` decorator (table arguments / results counted as inputs / outputs), smaller steps inside them with `with self.stages.stage(...)`
+# - `to_frame()`, `to_json(path)`, `to_csv(path)` export the records
+# - `profile_stages` attaches a profiler to chosen stages: cProfile by default (stats saved as `<profile_dir>/<stage>.prof`, open with `pstats` or snakeviz), or any `profiler(stage_path)` that returns a context manager, e.g. a sampling profiler (`Data_NN(profiler=...)`, `--profiler` of the command line)
+
+# %%
+RSS_SAMPLE_INTERVAL = 0.05
+
+def current_rss_mb():
+    '''resident memory of this process in MB (Linux /proc, else the peak from getrusage, else nan)'''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return np.nan
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2**20 if sys.platform == 'darwin' else 2**10)
+
+def data_size(obj):
+    '''(rows, bytes) of a table or of a dict / list of tables; (0, 0) for anything else'''
+    if isinstance(obj, pd.DataFrame):
+        return len(obj), int(obj.memory_usage(index=True).sum())
+    if isinstance(obj, pd.Series):
+        return len(obj), int(obj.memory_usage(index=True))
+    if isinstance(obj, dict):
+        obj = list(obj.values())
+    if isinstance(obj, (list, tuple)):
+        sizes = [data_size(x) for x in obj]
+        return sum(x[0] for x in sizes), sum(x[1] for x in sizes)
+    return 0, 0
+
+def cprofile_stage(profile_dir):
+    '''profiler factory for StageTimer: run the stage under cProfile and dump the stats to profile_dir/<stage>.prof'''
+    @contextmanager
+    def run(stage_path):
+        os.makedirs(profile_dir, exist_ok=True)
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield profiler
+        finally:
+            profiler.disable()
+            profiler.dump_stats(os.path.join(profile_dir, stage_path.replace('/', '.') + '.prof'))
+    return run
+
+class StageTimer:
+    '''records wall / CPU time, peak RSS and input / output sizes of named (nested) stages:
+
+        with timer.stage('rolling_metrics', inputs=sp500_used) as stage:
+            ...
+            stage['outputs'] = data_size(result)
+
+    profile_stages: stage names (or the end of their paths, such as 'prepare_data/fetch_raw') to run under `profiler`'''
+    COLUMNS = ['stage', 'depth', 'start', 'wall_s', 'cpu_s', 'rss_start_mb', 'peak_rss_mb',
+               'rows_in', 'bytes_in', 'rows_out', 'bytes_out']
+
+    def __init__(self, profile_stages=(), profiler=None, profile_dir='stage_profiles'):
+        self.records = []
+        self.profile_stages = set(profile_stages or ())
+        self.profiler = profiler or cprofile_stage(profile_dir)
+        self._open = []
+        self._lock = threading.Lock()
+        self._sampler = None
+
+    def _sample(self):
+        # one thread keeps the peak of every open stage while any stage runs
+        while True:
+            rss = current_rss_mb()
+            with self._lock:
+                if not self._open:
+                    self._sampler = None
+                    return
+                for record in self._open:
+                    record['peak_rss_mb'] = max(record['peak_rss_mb'], rss)
+            time.sleep(RSS_SAMPLE_INTERVAL)
+
+    @contextmanager
+    def stage(self, name, inputs=None):
+        path = '/'.join([x['stage'] for x in self._open[-1:]] + [name])
+        rows_in, bytes_in = data_size(inputs)
+        rss = current_rss_mb()
+        record = {'stage': path, 'depth': len(self._open), 'start': datetime.now().isoformat(timespec='seconds'),
+                  'rss_start_mb': rss, 'peak_rss_mb': rss, 'rows_in': rows_in, 'bytes_in': bytes_in, 'outputs': None}
+        self.records.append(record)
+        with self._lock:
+            self._open.append(record)
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample, daemon=True)
+                self._sampler.start()
+        profile = any(path == x or path.endswith('/' + x) for x in self.profile_stages)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            if profile:
+                with self.profiler(path):
+                    yield record
+            else:
+                yield record
+        finally:
+            record['wall_s'] = time.perf_counter() - wall
+            record['cpu_s'] = time.process_time() - cpu
+            with self._lock:
+                record['peak_rss_mb'] = max(record['peak_rss_mb'], current_rss_mb())
+                self._open.remove(record)
+            record['rows_out'], record['bytes_out'] = record.pop('outputs') or (0, 0)
+
+    def set_output(self, obj=None, rows=None, nbytes=None):
+        '''outputs of the innermost open stage: the size of obj, or rows / nbytes given directly (e.g. bytes on disk)'''
+        rows_obj, bytes_obj = data_size(obj)
+        self._open[-1]['outputs'] = (rows_obj if rows is None else rows, bytes_obj if nbytes is None else nbytes)
+
+    def reset(self):
+        self.records = []
+
+    def to_frame(self):
+        '''one row per stage run, in the order the stages started'''
+        return pd.DataFrame([x for x in self.records if 'wall_s' in x], columns=self.COLUMNS)
+
+    def summary(self):
+        '''stage runs added up by stage (peak RSS is the maximum)'''
+        return self.to_frame().groupby('stage', sort=False).agg(
+            runs=('wall_s', 'size'), wall_s=('wall_s', 'sum'), cpu_s=('cpu_s', 'sum'), peak_rss_mb=('peak_rss_mb', 'max'),
+            rows_in=('rows_in', 'sum'), bytes_in=('bytes_in', 'sum'), rows_out=('rows_out', 'sum'), bytes_out=('bytes_out', 'sum'))
+
+    def to_json(self, path=None):
+        text = self.to_frame().to_json(orient='records', indent=1)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(text)
+        return text
+
+    def to_csv(self, path=None):
+        return self.to_frame().to_csv(path, index=False)
+
+def staged(name):
+    '''method decorator: run the method as stage `name` of self.stages; table arguments are its inputs and
+    the returned tables its outputs (unless the method sets them with self.stages.set_output)'''
+    def wrap(method):
+        @functools.wraps(method)
+        def run(self, *args, **kwargs):
+            with self.stages.stage(name, inputs=[*args, *kwargs.values()]) as stage:
+                result = method(self, *args, **kwargs)
+                if stage['outputs'] is None:
+                    stage['outputs'] = data_size(result)
+            return result
+        return run
+    return wrap
+
+# %% [markdown]
+# ### Data sources
+# - `WrdsYahooSource` runs the WRDS queries and Yahoo Finance downloads used by `Data_NN`; `LocalSource` serves the same tables with the same schemas from Parquet fixtures, so the pipeline can run (and be timed) offline
+# - `fetch_concurrently` runs independent fetches on a bounded thread pool and retries failed ones
 
+# %%
+# treasury yield series downloaded from Yahoo Finance next to the S&P500 index
+TREASURY_TICKERS = {
+    "tsy10yr": "^TNX",
+    "tsy5yr": "^FVX",
+    "tsy2yr": "^IRX"  # Note: ^IRX is for 13-week T-bills, but you can replace it with the appropriate 2-year ticker if available
+}
+
+def fetch_concurrently(tasks, max_workers=4, retries=2, retry_wait=2.0):
+    '''run independent fetches {name: zero-argument callable} on a thread pool of at most max_workers threads.
+    A failed fetch is retried up to `retries` times (waiting retry_wait, then twice as long, ...).
+    Returns {name: result}; the first fetch that still fails after its retries raises'''
+    def run(name, task):
+        for attempt in range(retries + 1):
+            try:
+                return task()
+            except Exception as e:
+                if attempt == retries:
+                    raise
+                print(f'{name} failed ({e!r}), retrying..')
+                time.sleep(retry_wait * 2**attempt)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(tasks)))) as pool:
+        futures = {name: pool.submit(run, name, task) for name, task in tasks.items()}
+        return {name: future.result() for name, future in futures.items()}
+
+class WrdsYahooSource:
+    '''live data source: CRSP / CCM / JKP tables from WRDS and market series from Yahoo Finance.
+    WRDS connections are pooled so queries can run in parallel; extra connections log in without a prompt,
+    so more than one is only opened when a ~/.pgpass file exists (answer "Y" when the first connection asks)'''
+
+    def __init__(self, wrds_username=None, max_connections=None):
+        self.wrds_username = wrds_username
+        if max_connections is None:
+            pgpass = os.environ.get('PGPASSFILE', os.path.join(os.path.expanduser('~'), '.pgpass'))
+            max_connections = 4 if os.path.exists(pgpass) else 1
+        self.max_connections = max_connections
+        self._idle = queue.Queue()
+        self._opened = []
+        self._lock = threading.Lock()
+
+    def connect(self):
+        '''open the first connection (this is where WRDS asks for user name / password)'''
+        if not self._opened:
+            self._release(self._acquire())
+        return self
+
+    def _acquire(self):
+        with self._lock:
+            if self._idle.empty() and len(self._opened) < self.max_connections:
+                username = self.wrds_username or (getattr(self._opened[0], '_username', None) if self._opened else None)
+                db = wrds.Connection(wrds_username=username) if username else wrds.Connection()
+                self._opened.append(db)
+                return db
+        return self._idle.get()
+
+    def _release(self, db):
+        self._idle.put(db)
+
+    def raw_sql(self, sql, date_cols=None):
+        db = self._acquire()
+        try:
+            return db.raw_sql(sql, date_cols=date_cols)
+        finally:
+            self._release(db)
+
+    def raw_sql_chunks(self, sql, chunksize, date_cols=None):
+        '''iterate over the result of a query in DataFrames of at most chunksize rows (the connection is held until done)'''
+        db = self._acquire()
+        try:
+            yield from db.raw_sql(sql, date_cols=date_cols, chunksize=chunksize, return_iter=True)
+        finally:
+            self._release(db)
+
+    def _query(self, sql, date_cols=None, chunksize=None):
+        if chunksize is None:
+            return self.raw_sql(sql, date_cols=date_cols)
+        return self.raw_sql_chunks(sql, chunksize, date_cols=date_cols)
+
+    def char_data(self, char_chosen, since, cty_chosen=('USA',), chunksize=None):
         sql_query= f"""
                 SELECT id, eom, excntry, gvkey, permno, size_grp, me, ret_exc_lead1m, {','.join(map(str, char_chosen))}
                         FROM contrib.global_factor
                         WHERE common=1 and exch_main=1 and primary_sec=1 and obs_main=1 and
-                        excntry in ({','.join("'"+str(x)+"'" for x in cty_chosen)}) and eom>=CAST('{start_date}' AS DATE)
+                        excntry in ({','.join("'"+str(x)+"'" for x in cty_chosen)}) and eom>=CAST('{since}' AS DATE)
                 """
-        char_data = wrds_db.raw_sql(sql_query)
-        char_data = char_data.apply(lambda x: x.astype(float) if x.dtype=='Float64' else x, axis=0)
-        #IN: added to make sure types are 'float64' instead of 'Float64'
-
-        '''Download S&P500 constituents From CRSP and Compustat'''
-        print ('Download S&P500 constituents From CRSP and Compustat..')
-        '''Get S&P constituents in-index date range and respective return'''
-        print ('Get S&P constituents in-index date range and respective return..')
+        return self._query(sql_query, chunksize=chunksize)
 
-        start_date_sp = start_date
+    def sp500_daily(self, since, chunksize=None):
         # IN: crsp.msp500list is monthly data, crsp.dsp500list is daily data; similarly crsp.msp is monthly data; crsp.dsp is daily data
-
-        sp500_daily = wrds_db.raw_sql(f"""
+        return self._query(f"""
                                 select a.*, b.date, b.ret, b.vol
                                 from crsp.dsp500list as a,
                                 crsp.dsf as b
                                 where a.permno=b.permno
                                 and b.date >= a.start and b.date<= a.ending
-                                and b.date>=CAST('{start_date_sp}' AS DATE)
+                                and b.date>=CAST('{since}' AS DATE)
                                 order by date;
-                                """, date_cols=['start', 'ending', 'date'])
-        
-        '''Get Identifier and Descriptive Data From CRSP and Compustat for merges'''
-        print ('Get Identifier and Descriptive Data From CRSP and Compustat for merges..')
-        # Add Other Descriptive Variables from CRSP
+                                """, date_cols=['start', 'ending', 'date'], chunksize=chunksize)
+
+    def sp500_permnos(self):
+        '''every permno that was ever an S&P500 constituent (used to cut the universe into partitions)'''
+        return self.raw_sql("select distinct permno from crsp.dsp500list")['permno'].to_numpy()
 
-        mse = wrds_db.raw_sql("""
+    def msenames(self):
+        return self.raw_sql("""
                                 select comnam, ncusip, namedt, nameendt, 
                                 permno, shrcd, exchcd, hsiccd, ticker
                                 from crsp.msenames
                                 """, date_cols=['namedt', 'nameendt'])
 
-        # if nameendt is missing then set to today date
-        mse['nameendt']=mse['nameendt'].fillna(pd.to_datetime('today'))
-
-        # Merge with SP500 universe data
-        sp500_crsp = pd.merge(sp500_daily, mse, how = 'left', on = 'permno')
-
-        # Impose the date range restrictions
-        sp500_crsp = sp500_crsp.loc[(sp500_crsp.date>=sp500_crsp.namedt) \
-                                    & (sp500_crsp.date<=sp500_crsp.nameendt)]
-        
-        # Linking with Compustat through CCM
-        ccm=wrds_db.raw_sql("""
+    def ccm_links(self):
+        return self.raw_sql("""
                         select gvkey, liid as iid, lpermno as permno, linktype, linkprim, 
                         linkdt, linkenddt
                         from crsp.ccmxpf_linktable
@@ -311,43 +2227,770 @@ class Data_NN:
                         and (linkprim ='C' or linkprim='P')
                         """, date_cols=['linkdt', 'linkenddt'])
 
+    def market_series(self, ticker, start, end):
+        '''daily OHLCV of a Yahoo Finance ticker with flat columns (Close, High, Low, Open, Volume)'''
+        df = yf.download(ticker, start=start, end=end, progress=False)
+        if isinstance(df.columns, pd.MultiIndex):
+            df = df.droplevel(1, axis=1)
+        df.index = pd.to_datetime(df.index) #IN: to make sure it's datetime index
+        return df
+
+    def close(self):
+        for db in self._opened:
+            db.close()
+        self._opened, self._idle = [], queue.Queue()
+
+class LocalSource:
+    '''offline stand-in for WrdsYahooSource. Reads Parquet fixtures with the WRDS / Yahoo schemas from fixture_dir:
+    contrib_global_factor, crsp_dsp500list, crsp_dsf, crsp_msenames, crsp_ccmxpf_linktable (.parquet) and 
+    yahoo/<ticker>.parquet, and applies the same filters and joins as the SQL queries.
+    Fixtures can be written from any fetched tables with save_local_fixtures'''
+
+    def __init__(self, fixture_dir):
+        self.fixture_dir = fixture_dir
+
+    def connect(self):
+        return self
+
+    def close(self):
+        pass
+
+    def _read(self, name, **kwargs):
+        return pd.read_parquet(os.path.join(self.fixture_dir, f'{name}.parquet'), **kwargs)
+
+    def _batches(self, name, chunksize, columns=None):
+        for batch in pq.ParquetFile(os.path.join(self.fixture_dir, f'{name}.parquet')).iter_batches(batch_size=chunksize, columns=columns):
+            yield batch.to_pandas()
+
+    def char_data(self, char_chosen, since, cty_chosen=('USA',), chunksize=None):
+        if chunksize is not None:
+            return (self._filter_char(gf, char_chosen, since, cty_chosen)
+                    for gf in self._batches('contrib_global_factor', chunksize))
+        return self._filter_char(self._read('contrib_global_factor'), char_chosen, since, cty_chosen)
+
+    def _filter_char(self, gf, char_chosen, since, cty_chosen):
+        keep = pd.to_datetime(gf['eom']) >= pd.Timestamp(since)
+        for col in ['common', 'exch_main', 'primary_sec', 'obs_main']:
+            if col in gf.columns:
+                keep &= gf[col] == 1
+        if 'excntry' in gf.columns:
+            keep &= gf['excntry'].isin(cty_chosen)
+        columns = ['id', 'eom', 'excntry', 'gvkey', 'permno', 'size_grp', 'me', 'ret_exc_lead1m'] + list(char_chosen)
+        return gf.loc[keep.to_numpy(), columns].reset_index(drop=True)
+
+    def sp500_daily(self, since, chunksize=None):
+        members = self._read('crsp_dsp500list')
+        if chunksize is not None:
+            return (self._join_members(members, dsf[dsf['date'] >= pd.Timestamp(since)])
+                    for dsf in self._batches('crsp_dsf', chunksize, columns=['permno', 'date', 'ret', 'vol']))
+        dsf = self._read('crsp_dsf', columns=['permno', 'date', 'ret', 'vol'],
+                         filters=[('date', '>=', pd.Timestamp(since))])
+        return self._join_members(members, dsf)
+
+    def _join_members(self, members, dsf):
+        sp500_daily = pd.merge(members, dsf, on='permno')
+        sp500_daily = sp500_daily[(sp500_daily['date'] >= sp500_daily['start']) & (sp500_daily['date'] <= sp500_daily['ending'])]
+        return sp500_daily.sort_values(by='date', kind='stable').reset_index(drop=True)
+
+    def sp500_permnos(self):
+        return self._read('crsp_dsp500list', columns=['permno'])['permno'].unique()
+
+    def msenames(self):
+        return self._read('crsp_msenames', columns=['comnam', 'ncusip', 'namedt', 'nameendt',
+                                                    'permno', 'shrcd', 'exchcd', 'hsiccd', 'ticker'])
+
+    def ccm_links(self):
+        ccm = self._read('crsp_ccmxpf_linktable')
+        ccm = ccm[ccm['linktype'].str[:1].eq('L') & ccm['linkprim'].isin(['C', 'P'])]
+        return ccm.rename(columns={'liid': 'iid', 'lpermno': 'permno'})[
+            ['gvkey', 'iid', 'permno', 'linktype', 'linkprim', 'linkdt', 'linkenddt']].reset_index(drop=True)
+
+    def market_series(self, ticker, start, end):
+        df = self._read(os.path.join('yahoo', ticker))
+        return df.loc[(df.index >= pd.Timestamp(start)) & (df.index < pd.Timestamp(end))]
+
+def save_local_fixtures(fixture_dir, char_data, sp500_daily, mse, ccm, market_series):
+    '''write fetched (or synthetic) tables as LocalSource fixtures. sp500_daily is the joined constituent query; 
+    it is split back into crsp_dsp500list and crsp_dsf. market_series: {ticker: flat OHLCV frame}'''
+    os.makedirs(os.path.join(fixture_dir, 'yahoo'), exist_ok=True)
+    char_data.to_parquet(os.path.join(fixture_dir, 'contrib_global_factor.parquet'))
+    member_columns = [x for x in sp500_daily.columns if x not in ['date', 'ret', 'vol']]
+    sp500_daily[member_columns].drop_duplicates().to_parquet(os.path.join(fixture_dir, 'crsp_dsp500list.parquet'))
+    sp500_daily[['permno', 'date', 'ret', 'vol']].drop_duplicates(subset=['permno', 'date'])\
+        .to_parquet(os.path.join(fixture_dir, 'crsp_dsf.parquet'))
+    mse.to_parquet(os.path.join(fixture_dir, 'crsp_msenames.parquet'))
+    ccm.rename(columns={'iid': 'liid', 'permno': 'lpermno'}).to_parquet(os.path.join(fixture_dir, 'crsp_ccmxpf_linktable.parquet'))
+    for ticker, df in market_series.items():
+        df.to_parquet(os.path.join(fixture_dir, 'yahoo', f'{ticker}.parquet'))
+
+# %% [markdown]
+# ## Classes
+
+# %%
+# tables loaded into Data_NN.data_dic
+DATA_DIC_TABLES = ['data_useful_info_dic', 'sp500_used', 'mkt_daily', 'train_sp500', 'test_sp500',
+                   'train_mkt', 'test_mkt', 'ticker_permno_dic', 'permno_ticker_dic']
+TICKER_MAPS = ['ticker_permno_dic', 'permno_ticker_dic']
+
+class LazyDataDic(MutableMapping):
+    '''dict-like view of a checkpoint: a table is read from disk the first time it is accessed and kept afterwards.
+    `load` returns a column / date-range projection of a table (e.g. only some numerical columns of sp500_used 
+    from 2021 onward), and `drop` releases cached tables to free memory.
+    The train / test tables of a date-sorted checkpoint are row ranges of sp500_used / mkt_daily (manifest 'splits') 
+    and are returned as views of those tables.
+    remote: the RemoteCheckpoint that checkpoint_dir mirrors; a table missing locally is fetched before it is read
+    train_end_date: split a date-sorted checkpoint at this date instead of the stored split, and make the 
+    permno-ticker maps from that train view (a checkpoint in the shared cache can be re-split by another reader)'''
+
+    def __init__(self, checkpoint_dir, table_names=DATA_DIC_TABLES, remote=None, train_end_date=None):
+        self.checkpoint_dir = checkpoint_dir
+        self.remote = remote
+        self.table_names = list(table_names)
+        self.manifest = read_checkpoint_manifest(checkpoint_dir)
+        self.views = (self.manifest or {}).get('splits', {}).get('views', {})
+        self.train_end_date = None
+        self._cache = {}
+        self._projection_cache = {}
+        if train_end_date is not None and 'sp500_used_offsets' in (self.manifest or {}).get('tables', {}):
+            self.train_end_date = train_end_date
+            self._fetch('sp500_used_offsets')
+            self._fetch('mkt_daily')
+            mkt_offsets = date_offsets(load_checkpoint_table(checkpoint_dir, 'mkt_daily', columns=[], manifest=self.manifest).index)
+            self.views = split_views(load_checkpoint_table(checkpoint_dir, 'sp500_used_offsets', manifest=self.manifest),
+                                     mkt_offsets, train_end_date)['views']
+
+    def __getitem__(self, table_name):
+        if table_name not in self._cache:
+            if table_name not in self.table_names:
+                raise KeyError(table_name)
+            if table_name in self.views:
+                view = self.views[table_name]
+                self._cache[table_name] = self[view['table']].iloc[view['start']:view['stop']]
+            elif table_name in TICKER_MAPS and self.train_end_date is not None:
+                maps = {}, {}
+                update_ticker_maps(self.load('train_sp500', columns=['ticker','permno'], cache=False), *maps)
+                self._cache.update(zip(TICKER_MAPS, maps))
+            else:
+                self._fetch(table_name)
+                self._cache[table_name] = load_checkpoint_table(self.checkpoint_dir, table_name, manifest=self.manifest)
+        return self._cache[table_name]
+
+    def _fetch(self, table_name):
+        if self.remote is not None:
+            self.remote.fetch([table_name])
+
+    def __setitem__(self, table_name, value):
+        if table_name not in self.table_names:
+            self.table_names.append(table_name)
+        self._cache[table_name] = value
+
+    def __delitem__(self, table_name):
+        self.table_names.remove(table_name)
+        self.drop(table_name)
+
+    def __iter__(self):
+        return iter(self.table_names)
+
+    def __len__(self):
+        return len(self.table_names)
+
+    def __repr__(self):
+        return f'LazyDataDic({self.checkpoint_dir!r}, loaded={self.loaded()})'
+
+    def load(self, table_name, columns=None, start_date=None, end_date=None, cache=True):
+        '''projected read of one table; a table that is already fully loaded is projected in memory instead'''
+        if columns is None and start_date is None and end_date is None:
+            return self[table_name]
+        key = (table_name, tuple(columns) if columns is not None else None, start_date, end_date)
+        if key in self._projection_cache:
+            return self._projection_cache[key]
+        view = self.views.get(table_name)
+        if table_name in self._cache or (view is not None and view['table'] in self._cache):
+            df = self[table_name]
+            if start_date is not None or end_date is not None:
+                dates = df['date'] if 'date' in df.columns else df.index.to_series()
+                df = df[dates.between(start_date or dates.min(), end_date or dates.max()).values]
+            if columns is not None:
+                df = df[list(columns)]
+        elif view is not None:
+            self._fetch(view['table'])
+            df = load_checkpoint_table(self.checkpoint_dir, view['table'], columns=columns, start_date=start_date,
+                                       end_date=end_date, manifest=self.manifest, rows=slice(view['start'], view['stop']))
+        else:
+            self._fetch(table_name)
+            df = load_checkpoint_table(self.checkpoint_dir, table_name, columns=columns, start_date=start_date,
+                                       end_date=end_date, manifest=self.manifest)
+        if cache:
+            self._projection_cache[key] = df
+        return df
+
+    def loaded(self):
+        '''names of the tables (and projections) currently held in memory'''
+        return list(self._cache) + [key[0] for key in self._projection_cache]
+
+    def drop(self, *table_names):
+        '''release cached tables (all of them if no name is given); they are re-read on next access'''
+        table_names = table_names or self.table_names
+        # views keep the table they are cut from in memory
+        table_names = list(table_names) + [x for x, view in self.views.items() if view['table'] in table_names]
+        for table_name in table_names:
+            self._cache.pop(table_name, None)
+            for key in [key for key in self._projection_cache if key[0] == table_name]:
+                del self._projection_cache[key]
+
+class Data_NN:
+    '''this is the class to prepare and retreive NN (DL) used data
+    the class will check the existence of checkpoint data first, 
+    if not exist, then retrieve new version of data
+
+    note: if you will create the data with new checkpoint name, you will
+    need to put in WRDS user name, password, and "Y"
+
+    parameters:
+    - start_date / train_end_date: first date of the panel and last date of the train split
+    - end_date: end of the market data download (exclusive, as in yf.download); update_checkpoint moves it forward
+    - checkpoint_format: 'arrow' (default) saves DataFrames as memory-mappable Feather files with a manifest.json;
+      'pickle' keeps the old one-pickle-per-table layout
+    - daily_metric_windows / daily_metric_reducers: rolling return windows ({label: n_days}) and reducers added to 
+      sp500_used, see rolling_group_metrics
+    - char_max_staleness: optional limit (e.g. '93D') on how old the monthly characteristics attached to a daily row 
+      may be; None carries them forward without limit
+    - source: where the raw tables come from, WrdsYahooSource() (default) or LocalSource(fixture_dir) to run offline;
+      max_workers / fetch_retries: thread pool size and retries for the concurrent fetches
+    - streaming: build the checkpoint out of core, partition_size permnos at a time, reading the large queries in
+      chunks of chunksize rows (see _prepare_data_streaming); peak memory then follows the partition size
+    - n_jobs: worker processes for the per-permno steps (forward fills, rolling metrics), -1 for all cores; the result
+      is the same for any n_jobs, see run_by_group
+    - char_chosen: JKP characteristics to attach (default: the FF-5 / momentum / reversal set below)
+    - abnormal_threshold: opt_to_book_eq values above it are treated as outliers (the default cleaning_rules);
+      cleaning_rules: outlier rules per numerical column, each cleaned column is then forward filled by permno (see 
+      clean_panel)
+    - panel_dtypes: compact dtypes of sp500_used (see compact_panel), None keeps float64 / object columns
+    - panel_tensor: also store the dense (date, permno, feature) tensor, see PanelTensor
+    - cache_dir: folder of the parameter-keyed checkpoints used by retrieve_data() without a checkpoint name;
+      max_cached_checkpoints / max_cache_bytes: LRU limits of that folder (None = no limit)
+    - show_plots: draw the data check plots while building (see render_profile); None draws them only in an 
+      interactive (IPython / Jupyter) session, so batch builds stay headless. The data quality profile is stored 
+      either way
+    - profile_stages / profile_dir: stages of the build to run under cProfile (see StageTimer); the timings of every
+      stage are in self.stages, export them with stage_report. profiler: another profiler for those stages, a 
+      profiler(stage_path) context manager factory such as a sampling profiler
+    - data_dir: folder of the checkpoints (also set_directory); checkpoint names and cache_dir are relative to it. 
+      The working directory of the process is left alone, and may change afterwards (data_dir is kept as an 
+      absolute path)
+    - remote_cache_dir / remote_cache_bytes / storage_options: local cache (in data_dir), its size limit and the 
+      fsspec options (e.g. credentials) for checkpoints named by URL, see RemoteCheckpoint'''
+
+    def __init__(self, start_date='2000-01-01', train_end_date='2020-12-31', checkpoint_format='arrow',
+                 daily_metric_windows=DAILY_METRIC_WINDOWS, daily_metric_reducers=('sum',), char_max_staleness=None,
+                 end_date='2025-01-01', source=None, max_workers=4, fetch_retries=2,
+                 streaming=False, partition_size=250, chunksize=1000000, n_jobs=1, char_chosen=None, abnormal_threshold=30,
+                 cache_dir='checkpoint_cache', max_cached_checkpoints=None, max_cache_bytes=None, panel_dtypes=PANEL_DTYPES,
+                 show_plots=None, profile_stages=None, profile_dir='stage_profiles', profiler=None, panel_tensor=True, cleaning_rules=None,
+                 data_dir='.', remote_cache_dir=REMOTE_CACHE_DIR, remote_cache_bytes=REMOTE_CACHE_BYTES, storage_options=None):
+        self.checkpoint_name = ''
+        # absolute, so the lazily read tables are still found after the working directory changes
+        self.dir = os.path.abspath(data_dir)
+        self.remote_cache_dir = remote_cache_dir
+        self.remote_cache_bytes = remote_cache_bytes
+        self.storage_options = storage_options
+        self._remote = {}
+        self._pinned = None
+        self.data_dic = {}
+        self.start_date=start_date
+        self.train_end_date = train_end_date
+        self.checkpoint_format = checkpoint_format
+        self.daily_metric_windows = daily_metric_windows
+        self.daily_metric_reducers = daily_metric_reducers
+        self.char_max_staleness = char_max_staleness
+        self.end_date = end_date
+        self.source = source
+        self.max_workers = max_workers
+        self.fetch_retries = fetch_retries
+        self.streaming = streaming
+        self.partition_size = partition_size
+        self.chunksize = chunksize
+        self.n_jobs = n_jobs
+        self.abnormal_threshold = abnormal_threshold
+        self.cleaning_rules = cleaning_rules if cleaning_rules is not None else default_cleaning_rules(abnormal_threshold)
+        self.cleaning_log = None
+        self.panel_dtypes = panel_dtypes
+        self.cache_dir = cache_dir
+        self.max_cached_checkpoints = max_cached_checkpoints
+        self.max_cache_bytes = max_cache_bytes
+        self.show_plots = _interactive_session() if show_plots is None else show_plots
+        self.stages = StageTimer(profile_stages, profiler=profiler, profile_dir=profile_dir)
+        self.build_tensor = panel_tensor
+        #IN: second version where the first five factors are based on paper
+        self.char_chosen =['market_equity','be_me','at_gr1','ope_be','ret_12_1', # FF-5-factor
+                    'ret_6_1','ret_3_1', # other mmt
+                    'ret_60_12', 'ret_1_0'] # reversal
+        if char_chosen is not None:
+            self.char_chosen = list(char_chosen)
+         
+    def __repr__(self):
+        return f'\nThe checkpoint name of this data is {self.checkpoint_name}, \nand data_dic keys are {list(self.data_dic.keys())}'
+    
+    def set_directory(self, data_directory_path, chdir=False):
+        #IN: note this directory_path should be where the data is at
+        # checkpoints are looked up in it via checkpoint_path; chdir=True also makes it the working directory (as before)
+        self.dir = os.path.abspath(data_directory_path)
+        if chdir:
+            os.chdir(data_directory_path)
+
+    def checkpoint_path(self, checkpoint_name=None):
+        '''path of a checkpoint (the current one by default) in the data directory; for a checkpoint URL its local 
+        mirror, where only the files fetched so far are (see _local_checkpoint)'''
+        checkpoint_name = checkpoint_name or self.checkpoint_name
+        if is_remote_checkpoint(checkpoint_name):
+            return self.remote_checkpoint(checkpoint_name).local_dir
+        return os.path.join(self.dir, checkpoint_name)
+
+    def _local_checkpoint(self, checkpoint_name, table_names, tensor=False):
+        '''checkpoint_path, with the files of table_names (and of the panel tensor) present: for a checkpoint URL only
+        those are fetched'''
+        checkpoint_name = checkpoint_name or self.checkpoint_name
+        if is_remote_checkpoint(checkpoint_name):
+            return self.remote_checkpoint(checkpoint_name).fetch(list(table_names), tensor=tensor)
+        return self.checkpoint_path(checkpoint_name)
+
+    def _pin(self, checkpoint_dir):
+        '''pin the checkpoint in use (see pin_checkpoint), releasing the one pinned before'''
+        unpin_checkpoint(self._pinned)
+        self._pinned = pin_checkpoint(checkpoint_dir, owner=self)
+
+    def remote_checkpoint(self, url, reopen=False):
+        '''the local cache of a checkpoint URL (see RemoteCheckpoint); reopen reads its manifest again'''
+        if reopen or url not in self._remote:
+            if url in self._remote:
+                self._remote[url].close()
+            self._remote[url] = RemoteCheckpoint(url, os.path.join(self.dir, self.remote_cache_dir), self.remote_cache_bytes,
+                                                 max_concurrency=self.max_workers, storage_options=self.storage_options)
+        return self._remote[url]
+
+    def check_checkpoint(self, checkpoint_name):
+        if os.path.exists(self.checkpoint_path(checkpoint_name)):
+            self.checkpoint_name = checkpoint_name
+            return True
+        else:
+            return False 
+        
+    def build_params(self):
+        '''the parameters that determine the stored panel (everything but the train/test boundary)'''
+        return {'start_date': self.start_date,
+                'end_date': self.end_date,
+                'char_chosen': self.char_chosen,
+                'abnormal_threshold': float(self.abnormal_threshold),
+                'cleaning_rules': self.cleaning_rules,
+                'daily_metric_windows': self.daily_metric_windows,
+                'daily_metric_reducers': list(self.daily_metric_reducers),
+                'char_max_staleness': self.char_max_staleness,
+                'panel_dtypes': self.panel_dtypes}
+
+    def _build_record(self):
+        '''build parameters, train/test boundary and cache key, as recorded in the manifest'''
+        return {**self.build_params(), 'train_end_date': self.train_end_date,
+                'pipeline_version': PIPELINE_VERSION, 'key': checkpoint_key(self.build_params())}
+
+    def stage_report(self, path=None):
+        '''timings / memory of the stages run so far (see StageTimer); saved as JSON or CSV if path ends in .json / .csv'''
+        if path is not None and path.endswith('.json'):
+            self.stages.to_json(path)
+        elif path is not None:
+            self.stages.to_csv(path)
+        return self.stages.to_frame()
+
+    @staged('retrieve_data')
+    def retrieve_data(self, checkpoint_name=None):
+        '''data_dic is a LazyDataDic: tables are only read from the checkpoint when first used.
+        Without a checkpoint_name the parameter-keyed cache in cache_dir is used (see cached_checkpoint).
+        A checkpoint URL is read through its local cache: the data_dic tables are fetched up front (concurrently), 
+        any other table when first used'''
+        if checkpoint_name is not None and is_remote_checkpoint(checkpoint_name):
+            remote = self.remote_checkpoint(checkpoint_name, reopen=True)
+            remote.fetch(DATA_DIC_TABLES + ['sp500_used_offsets'])
+            self.checkpoint_name = checkpoint_name
+            self.data_dic = LazyDataDic(remote.local_dir, remote=remote)
+            self.stages.set_output(nbytes=checkpoint_bytes(remote.local_dir))
+            return
+        if checkpoint_name is None:
+            checkpoint_name = self.cached_checkpoint()
+        else:
+            # checked under the lock: another process may have just built it
+            with checkpoint_lock(self.checkpoint_path(checkpoint_name)):
+                if not self.check_checkpoint(checkpoint_name):
+                    self.prepare_data(self.start_date, checkpoint_name)
+                else:
+                    self._warn_if_stale(checkpoint_name)
+        self.checkpoint_name = checkpoint_name
+
+        self.data_dic = LazyDataDic(self.checkpoint_path(checkpoint_name), train_end_date=self._reader_split(checkpoint_name))
+        self.stages.set_output(nbytes=checkpoint_bytes(self.checkpoint_path(checkpoint_name)))
+
+    def _reader_split(self, checkpoint_name):
+        '''split date of a reader of checkpoint_name: its own train_end_date in the shared cache, where another reader
+        may re-split the checkpoint at its date while this one reads (see LazyDataDic), else the stored split'''
+        in_cache = os.path.dirname(os.path.normpath(checkpoint_name)) == os.path.normpath(self.cache_dir)
+        return self.train_end_date if in_cache else None
+
+    def _warn_if_stale(self, checkpoint_name):
+        built = (read_checkpoint_manifest(self.checkpoint_path(checkpoint_name)) or {}).get('build', {})
+        current = json.loads(json.dumps({**self.build_params(), 'train_end_date': self.train_end_date}, default=str))
+        changed = [x for x in current if x in built and built[x] != current[x]]
+        if changed:
+            print(f'Warning: {checkpoint_name} was built with different {", ".join(changed)} than requested, '
+                  'its data does not match the current settings (use a new checkpoint name, or retrieve_data() '
+                  'without a name to use the parameter-keyed cache)')
+
+    @staged('cached_checkpoint')
+    def cached_checkpoint(self):
+        '''path of the checkpoint for the current build parameters in cache_dir (cache_dir/<checkpoint_key>):
+        - built if it does not exist yet (or was refreshed / built with other parameters since)
+        - re-split if only train_end_date differs from the cached one (readers of the other split date keep their
+          own split, see LazyDataDic)
+        - least recently used checkpoints beyond max_cached_checkpoints / max_cache_bytes are evicted afterwards'''
+        if self.checkpoint_format != 'arrow':
+            raise ValueError("the checkpoint cache needs the manifest of checkpoint_format='arrow'")
+        key = checkpoint_key(self.build_params())
+        checkpoint_name = os.path.join(self.cache_dir, key)
+        cache_dir = os.path.join(self.dir, self.cache_dir)
+        os.makedirs(cache_dir, exist_ok=True)
+        # workers sharing the cache wait for each other: the first one builds, the others find the result
+        with checkpoint_lock(self.checkpoint_path(checkpoint_name)):
+            manifest = read_checkpoint_manifest(self.checkpoint_path(checkpoint_name))
+            if manifest is not None and manifest.get('build', {}).get('key') != key:
+                print (f'Cached checkpoint {key} was refreshed or built with other parameters, rebuilding..')
+                manifest = None
+            if manifest is None:
+                print (f'No cached checkpoint for these parameters, building {checkpoint_name}..')
+                # a folder without manifest is an old-style (pickle) checkpoint
+                shutil.rmtree(self.checkpoint_path(checkpoint_name), ignore_errors=True)
+                self.prepare_data(self.start_date, checkpoint_name)
+            elif manifest['build'].get('train_end_date') != self.train_end_date:
+                print (f'Re-split cached checkpoint {key} at {self.train_end_date}..')
+                self.resplit_checkpoint(checkpoint_name)
+            else:
+                print (f'Using cached checkpoint {key}')
+            touch_checkpoint(self.checkpoint_path(checkpoint_name))
+            # pinned before the lock is released, so no other process evicts it before it is read
+            self._pin(self.checkpoint_path(checkpoint_name))
+        evict_checkpoints(cache_dir, self.max_cached_checkpoints, self.max_cache_bytes, keep=[key])
+        return checkpoint_name
+
+    @staged('resplit_checkpoint')
+    @locked
+    def resplit_checkpoint(self, checkpoint_name):
+        '''move the train/test split of a stored (columnar) checkpoint to self.train_end_date and redo the permno-ticker 
+        maps, without rebuilding the panel: only the row ranges in the manifest change. A checkpoint that still stores 
+        the split tables (built before sp500_used was kept date-sorted) is converted to the date-sorted layout first'''
+        checkpoint_dir = self.checkpoint_path(checkpoint_name)
+        manifest = read_checkpoint_manifest(checkpoint_dir)
+        if manifest is None:
+            raise ValueError(f'{checkpoint_name} is a pickle checkpoint, run convert_checkpoint first')
+
+        if 'sp500_used_offsets' not in manifest['tables']:
+            print (f'Sort sp500_used of {checkpoint_name} by date..')
+            if manifest['tables']['sp500_used']['kind'] == 'arrow_partitioned':
+                sp500_used_offsets = sort_partitioned_by_date(checkpoint_dir, 'sp500_used', manifest)
+            else:
+                sp500_used = load_checkpoint_table(checkpoint_dir, 'sp500_used', manifest=manifest)\
+                    .sort_values(by='date', kind='stable').reset_index(drop=True)
+                save_checkpoint_table(sp500_used, checkpoint_dir, 'sp500_used', manifest)
+                sp500_used_offsets = date_offsets(sp500_used['date'])
+                del sp500_used
+            save_checkpoint_table(sp500_used_offsets, checkpoint_dir, 'sp500_used_offsets', manifest)
+            permno_tables = permno_index(load_checkpoint_table(checkpoint_dir, 'sp500_used', columns=['permno'], manifest=manifest)['permno'])
+            for table_name, table in zip(PERMNO_INDEX_TABLES, permno_tables):
+                save_checkpoint_table(table, checkpoint_dir, table_name, manifest)
+        else:
+            sp500_used_offsets = load_checkpoint_table(checkpoint_dir, 'sp500_used_offsets', manifest=manifest)
+        # the split tables are views now (also of a checkpoint that was converted but still stores copies of them)
+        for table_name in SPLIT_VIEWS:
+            remove_checkpoint_table(checkpoint_dir, table_name, manifest)
+
+        mkt_offsets = date_offsets(load_checkpoint_table(checkpoint_dir, 'mkt_daily', columns=[], manifest=manifest).index)
+        manifest['splits'] = split_views(sp500_used_offsets, mkt_offsets, self.train_end_date)
+        train = manifest['splits']['views']['train_sp500']
+        ticker_permno_dic, permno_ticker_dic = {}, {}
+        update_ticker_maps(load_checkpoint_table(checkpoint_dir, 'sp500_used', columns=['ticker','permno'], manifest=manifest,
+                                                  rows=slice(train['start'], train['stop'])),
+                           ticker_permno_dic, permno_ticker_dic)
+        save_checkpoint_table(ticker_permno_dic, checkpoint_dir, 'ticker_permno_dic', manifest)
+        save_checkpoint_table(permno_ticker_dic, checkpoint_dir, 'permno_ticker_dic', manifest)
+        manifest.setdefault('build', {})['train_end_date'] = self.train_end_date
+        write_checkpoint_manifest(checkpoint_dir, manifest)
+
+    def load_table(self, table_name, columns=None, start_date=None, end_date=None):
+        '''load a single table (optionally only some columns / a date range) from the current checkpoint'''
+        return self.data_dic.load(table_name, columns=columns, start_date=start_date, end_date=end_date)
+
+    def panel_tensor(self, checkpoint_name=None):
+        '''the dense (date, permno, feature) tensor of a columnar checkpoint (see PanelTensor), built from the stored 
+        sp500_used first if the checkpoint has none'''
+        checkpoint_name = checkpoint_name or self.checkpoint_name
+        manifest = read_checkpoint_manifest(self.checkpoint_path(checkpoint_name))
+        if manifest is None:
+            raise ValueError(f'{checkpoint_name} is a pickle checkpoint, run convert_checkpoint first')
+        if 'tensor' in manifest:
+            checkpoint_dir = self._local_checkpoint(checkpoint_name, [], tensor=True)
+        else:
+            checkpoint_dir = self._local_checkpoint(checkpoint_name, ['sp500_used', 'sp500_used_offsets', 'data_useful_info_dic'])
+            if 'sp500_used_offsets' not in manifest['tables']:
+                raise ValueError(f'sp500_used of {checkpoint_name} is not sorted by date, run resplit_checkpoint first')
+            self._save_panel_tensor(checkpoint_dir, manifest, load_checkpoint_table(checkpoint_dir, 'sp500_used_offsets', manifest=manifest))
+            write_checkpoint_manifest(checkpoint_dir, manifest)
+        return PanelTensor(checkpoint_dir, manifest)
+
+    def identifier_index(self, checkpoint_name=None):
+        '''time-aware ticker / ncusip / gvkey <-> permno lookups of a checkpoint (see IdentifierIndex)'''
+        checkpoint_name = checkpoint_name or self.checkpoint_name
+        checkpoint_dir = self._local_checkpoint(checkpoint_name, ['identifier_index'])
+        manifest = read_checkpoint_manifest(checkpoint_dir)
+        if not os.path.exists(os.path.join(checkpoint_dir, 'identifier_index.pkl')) and 'identifier_index' not in (manifest or {}).get('tables', {}):
+            raise ValueError(f'{checkpoint_name} was built without the identifier index, refresh it with update_checkpoint')
+        return IdentifierIndex(load_checkpoint_table(checkpoint_dir, 'identifier_index', manifest=manifest))
+
+    def query(self, checkpoint_name=None):
+        '''indexed cross-section / history / as-of queries on the sp500_used of a columnar checkpoint (see PanelQuery)'''
+        return PanelQuery(self._local_checkpoint(checkpoint_name, ['sp500_used', 'sp500_used_offsets'] + PERMNO_INDEX_TABLES))
+
+    def serve_checkpoint(self, checkpoint_name=None, table_names=SHARED_TABLES):
+        '''load a checkpoint into shared memory for worker processes (see CheckpointServer): pass server.descriptor
+        to the workers, which call attach(descriptor), and close the server when they are done'''
+        checkpoint_name = checkpoint_name or self.checkpoint_name
+        # a checkpoint URL: the served tables are fetched as they are read
+        remote = self.remote_checkpoint(checkpoint_name) if is_remote_checkpoint(checkpoint_name) else None
+        return CheckpointServer(self.checkpoint_path(checkpoint_name), table_names, self._reader_split(checkpoint_name), remote=remote)
+
+    def attach(self, descriptor):
+        '''use a checkpoint served by another process: data_dic holds the shared tables, read-only and not copied'''
+        self.data_dic = attach_checkpoint(descriptor)
+        self.checkpoint_name = os.path.basename(descriptor['checkpoint_dir'])
+
+    def walk_forward(self, first_train_end, test_months=12, train_months=None, step_months=None, columns=None):
+        '''walk-forward folds of the current checkpoint (see walk_forward_folds). Yields (fold, train_sp500, test_sp500, 
+        train_mkt, test_mkt) per fold, the tables as views of sp500_used (or of its `columns`) and mkt_daily'''
+        sp500_used = self.data_dic.load('sp500_used', columns=columns)
+        if 'sp500_used_offsets' in (self.data_dic.manifest or {}).get('tables', {}):
+            sp500_used_offsets = load_checkpoint_table(self.data_dic.checkpoint_dir, 'sp500_used_offsets', manifest=self.data_dic.manifest)
+        else:
+            dates = self.data_dic.load('sp500_used', columns=['date'])['date']
+            if not dates.is_monotonic_increasing:
+                raise ValueError(f'sp500_used of {self.checkpoint_name} is not sorted by date, run resplit_checkpoint first')
+            sp500_used_offsets = date_offsets(dates)
+        mkt_daily = self.data_dic['mkt_daily']
+        mkt_offsets = date_offsets(mkt_daily.index)
+        for fold in walk_forward_folds(sp500_used_offsets, first_train_end, test_months=test_months,
+                                       train_months=train_months, step_months=step_months):
+            yield (fold, sp500_used.iloc[fold['train']], sp500_used.iloc[fold['test']],
+                   mkt_daily.iloc[row_range(mkt_offsets, after=fold['train_after'], through=fold['train_end'])],
+                   mkt_daily.iloc[row_range(mkt_offsets, after=fold['train_end'], through=fold['test_end'])])
+
+    def plot_profile(self, checkpoint_name=None):
+        '''draw the data check plots of a built checkpoint from its stored profile'''
+        checkpoint_name = checkpoint_name or self.checkpoint_name
+        render_profile(load_profile(self._local_checkpoint(checkpoint_name, PROFILE_TABLES)), 'sp500_used')
+
+    @staged('prepare_data')
+    @locked
+    def prepare_data(self, start_date, checkpoint_name):
+        if self.streaming:
+            return self._prepare_data_streaming(start_date, checkpoint_name)
+
+        '''establish connection'''
+        source = (self.source or WrdsYahooSource()).connect()
+
+        raw = self._fetch_raw(source, char_since=start_date, daily_since=start_date, mkt_since='1990-01-01',
+                              tsy_since='2000-01-01')
+        # before the identifier joins, which close the open name / link intervals at today
+        identifier_index = identifier_intervals(raw['mse'], raw['ccm'], permnos=raw['sp500_daily']['permno'].unique())
+        panel = self._build_security_panel(raw)
+        panel['identifier_index'] = identifier_index
+        self.cleaning_log = panel['cleaning_log']
+
+        print ('Profile sp500_used..')
+        with self.stages.stage('profile', inputs=panel['sp500_used']) as stage:
+            panel['profile'] = profile_panel(panel['sp500_used'], panel['data_useful_info_dic']['numerical_columns'])
+            stage['outputs'] = data_size(panel['profile'])
+        if self.show_plots:
+            # plot checking resulting data
+            print ('S&P data plot after processing..')
+            render_profile(panel['profile'], 'sp500_used')
+
+        mkt_daily, mkt_state = self._build_market_data(raw, tsy_start='2000-01-01')
+        if self.show_plots:
+            print ('Mkt data plot..')
+            mkt_daily[['return_sp','tsy10yr','tsy2yr','tsy5yr']].plot(title='Market Data Plot')
+            plt.show()
+
+        '''save data'''
+        # Save this data locally for later use
+        print ('Saving data..')
+        build_dir = f'{self.checkpoint_path(checkpoint_name)}.building'
+        shutil.rmtree(build_dir, ignore_errors=True)
+        os.makedirs(build_dir)
+        self._save_checkpoint(build_dir, panel, mkt_daily, mkt_state)
+        publish_checkpoint(build_dir, self.checkpoint_path(checkpoint_name))
+
+    @staged('update_checkpoint')
+    @locked
+    def update_checkpoint(self, checkpoint_name, end_date=None):
+        '''refresh an existing (columnar) checkpoint with the data published since it was built, without a full rebuild:
+        - only daily rows on/after the refresh point and characteristics from the last stored eom onward are queried
+        - the tail is recomputed with the stored rows it needs as context (the last rolling-window rows per permno 
+          and the last cleaned value for the forward fill), then appended and the train/test split is redone
+        - market data is fetched from the last stored date and continued from the stored running state
+        the refresh point is the earlier of the day after the last stored date and the last stored eom, so rows whose 
+        characteristics could change with a newly published month are recomputed too. The result matches a full 
+        rebuild (the rolling sums up to floating-point rounding, since their cumulative sums start at the context)'''
+        checkpoint_dir = self.checkpoint_path(checkpoint_name)
+        manifest = read_checkpoint_manifest(checkpoint_dir)
+        if manifest is None:
+            raise ValueError(f'{checkpoint_name} is a pickle checkpoint, run convert_checkpoint first')
+        self.end_date = end_date or pd.Timestamp('today').strftime('%Y-%m-%d')
+        self.checkpoint_name = checkpoint_name
+        stored = LazyDataDic(checkpoint_dir, table_names=list(manifest['tables']))
+
+        sp500_used_old = stored['sp500_used']
+        char_data_old = stored['char_data']
+        last_date = sp500_used_old['date'].max()
+        last_eom = pd.to_datetime(char_data_old['eom']).max()
+        refresh_from = min(last_date + pd.Timedelta(days=1), last_eom)
+        print (f'Refreshing {checkpoint_name} from {refresh_from.date()} (last stored date {last_date.date()})..')
+
+        mkt_old = load_checkpoint_table(checkpoint_dir, 'mkt_daily', manifest=manifest)
+        mkt_state = manifest.get('mkt_state')
+        # checkpoints built before the market state was recorded get their (small) market table rebuilt
+        mkt_since = (mkt_old.index.max() + pd.Timedelta(days=1)).strftime('%Y-%m-%d') if mkt_state else '1990-01-01'
+        tsy_since = mkt_since if mkt_state else '2000-01-01'
+
+        source = (self.source or WrdsYahooSource()).connect()
+        raw = self._fetch_raw(source, char_since=last_eom.strftime('%Y-%m-%d'), daily_since=refresh_from.strftime('%Y-%m-%d'),
+                              mkt_since=mkt_since, tsy_since=tsy_since)
+        raw['char_data'] = pd.concat([char_data_old[pd.to_datetime(char_data_old['eom']) < last_eom], raw['char_data']],
+                                     ignore_index=True)
+
+        # rows before the refresh point that the tail needs: the rolling windows and the forward-filled cleaning state
+        n_context = max([n - 1 for n in self.daily_metric_windows.values()] + [1])
+        keep_old = (sp500_used_old['date'] < refresh_from).to_numpy()
+        context = sp500_used_old[keep_old].groupby('permno').tail(n_context)
+        identifier_index = identifier_intervals(raw['mse'], raw['ccm'], 
+                                                permnos=np.union1d(sp500_used_old['permno'].unique(), raw['sp500_daily']['permno'].unique()))
+        panel = self._build_security_panel(raw, panel_start=sp500_used_old['date'].min(), context=context, verbose=False)
+        panel['identifier_index'] = identifier_index
+        self.cleaning_log = panel['cleaning_log']
+
+        print ('Append refreshed rows..')
+        for table_name in ['sp500_crsp', 'sp500_crsp_ccm', 'sp500_comb', 'sp500_used']:
+            old = sp500_used_old[keep_old] if table_name == 'sp500_used' else stored[table_name]
+            old = old[(old['date'] < refresh_from).to_numpy()]
+            new = panel[table_name]
+            if table_name == 'sp500_comb':
+                new['index'] = new['index'] + old['index'].max() + 1
+            panel[table_name] = pd.concat([old, new], ignore_index=True)
+        panel['sp500_used'] = panel['sp500_used'].sort_values(by=['permno','date'], kind='stable').reset_index(drop=True)
+        if self.panel_dtypes is not None:
+            panel['sp500_used'] = compact_panel(panel['sp500_used'], self.panel_dtypes)
+        panel['char_data'] = raw['char_data']
+        panel['data_useful_info_dic'] = stored['data_useful_info_dic']
+        panel['profile'] = profile_panel(panel['sp500_used'], panel['data_useful_info_dic']['numerical_columns'])
+        stored.drop()
+
+        if mkt_state is None:
+            mkt_daily, mkt_state = self._build_market_data(raw, tsy_start=tsy_since)
+        else:
+            mkt_new, mkt_state = self._build_market_data(raw, tsy_start=tsy_since, mkt_state=mkt_state)
+            mkt_daily = pd.concat([mkt_old, mkt_new[mkt_old.columns]])
+
+        print ('Saving data..')
+        # written as a new checkpoint and swapped in: a streaming (partitioned) checkpoint becomes single-file tables, 
+        # and the split tables of a checkpoint built before the date-sorted layout are now views
+        build_dir = f'{checkpoint_dir}.building'
+        shutil.rmtree(build_dir, ignore_errors=True)
+        os.makedirs(build_dir)
+        self._save_checkpoint(build_dir, panel, mkt_daily, mkt_state)
+        publish_checkpoint(build_dir, checkpoint_dir)
+        self.data_dic = LazyDataDic(checkpoint_dir)
+
+    @staged('fetch_raw')
+    def _fetch_raw(self, source, char_since, daily_since, mkt_since, tsy_since, spill=None):
+        '''fetch the firm characteristics (eom >= char_since), the daily S&P500 constituent returns (date >= daily_since),
+        the msenames / CCM link tables, the S&P500 index (from mkt_since) and treasury yields (from tsy_since).
+        The fetches are independent, so they run concurrently (self.max_workers threads) with retries.
+        spill: (part_starts, spill_dir) to read the characteristics and daily returns in chunks and spill them by permno
+        partition instead of returning them (raw then holds the rows spilled per partition)'''
+        print ('Downloading the JKP data (Firm Characteristic Data) from WRDS...')
+        print ('Get S&P constituents in-index date range and respective return..')
+        print ('Get Identifier and Descriptive Data From CRSP and Compustat for merges..')
+        print ('Retrieve market level data (S&P and Treasury data)..')
+        if spill is None:
+            tasks = {'char_data': lambda: source.char_data(self.char_chosen, char_since),
+                     'sp500_daily': lambda: source.sp500_daily(daily_since)}
+        else:
+            part_starts, spill_dir = spill
+            tasks = {'char_data': lambda: spill_by_permno(source.char_data(self.char_chosen, char_since, chunksize=self.chunksize),
+                                                          part_starts, os.path.join(spill_dir, 'char_data')),
+                     'sp500_daily': lambda: spill_by_permno(source.sp500_daily(daily_since, chunksize=self.chunksize),
+                                                            part_starts, os.path.join(spill_dir, 'sp500_daily'))}
+        tasks.update({'mse': source.msenames,
+                      'ccm': source.ccm_links,
+                      'sp500_mkt': lambda: source.market_series('^GSPC', mkt_since, self.end_date)})
+        for bond, ticker in TREASURY_TICKERS.items():
+            tasks[bond] = lambda ticker=ticker: source.market_series(ticker, tsy_since, self.end_date)
+        raw = fetch_concurrently(tasks, max_workers=self.max_workers, retries=self.fetch_retries)
+
+        if spill is None:
+            raw['char_data'] = to_plain_float(raw['char_data'])
+            #IN: added to make sure types are 'float64' instead of 'Float64'
+        return raw
+
+    @staged('link_identifiers')
+    def _link_identifiers(self, sp500_daily, mse, ccm):
+        '''attach the msenames names and the CCM gvkey links valid on each date; returns sp500_crsp, sp500_crsp_ccm'''
+        # if nameendt is missing then set to today date
+        mse['nameendt']=mse['nameendt'].fillna(pd.to_datetime('today'))
+
+        # Merge with SP500 universe data, keeping the name record valid on each date
+        sp500_crsp = interval_join(sp500_daily, mse, by='permno', on='date', start='namedt', end='nameendt')
+
         # if linkenddt is missing then set to today date
         ccm['linkenddt']=ccm['linkenddt'].fillna(pd.to_datetime('today'))
 
-        # Merge the CCM data with S&P500 data
-        # First just link by matching PERMNO
-        sp500_crsp_ccm = pd.merge(sp500_crsp, ccm, how='left', on=['permno'])
-
-        # Then set link date bounds
-        sp500_crsp_ccm = sp500_crsp_ccm.loc[(sp500_crsp_ccm['date']>=sp500_crsp_ccm['linkdt'])\
-                                &(sp500_crsp_ccm['date']<=sp500_crsp_ccm['linkenddt'])]
-        sp500_crsp_ccm = sp500_crsp_ccm.apply(lambda x: x.astype(float) if x.dtype=='Float64' else x, axis=0)
+        # Merge the CCM data with S&P500 data: match PERMNO and the link date bounds in one pass
+        sp500_crsp_ccm = interval_join(sp500_crsp, ccm, by='permno', on='date', start='linkdt', end='linkenddt')
+        sp500_crsp_ccm = to_plain_float(sp500_crsp_ccm)
         #IN: added to make sure types are 'float64' instead of 'Float64'
+        return sp500_crsp, sp500_crsp_ccm
+
+    @staged('build_security_panel')
+    def _build_security_panel(self, raw, panel_start=None, context=None, verbose=True):
+        '''merge the queried tables into sp500_used and add the daily metrics / cleaning.
+        raw: the fetched tables; if it already holds sp500_crsp_ccm (streaming build) the identifier joins are skipped
+        panel_start: first date of the full panel (characteristics before it are ignored), by default the first date 
+        of sp500_crsp_ccm
+        context: stored sp500_used rows that precede raw['sp500_daily'] (incremental refresh); they feed the rolling
+        windows and forward fills and are dropped from the result'''
+        char_data = raw['char_data']
+        char_chosen = self.char_chosen
+
+        if 'sp500_crsp_ccm' in raw:
+            sp500_crsp, sp500_crsp_ccm = raw.get('sp500_crsp'), raw['sp500_crsp_ccm']
+        else:
+            sp500_crsp, sp500_crsp_ccm = self._link_identifiers(raw['sp500_daily'], raw['mse'], raw['ccm'])
+        if panel_start is None:
+            panel_start = sp500_crsp_ccm['date'].min()
 
         '''Merge S&P500 Universe CRSP, Compustat Data with Firm Characteristic data'''
         print ('Merge S&P500 Universe CRSP, Compustat Data with Firm Characteristic data..')
 
-        '''Prepare char_data to be merged'''
-        print ('preparing char_data to be merged')
-        # IN - get the index we need for char_data from sp500
-        sp500_crsp_ccm_adj = sp500_crsp_ccm.copy().drop_duplicates(subset=['date','permno'])
-        sp500_crsp_ccm_adj = sp500_crsp_ccm_adj.set_index(['date','permno'])
-        daily_index = pd.date_range(start=sp500_crsp_ccm_adj.index.get_level_values('date').min(),
-                                    end=sp500_crsp_ccm_adj.index.get_level_values('date').max(),
-                                    freq='D')
-        
-        # IN: Use sp500_crsp_ccm_adj's extended index with daily frequency (note not BD) to reindex char_data
-        char_data_adj = char_data.copy()[['permno','eom']+char_chosen+['ret_exc_lead1m']].dropna(subset=['permno'])
-        char_data_adj['date'] = pd.to_datetime(char_data_adj['eom'])
-
-        char_data_adj = char_data_adj.set_index(['date','permno'])\
-            .reindex(pd.MultiIndex.from_product([daily_index, sp500_crsp_ccm_adj.index.get_level_values('permno').unique()],
-                                                                    names=['date','permno']))\
-                                                                    .groupby('permno').ffill().reset_index()
-        
-        '''Merge sp500 data with reindexed firm characteristic data'''
-        print ('Merge sp500 data with prepared firm characteristic data...')    
-        sp500_comb = pd.merge(sp500_crsp_ccm, char_data_adj, on=['date','permno'], how='left').sort_values(by=['permno','date']).reset_index()
+        '''Attach the latest monthly firm characteristics to each daily row (as-of join on eom)'''
+        print ('Merge sp500 data with firm characteristic data as of each date...')
+        with self.stages.stage('char_asof_join', inputs=[sp500_crsp_ccm, char_data]) as stage:
+            sp500_comb = asof_join_characteristics(sp500_crsp_ccm, char_data, char_chosen+['ret_exc_lead1m'],
+                                                   start_date=panel_start,
+                                                   max_staleness=self.char_max_staleness, n_jobs=self.n_jobs)\
+                                                   .sort_values(by=['permno','date']).reset_index()
+            stage['outputs'] = data_size(sp500_comb)
 
         '''prepare data to be used for analysis'''
         print ('Prepare data to be used for later analysis..')
@@ -369,47 +3012,58 @@ class Data_NN:
         numerical_columns = [name_map[x] if x in name_map else x for x in char_chosen + ['ret','vol','ret_exc_lead1m']]
 
         sp500_used = sp500_comb[useful_columns].rename(columns=name_map).drop_duplicates(subset=['permno','date'])
+        if self.panel_dtypes is not None:
+            memory_before = memory_mb(sp500_used)
+            sp500_used = compact_panel(sp500_used, self.panel_dtypes)
+            print(f'sp500_used memory before / after compact dtypes: {memory_before:.1f} MB / {memory_mb(sp500_used):.1f} MB')
 
         '''initial check of data'''
-        prelim_check_data(sp500_used, 'sp500_used', checkpoint_name=None)
+        if verbose and self.show_plots:
+            prelim_check_data(sp500_used, 'sp500_used', checkpoint_name=None)
+
+        if context is not None:
+            n_new = len(sp500_used)
+            sp500_used = pd.concat([context[sp500_used.columns], sp500_used], ignore_index=True)\
+                .sort_values(by=['permno','date'], kind='stable')
+            is_new = (sp500_used.index >= len(context))
+            sp500_used = sp500_used.reset_index(drop=True)
 
         '''add selective daily metrics'''
         print ('Add selective daily metrics..')
-        ## calculating the daily metrics
-        ret_12m_d = sp500_used.set_index(['permno','date'])['return']\
-            .groupby('permno').apply(lambda x: (x.rolling(21*12).sum()).droplevel(0)).rename('ret_12m_d').reset_index()
-
-        ret_6m_d = sp500_used.set_index(['permno','date'])['return']\
-            .groupby('permno').apply(lambda x: (x.rolling(21*6).sum()).droplevel(0)).rename('ret_6m_d').reset_index()
-
-        ret_3m_d = sp500_used.set_index(['permno','date'])['return']\
-            .groupby('permno').apply(lambda x: (x.rolling(21*3).sum()).droplevel(0)).rename('ret_3m_d').reset_index()
-
-        ret_1m_d = sp500_used.set_index(['permno','date'])['return']\
-            .groupby('permno').apply(lambda x: (x.rolling(21).sum()).droplevel(0)).rename('ret_1m_d').reset_index()
-
-        ## adding them to sp500 data set
         print(f'sp500_used shape before adding daily metrics: {sp500_used.shape}')
-        for data_d in [ret_12m_d, ret_6m_d, ret_3m_d, ret_1m_d]:
-            sp500_used = pd.merge(sp500_used, data_d, on=['permno','date'], how='left')
+        with self.stages.stage('rolling_metrics', inputs=sp500_used) as stage:
+            daily_metric_columns = rolling_group_metrics(sp500_used, self.daily_metric_windows,
+                                                         reducers=self.daily_metric_reducers, n_jobs=self.n_jobs)
+            stage['outputs'] = data_size(sp500_used[daily_metric_columns])
         print(f'sp500_used shape after adding daily metrics: {sp500_used.shape}')
 
         ## update numerical columns to include the new daily metrics
-        numerical_columns = numerical_columns + ['ret_12m_d','ret_6m_d','ret_3m_d','ret_1m_d']
+        numerical_columns = numerical_columns + daily_metric_columns
 
         '''Further data cleaning'''
         print ('Further data cleaning..')
-        print ('Clean outliers based on preliminary checks (on operating profit on book equity)..')
+        print (f'Clean outliers based on preliminary checks (on {", ".join(self.cleaning_rules)})..')
 
         print(f'sp500_used shape before outlier cleanng: {sp500_used.shape}')
         
-        abnormal_threshold = 30 
-        sp500_used.loc[sp500_used['opt_to_book_eq']>abnormal_threshold, 'opt_to_book_eq'] = np.nan
-        temp_ffill = sp500_used.set_index(['permno','date'])['opt_to_book_eq'].groupby('permno').ffill().reset_index()
-        sp500_used = pd.merge(sp500_used.drop(columns=['opt_to_book_eq']), temp_ffill, on=['permno','date'], how='left')
+        with self.stages.stage('clean_outliers', inputs=sp500_used) as stage:
+            sp500_used = sp500_used.reset_index(drop=True)
+            # context rows of a refresh were cleaned when they were stored, they only feed the forward fill
+            cleaning_log = clean_panel(sp500_used, self.cleaning_rules, rows=is_new if context is not None else None,
+                                       n_jobs=self.n_jobs)
+            print('Values changed by each cleaning rule:\n' + cleaning_log.to_string(index=False))
+            stage['outputs'] = data_size(sp500_used)
 
         print(f'sp500_used shape after outlier cleanng: {sp500_used.shape}')
 
+        if context is not None:
+            sp500_used = sp500_used[is_new].reset_index(drop=True)
+            assert len(sp500_used) == n_new
+
+        if self.panel_dtypes is not None:
+            # the daily metrics / cleaned column come back as float64, and concatenating with the context drops categories
+            sp500_used = compact_panel(sp500_used, self.panel_dtypes)
+
         # Packing important inputs for later analysis for saving
         data_useful_info_dic={}
 
@@ -420,124 +3074,236 @@ class Data_NN:
         data_useful_info_dic['categorical_columns'] = categorical_columns
         data_useful_info_dic['numerical_columns'] = numerical_columns
 
-        # plot checking resulting data
-        print ('S&P data plot after processing..')
-        block_distribution_plot(sp500_used, numerical_columns, 'Numerical Variables', n_per_row=4)
-        block_time_series_plot(sp500_used, numerical_columns, 'Numerical Variables', n_per_row=4)
-
-        # split train and test data
-        print ('Split train and test data - S&P500..')
-        train_sp500 = sp500_used[sp500_used['date']<=self.train_end_date]
-        test_sp500 = sp500_used[sp500_used['date']>self.train_end_date]
-
-        '''Retrieve market level info'''
-        print ('Retrieve market level data..')
-        print ('Retrieve S&P data..')
-        # Download S&P 500 historical data
-        sp500_mkt = yf.download('^GSPC', start='1990-01-01', end='2025-01-01')
-        sp500_mkt = sp500_mkt.droplevel(1, axis=1)
-        sp500_mkt.index = pd.to_datetime(sp500_mkt.index) #IN: to make sure it's datetime index
-
-        # Calculate daily returns
-        sp500_mkt['return'] = sp500_mkt['Close'].pct_change()
-        sp500_mkt = mmd_cal(sp500_mkt)
-
-        print('Retrieve Treasury data..')
-        # Treasury data
-        start_date_tsy = '2000-01-01'
-        end_time_tsy = '2025-01-01'
-
-        tickers = {
-            "tsy10yr": "^TNX",
-            "tsy5yr": "^FVX",
-            "tsy2yr": "^IRX"  # Note: ^IRX is for 13-week T-bills, but you can replace it with the appropriate 2-year ticker if available
-        }
-
-        # Fetch historical yield data
-        data = {}
-        for bond, ticker in tickers.items():
-            data[bond] = yf.download(ticker, start=start_date_tsy, end=end_time_tsy).droplevel(1, axis=1)["Close"]
+        return {'char_data': char_data,
+                'sp500_crsp': sp500_crsp,
+                'sp500_crsp_ccm': sp500_crsp_ccm,
+                'sp500_comb': sp500_comb,
+                'sp500_used': sp500_used,
+                'data_useful_info_dic': data_useful_info_dic,
+                'cleaning_log': cleaning_log}
+
+    @staged('market_data')
+    def _build_market_data(self, raw, tsy_start, mkt_state=None):
+        '''combine the fetched S&P500 index and treasury yields into mkt_daily; with mkt_state (the running state of a 
+        stored mkt_daily) the index metrics continue from it instead of starting over. Returns mkt_daily and its new state'''
+        sp500_mkt = raw['sp500_mkt'].copy()
+
+        # daily returns and drawdown metrics, continued from the stored state bar by bar
+        updater = MarketMetricsUpdater(mkt_state)
+        metrics = updater.append(sp500_mkt['Close'])
+        for column in metrics.columns:
+            sp500_mkt[column] = metrics[column]
+        mkt_state = updater.state
 
         # Combine data into a single DataFrame
-        yield_data = pd.DataFrame(data)
+        yield_data = pd.DataFrame({bond: raw[bond]["Close"] for bond in TREASURY_TICKERS})
         yield_data.index = pd.to_datetime(yield_data.index) 
 
         print('Combine market level data')
         mkt_daily = pd.concat([sp500_mkt\
                        .rename(columns=dict(zip(sp500_mkt.columns,
                                         [f'{x}_sp' for x in sp500_mkt.columns]))), 
-                                        yield_data/100], axis=1).loc[start_date_tsy:end_time_tsy,:]
-        print ('Mkt data plot..')
-        mkt_daily[['return_sp','tsy10yr','tsy2yr','tsy5yr']].plot(title='Market Data Plot')
-        plt.show()
+                                        yield_data/100], axis=1).loc[tsy_start:self.end_date,:]
+        return mkt_daily, mkt_state
 
-        # split market level data into train and test
-        print ('Split train and test data - Market data..')
-        train_mkt = mkt_daily.loc[:self.train_end_date,:]
-        test_mkt = mkt_daily.loc[self.train_end_date:,:]
+    @staged('save_checkpoint')
+    def _save_checkpoint(self, checkpoint_dir, panel, mkt_daily, mkt_state):
+        '''sort sp500_used by date, record the train/test splits, build the permno-ticker maps and write all tables 
+        of the checkpoint'''
+        sp500_used = panel['sp500_used']
 
         '''make permno-ticker maps'''
-        multi_index = train_sp500.set_index(['ticker','permno']).index.unique()
-        ticker_permno_dic = {item[0]:item[1] for item in multi_index}
-        permno_ticker_dic = {item[1]:item[0] for item in multi_index}
+        ticker_permno_dic, permno_ticker_dic = {}, {}
+        update_ticker_maps(sp500_used.loc[(sp500_used['date']<=self.train_end_date).to_numpy(), ['ticker','permno']],
+                           ticker_permno_dic, permno_ticker_dic)
+
+        # split train and test data: row ranges of the date-sorted panel / market data
+        print ('Split train and test data..')
+        panel['sp500_used'] = sp500_used = sp500_used.sort_values(by='date', kind='stable').reset_index(drop=True)
+        sp500_used_offsets = date_offsets(sp500_used['date'])
+        sp500_used_permno_offsets, sp500_used_permno_rows = permno_index(sp500_used['permno'])
+        splits = split_views(sp500_used_offsets, date_offsets(mkt_daily.index), self.train_end_date)
+
+        checkpoint_tables = {'char_data': panel['char_data'],
+                             'sp500_crsp': panel['sp500_crsp'],
+                             'sp500_crsp_ccm': panel['sp500_crsp_ccm'],
+                             'sp500_comb': panel['sp500_comb'],
+                             'sp500_used': sp500_used,
+                             'sp500_used_offsets': sp500_used_offsets,
+                             'sp500_used_permno_offsets': sp500_used_permno_offsets,
+                             'sp500_used_permno_rows': sp500_used_permno_rows,
+                             'data_useful_info_dic': panel['data_useful_info_dic'],
+                             'mkt_daily': mkt_daily,
+                             'ticker_permno_dic': ticker_permno_dic,
+                             'permno_ticker_dic': permno_ticker_dic,
+                             'identifier_index': panel['identifier_index']}
+        manifest = {'build': self._build_record(), 'mkt_state': mkt_state}
+        if self.checkpoint_format == 'arrow':
+            manifest['splits'] = splits
+        else:
+            # pickle checkpoints have no manifest and keep the split tables
+            for view_name, view in splits['views'].items():
+                checkpoint_tables[view_name] = checkpoint_tables[view['table']].iloc[view['start']:view['stop']]
+        for table_name, table in checkpoint_tables.items():
+            save_checkpoint_table(table, checkpoint_dir, table_name, manifest, self.checkpoint_format)
+        save_profile(panel['profile'], checkpoint_dir, manifest, self.checkpoint_format)
+        if self.checkpoint_format == 'arrow':
+            if self.build_tensor:
+                self._save_panel_tensor(checkpoint_dir, manifest, sp500_used_offsets,
+                                        read_columns=lambda names: sp500_used[names])
+            write_checkpoint_manifest(checkpoint_dir, manifest)
+        self.stages.set_output(rows=len(sp500_used), nbytes=checkpoint_bytes(checkpoint_dir))
+
+    @staged('panel_tensor')
+    def _save_panel_tensor(self, checkpoint_dir, manifest, sp500_used_offsets, read_columns=None):
+        '''build the dense tensor of the numerical columns of sp500_used and record it in the manifest; the columns are 
+        read from the stored (date-sorted) sp500_used unless read_columns is given'''
+        print ('Build the dense panel tensor..')
+        if read_columns is None:
+            read_columns = lambda names: load_checkpoint_table(checkpoint_dir, 'sp500_used', columns=names, manifest=manifest)
+        features = load_checkpoint_table(checkpoint_dir, 'data_useful_info_dic', manifest=manifest)['numerical_columns']
+        manifest['tensor'] = build_panel_tensor(os.path.join(checkpoint_dir, PANEL_TENSOR_DIR), read_columns,
+                                                sp500_used_offsets, features)
+        self.stages.set_output(nbytes=checkpoint_bytes(os.path.join(checkpoint_dir, PANEL_TENSOR_DIR)))
+
+    @staged('prepare_data_streaming')
+    def _prepare_data_streaming(self, start_date, checkpoint_name):
+        '''out-of-core version of prepare_data:
+        - the permnos are cut into partitions of self.partition_size (see permno_partitions)
+        - the daily returns and characteristics are read in chunks of self.chunksize rows and spilled to disk by partition
+        - the merges, forward fills, rolling metrics and outlier cleaning then run one partition at a time, and every 
+          panel table is written as one Arrow file per partition
+        - sp500_used is finally merged into one date-sorted file from the memory-mapped partitions
+        peak memory follows the partition size instead of the panel (plus the dates of the final sort). sp500_used and 
+        the train/test splits are the same as in the in-memory build; the intermediate tables (sp500_crsp, ...) are 
+        stored in partition order.
+        The checkpoint is built in a side folder and only renamed to checkpoint_name when complete. No plots are drawn;
+        the profile is combined from the partition profiles, with a last pass over sp500_used for the histograms'''
+        if self.checkpoint_format != 'arrow':
+            raise ValueError("the streaming build writes partitioned Arrow tables, use checkpoint_format='arrow'")
+        if any(rule['rule'] in CROSS_SECTIONAL_RULES for rules in self.cleaning_rules.values() for rule in rules):
+            raise ValueError(f'the streaming build cleans one permno partition at a time, {CROSS_SECTIONAL_RULES} rules '
+                             'need the whole cross-section of a date: use the in-memory build')
+        build_dir = f'{self.checkpoint_path(checkpoint_name)}.building'
+        spill_dir = os.path.join(build_dir, '_spill')
+        shutil.rmtree(build_dir, ignore_errors=True)
+        os.makedirs(spill_dir)
+
+        '''establish connection'''
+        source = (self.source or WrdsYahooSource()).connect()
+        part_starts = permno_partitions(source.sp500_permnos(), self.partition_size)
+        print (f'Streaming build: {len(part_starts)} partitions of up to {self.partition_size} permnos..')
+
+        raw = self._fetch_raw(source, char_since=start_date, daily_since=start_date, mkt_since='1990-01-01',
+                              tsy_since='2000-01-01', spill=(part_starts, spill_dir))
+        parts = np.flatnonzero(raw['sp500_daily'])
+        manifest = {'build': {**self._build_record(), 'partitions': len(part_starts)}}
+
+        # first pass: identifier joins, which also give the first date of the whole panel
+        identifier_index = identifier_intervals(raw['mse'], raw['ccm'])
+        panel_start, permnos = None, []
+        for part in parts:
+            print (f'Link identifiers - partition {part+1}/{len(part_starts)}..')
+            sp500_daily = read_spilled_partition(os.path.join(spill_dir, 'sp500_daily'), part)
+            permnos.append(sp500_daily['permno'].unique())
+            sp500_crsp, sp500_crsp_ccm = self._link_identifiers(sp500_daily, raw['mse'], raw['ccm'])
+            save_checkpoint_partition(sp500_crsp, build_dir, 'sp500_crsp', part, manifest)
+            save_checkpoint_partition(sp500_crsp_ccm, build_dir, 'sp500_crsp_ccm', part, manifest)
+            if len(sp500_crsp_ccm) and (panel_start is None or sp500_crsp_ccm['date'].min() < panel_start):
+                panel_start = sp500_crsp_ccm['date'].min()
+            del sp500_daily, sp500_crsp, sp500_crsp_ccm
+
+        identifier_index = identifier_index[identifier_index['permno'].isin(np.concatenate(permnos))].reset_index(drop=True)
+
+        # second pass: characteristics, daily metrics and cleaning per partition
+        ticker_permno_dic, permno_ticker_dic = {}, {}
+        comb_offset = 0
+        profiles, cleaning_logs = [], []
+        for part in range(len(part_starts)):
+            char_data = read_spilled_partition(os.path.join(spill_dir, 'char_data'), part)
+            char_data = to_plain_float(char_data)
+            save_checkpoint_partition(char_data, build_dir, 'char_data', part, manifest)
+            if part not in parts:
+                continue
+            print (f'Build sp500_used - partition {part+1}/{len(part_starts)}..')
+            sp500_crsp_ccm = feather.read_feather(os.path.join(build_dir, 'sp500_crsp_ccm', f'part-{part:05d}.feather'))
+            panel = self._build_security_panel({'char_data': char_data, 'sp500_crsp_ccm': sp500_crsp_ccm},
+                                               panel_start=panel_start, verbose=False)
+            # sp500_comb['index'] points at the rows of the (concatenated) sp500_crsp_ccm table
+            panel['sp500_comb']['index'] += comb_offset
+            comb_offset += len(sp500_crsp_ccm)
+            save_checkpoint_partition(panel['sp500_comb'], build_dir, 'sp500_comb', part, manifest)
+            save_checkpoint_partition(panel['sp500_used'], build_dir, 'sp500_used', part, manifest)
+
+            '''make permno-ticker maps'''
+            sp500_used = panel['sp500_used']
+            update_ticker_maps(sp500_used.loc[(sp500_used['date']<=self.train_end_date).to_numpy(), ['ticker','permno']],
+                               ticker_permno_dic, permno_ticker_dic)
+            data_useful_info_dic = panel['data_useful_info_dic']
+            cleaning_logs.append(panel['cleaning_log'])
+            profiles.append(profile_panel(sp500_used, data_useful_info_dic['numerical_columns'], bins=None))
+            del char_data, sp500_crsp_ccm, panel, sp500_used
+
+        self.cleaning_log = pd.concat(cleaning_logs).groupby(['column', 'rule'], sort=False, as_index=False)['changed'].sum()
+
+        # histograms on common bins (from the combined min / max), reading back the numerical columns partition by partition
+        print ('Profile sp500_used..')
+        with self.stages.stage('profile') as stage:
+            profile = combine_profiles(profiles)
+            edges = _histogram_edges(profile['columns'], data_useful_info_dic['numerical_columns'])
+            hists = [profile_histogram(feather.read_feather(os.path.join(build_dir, file_name), columns=list(edges)), edges)
+                     for file_name in manifest['tables']['sp500_used']['files']]
+            profile['hist'] = pd.concat(hists).groupby(['column', 'left', 'right'], sort=False, as_index=False)['count'].sum()
+            save_profile(profile, build_dir, manifest)
+            stage['outputs'] = data_size(profile)
+
+        # split train and test data: row ranges of the date-sorted panel / market data
+        print ('Sort sp500_used by date and split train and test data..')
+        with self.stages.stage('sort_by_date') as stage:
+            sp500_used_offsets = sort_partitioned_by_date(build_dir, 'sp500_used', manifest)
+            sp500_used_permno_offsets, sp500_used_permno_rows = permno_index(
+                load_checkpoint_table(build_dir, 'sp500_used', columns=['permno'], manifest=manifest)['permno'])
+            stage['outputs'] = (manifest['tables']['sp500_used']['rows'], manifest['tables']['sp500_used']['bytes'])
+        mkt_daily, mkt_state = self._build_market_data(raw, tsy_start='2000-01-01')
+        manifest['mkt_state'] = mkt_state
+        manifest['splits'] = split_views(sp500_used_offsets, date_offsets(mkt_daily.index), self.train_end_date)
 
         '''save data'''
-        # Save this data locally for later use
         print ('Saving data..')
-        os.mkdir(checkpoint_name)
-        with open(f'./{checkpoint_name}/char_data.pkl','wb') as f:
-            pickle.dump(char_data, f)
-        
-        with open(f'./{checkpoint_name}/sp500_crsp.pkl','wb') as f:
-            pickle.dump(sp500_crsp, f)
-
-        with open(f'./{checkpoint_name}/sp500_crsp_ccm.pkl','wb') as f:
-            pickle.dump(sp500_crsp_ccm, f)
-
-        with open(f'./{checkpoint_name}/sp500_comb.pkl','wb') as f:
-            pickle.dump(sp500_comb, f)
-
-        with open(f'./{checkpoint_name}/sp500_used.pkl','wb') as f:
-            pickle.dump(sp500_used, f)
-        
-        with open(f'./{checkpoint_name}/data_useful_info_dic.pkl','wb') as f:
-            pickle.dump(data_useful_info_dic, f)
-
-        with open(f'./{checkpoint_name}/mkt_daily.pkl','wb') as f:
-            pickle.dump(mkt_daily, f)
-
-        with open(f'./{checkpoint_name}/train_sp500.pkl','wb') as f:
-            pickle.dump(train_sp500, f)
-
-        with open(f'./{checkpoint_name}/test_sp500.pkl','wb') as f:
-            pickle.dump(test_sp500, f)
-
-        with open(f'./{checkpoint_name}/train_mkt.pkl','wb') as f:
-            pickle.dump(train_mkt, f)
-
-        with open(f'./{checkpoint_name}/test_mkt.pkl','wb') as f:
-            pickle.dump(test_mkt, f)
-
-        with open(f'./{checkpoint_name}/ticker_permno_dic.pkl','wb') as f:
-            pickle.dump(ticker_permno_dic, f)
-
-        with open(f'./{checkpoint_name}/permno_ticker_dic.pkl','wb') as f:
-            pickle.dump(permno_ticker_dic, f)
+        for table_name, table in {'sp500_used_offsets': sp500_used_offsets,
+                                  'sp500_used_permno_offsets': sp500_used_permno_offsets,
+                                  'sp500_used_permno_rows': sp500_used_permno_rows,
+                                  'data_useful_info_dic': data_useful_info_dic,
+                                  'mkt_daily': mkt_daily,
+                                  'ticker_permno_dic': ticker_permno_dic,
+                                  'permno_ticker_dic': permno_ticker_dic,
+                                  'identifier_index': identifier_index}.items():
+            save_checkpoint_table(table, build_dir, table_name, manifest)
+        if self.build_tensor:
+            self._save_panel_tensor(build_dir, manifest, sp500_used_offsets)
+        write_checkpoint_manifest(build_dir, manifest)
+        shutil.rmtree(spill_dir)
+        self.stages.set_output(rows=manifest['tables']['sp500_used']['rows'], nbytes=checkpoint_bytes(build_dir))
+        publish_checkpoint(build_dir, self.checkpoint_path(checkpoint_name))
 
 # %% [markdown]
 # ### Execution Main
 
 # %%
-def data_main(data_directory, data_checkpoint_name, start_date, train_end_date, verbose=True):
+def data_main(data_directory, data_checkpoint_name, start_date, train_end_date, verbose=True, shared=None):
     # data_directory = r'C:\Mine\U.S.-2019\NPB living - 2 - related\School-part time\Berkeley-202308\MIDS classes\210-Capstone\Project-related\code-IN/data-used'
     # data_checkpoint_name = 'data_checkpoint1'
     # start_date = '2000-01-01'
+    # shared: descriptor of a CheckpointServer (worker processes attach to it instead of reading the checkpoint)
 
     data_obj = Data_NN(start_date, train_end_date)
     print(data_obj)
 
     data_obj.set_directory(data_directory)
-    data_obj.retrieve_data(data_checkpoint_name)
+    if shared is not None:
+        data_obj.attach(shared)
+    else:
+        data_obj.retrieve_data(data_checkpoint_name)
 
     data_dic_used = data_obj.data_dic
     print(data_obj)
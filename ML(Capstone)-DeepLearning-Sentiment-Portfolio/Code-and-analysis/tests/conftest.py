@@ -0,0 +1,23 @@
+import os
+import sys
+
+import pytest
+
+# the modules live next to this folder and are imported as top-level modules (as in the notebooks)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='session')
+def fixture_dir(tmp_path_factory):
+    '''a small synthetic WRDS / Yahoo universe (30 permnos, 2000-2005) as LocalSource fixtures'''
+    from dsp_DL_ml_portf_data_benchmark import write_synthetic_fixtures
+    return write_synthetic_fixtures(str(tmp_path_factory.mktemp('fixtures')), 30, start_date='2000-01-01',
+                                    end_date='2006-01-01')
+
+
+@pytest.fixture
+def build_params(fixture_dir):
+    '''Data_NN arguments for a headless build from the fixtures'''
+    from dsp_DL_ml_portf_data_retrieval import LocalSource
+    return {'start_date': '2000-01-01', 'end_date': '2006-01-01', 'source': LocalSource(fixture_dir),
+            'show_plots': False}
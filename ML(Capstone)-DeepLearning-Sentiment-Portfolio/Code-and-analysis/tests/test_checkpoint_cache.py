@@ -0,0 +1,36 @@
+import os
+
+import pandas as pd
+
+from dsp_DL_ml_portf_data_retrieval import Data_NN
+
+
+def test_resplit_for_another_reader_keeps_the_split(tmp_path, build_params):
+    first = Data_NN(train_end_date='2004-12-31', data_dir=str(tmp_path), **build_params)
+    first.retrieve_data()
+    train_sp500 = first.data_dic['train_sp500']
+    # a second reader of the same cached panel with another split date re-splits it
+    second = Data_NN(train_end_date='2002-06-28', data_dir=str(tmp_path), **build_params)
+    second.retrieve_data()
+    assert second.checkpoint_name == first.checkpoint_name
+
+    full = Data_NN(train_end_date='2004-12-31', data_dir=str(tmp_path), **build_params)
+    full.retrieve_data('full')
+    # the first reader only reads its permno-ticker maps now, they still follow its own split
+    for table_name in ['ticker_permno_dic', 'permno_ticker_dic']:
+        assert first.data_dic[table_name] == full.data_dic[table_name]
+        assert len(second.data_dic[table_name]) < len(first.data_dic[table_name])
+    for table_name in ['train_sp500', 'test_sp500', 'train_mkt', 'test_mkt']:
+        pd.testing.assert_frame_equal(first.data_dic[table_name], full.data_dic[table_name], check_freq=False)
+    assert train_sp500['date'].max() <= pd.Timestamp('2004-12-31') < first.data_dic['test_sp500']['date'].min()
+    assert second.data_dic['train_sp500']['date'].max() <= pd.Timestamp('2002-06-28')
+
+
+def test_data_dic_reads_after_a_chdir(tmp_path, monkeypatch, build_params):
+    monkeypatch.chdir(tmp_path)
+    data_obj = Data_NN(train_end_date='2004-12-31', **build_params)
+    data_obj.set_directory('data')
+    data_obj.retrieve_data('full')
+    monkeypatch.chdir('/')
+    assert data_obj.data_dic['train_sp500']['date'].max() <= pd.Timestamp('2004-12-31')
+    assert os.path.isdir(data_obj.checkpoint_path())
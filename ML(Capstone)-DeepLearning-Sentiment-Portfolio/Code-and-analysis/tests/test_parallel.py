@@ -0,0 +1,16 @@
+import pandas as pd
+
+import dsp_DL_ml_portf_data_retrieval as retrieval
+from dsp_DL_ml_portf_data_retrieval import ROLLING_REDUCERS, Data_NN
+
+
+def test_build_is_the_same_for_any_n_jobs(tmp_path, monkeypatch, build_params):
+    # the fixture panel is far below the size that is worth sharding
+    monkeypatch.setattr(retrieval, 'PARALLEL_MIN_ROWS', 0)
+    data_objs = {}
+    for n_jobs in [1, 3]:
+        data_objs[n_jobs] = Data_NN(train_end_date='2003-12-31', daily_metric_reducers=tuple(ROLLING_REDUCERS),
+                                    n_jobs=n_jobs, data_dir=str(tmp_path), **build_params)
+        data_objs[n_jobs].retrieve_data(f'n_jobs_{n_jobs}')
+    for table_name in ['sp500_used', 'train_sp500', 'test_sp500']:
+        pd.testing.assert_frame_equal(data_objs[3].data_dic[table_name], data_objs[1].data_dic[table_name], check_exact=True)
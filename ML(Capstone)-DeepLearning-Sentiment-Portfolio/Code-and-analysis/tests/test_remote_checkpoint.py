@@ -0,0 +1,146 @@
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from dsp_DL_ml_portf_data_retrieval import (Data_NN, LazyDataDic, RemoteCheckpoint, checkpoint_bytes, load_checkpoint_table,
+                                            read_checkpoint_manifest, save_checkpoint_table, write_checkpoint_manifest)
+
+
+def _frame(seed=0, n=200):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({'permno': np.repeat(np.arange(n // 20), 20).astype(float),
+                         'date': np.tile(pd.bdate_range('2020-01-01', periods=20), n // 20),
+                         'return': rng.normal(0, 0.02, n)})
+
+
+def _write_checkpoint(checkpoint_dir, seed=0, n=200):
+    '''small checkpoint with an Arrow table and a pickled dict, as the Data_NN checkpoints store them'''
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    manifest = {}
+    save_checkpoint_table(_frame(seed, n), checkpoint_dir, 'sp500_used', manifest)
+    save_checkpoint_table({'seed': seed}, checkpoint_dir, 'sp500_used_offsets', manifest)
+    write_checkpoint_manifest(checkpoint_dir, manifest)
+    return 'file://' + str(checkpoint_dir)
+
+
+@pytest.fixture
+def transfers(monkeypatch):
+    '''names of the files RemoteCheckpoint downloads'''
+    fetched = []
+    fetch_file = RemoteCheckpoint._fetch_file
+    def counting_fetch_file(self, file_name):
+        fetched.append(file_name)
+        fetch_file(self, file_name)
+    monkeypatch.setattr(RemoteCheckpoint, '_fetch_file', counting_fetch_file)
+    return fetched
+
+
+def test_first_fetch_copies_only_the_requested_tables(tmp_path, transfers):
+    url = _write_checkpoint(tmp_path / 'remote' / 'ck')
+    remote = RemoteCheckpoint(url, str(tmp_path / 'cache'))
+    data_dic = LazyDataDic(remote.local_dir, ['sp500_used', 'sp500_used_offsets'], remote=remote)
+    pd.testing.assert_frame_equal(data_dic['sp500_used'], _frame())
+    assert transfers == ['sp500_used.feather']
+    assert not os.path.exists(os.path.join(remote.local_dir, 'sp500_used_offsets.pkl'))
+    assert data_dic['sp500_used_offsets'] == {'seed': 0}
+    assert transfers == ['sp500_used.feather', 'sp500_used_offsets.pkl']
+
+
+def test_cache_hit_skips_the_transfer(tmp_path, transfers):
+    url = _write_checkpoint(tmp_path / 'remote' / 'ck')
+    first = RemoteCheckpoint(url, str(tmp_path / 'cache'))
+    first.fetch()
+    first.close()
+    n_fetched = len(transfers)
+    second = RemoteCheckpoint(url, str(tmp_path / 'cache'))
+    assert second.local_dir == first.local_dir
+    assert second.fetch() == first.local_dir
+    assert len(transfers) == n_fetched
+    pd.testing.assert_frame_equal(load_checkpoint_table(second.local_dir, 'sp500_used'), _frame())
+
+
+def test_manifest_change_fetches_the_new_version(tmp_path, transfers):
+    url = _write_checkpoint(tmp_path / 'remote' / 'ck')
+    old = RemoteCheckpoint(url, str(tmp_path / 'cache'))
+    old.fetch()
+    # the checkpoint is rebuilt in place: new manifest, same file names
+    _write_checkpoint(tmp_path / 'remote' / 'ck', seed=1, n=240)
+    transfers.clear()
+    new = RemoteCheckpoint(url, str(tmp_path / 'cache'))
+    assert new.local_dir != old.local_dir
+    new.fetch()
+    assert sorted(transfers) == ['sp500_used.feather', 'sp500_used_offsets.pkl']
+    pd.testing.assert_frame_equal(load_checkpoint_table(new.local_dir, 'sp500_used'), _frame(1, 240))
+    pd.testing.assert_frame_equal(load_checkpoint_table(old.local_dir, 'sp500_used'), _frame(0))
+
+
+def test_least_recently_used_versions_are_evicted(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    urls = [_write_checkpoint(tmp_path / 'remote' / f'ck{i}', seed=i) for i in range(3)]
+    first = RemoteCheckpoint(urls[0], cache_dir)
+    first.fetch()
+    first.close()
+    max_bytes = int(2.5 * checkpoint_bytes(first.local_dir))
+    remotes = [first] + [RemoteCheckpoint(url, cache_dir, max_cache_bytes=max_bytes) for url in urls[1:]]
+    remotes[1].fetch()
+    remotes[1].close()
+    # reading ck0 again makes ck1 the least recently used one
+    reread = RemoteCheckpoint(urls[0], cache_dir, max_cache_bytes=max_bytes)
+    reread.fetch()
+    reread.close()
+    remotes[2].fetch()
+    assert sorted(os.listdir(cache_dir)) == sorted([remotes[0].name, remotes[2].name])
+
+
+def test_open_versions_are_not_evicted(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    urls = [_write_checkpoint(tmp_path / 'remote' / f'ck{i}', seed=i) for i in range(2)]
+    remotes = [RemoteCheckpoint(url, cache_dir, max_cache_bytes=1) for url in urls]
+    remotes[0].fetch()
+    remotes[1].fetch()
+    assert os.path.exists(remotes[0].local_dir)
+    remotes[0].close()
+    remotes[1].fetch()
+    assert not os.path.exists(remotes[0].local_dir)
+    assert os.path.exists(remotes[1].local_dir)
+
+
+def test_pickle_checkpoint_without_manifest(tmp_path, transfers):
+    checkpoint_dir = tmp_path / 'remote' / 'legacy'
+    os.makedirs(checkpoint_dir)
+    for table_name, obj in {'sp500_used': _frame(), 'sp500_used_offsets': {'seed': 0}}.items():
+        with open(checkpoint_dir / f'{table_name}.pkl', 'wb') as f:
+            pickle.dump(obj, f)
+    remote = RemoteCheckpoint('file://' + str(checkpoint_dir), str(tmp_path / 'cache'))
+    assert remote.manifest is None
+    assert sorted(remote.pickles) == ['sp500_used.pkl', 'sp500_used_offsets.pkl']
+    remote.fetch(['sp500_used'])
+    assert transfers == ['sp500_used.pkl']
+    pd.testing.assert_frame_equal(load_checkpoint_table(remote.local_dir, 'sp500_used'), _frame())
+    # a changed listing is a new version
+    with open(checkpoint_dir / 'sp500_used.pkl', 'wb') as f:
+        pickle.dump(_frame(1), f)
+    assert RemoteCheckpoint('file://' + str(checkpoint_dir), str(tmp_path / 'cache')).name != remote.name
+
+
+def test_data_nn_methods_fetch_only_what_they_read(tmp_path, transfers, build_params):
+    Data_NN(train_end_date='2004-12-31', data_dir=str(tmp_path / 'remote'), **build_params).retrieve_data('ck')
+    url = 'file://' + str(tmp_path / 'remote' / 'ck')
+    reader = Data_NN(train_end_date='2004-12-31', data_dir=str(tmp_path / 'reader'), **build_params)
+    assert os.path.isdir(reader.checkpoint_path(url))
+    assert transfers == []
+    permno = reader.query(url).permnos[0]
+    assert len(reader.query(url).history(permno)) > 0
+    assert sorted(transfers) == ['sp500_used.feather', 'sp500_used_offsets.feather', 'sp500_used_permno_offsets.feather',
+                                 'sp500_used_permno_rows.feather']
+    transfers.clear()
+    reader.identifier_index(url)
+    assert [os.path.splitext(x)[0] for x in transfers] == ['identifier_index']
+    transfers.clear()
+    tensor = reader.panel_tensor(url)
+    assert tensor.values.shape[0] == len(tensor.dates)
+    tensor_dir = read_checkpoint_manifest(reader.checkpoint_path(url))['tensor']['dir']
+    assert transfers and all(x.startswith(tensor_dir + '/') for x in transfers)
@@ -0,0 +1,43 @@
+import hashlib
+import os
+
+import pandas as pd
+
+from dsp_DL_ml_portf_data_retrieval import TICKER_MAPS, Data_NN, LazyDataDic, read_checkpoint_manifest
+
+
+def _stored_files(checkpoint_dir):
+    '''content hash of every stored file but the manifest'''
+    files = {}
+    for root, _, names in os.walk(checkpoint_dir):
+        for name in names:
+            path = os.path.join(root, name)
+            if name != 'manifest.json':
+                with open(path, 'rb') as f:
+                    files[os.path.relpath(path, checkpoint_dir)] = hashlib.sha256(f.read()).hexdigest()
+    return files
+
+
+def test_resplit_only_moves_the_row_ranges(tmp_path, build_params):
+    data_obj = Data_NN(train_end_date='2004-12-31', data_dir=str(tmp_path), **build_params)
+    data_obj.retrieve_data('ck')
+    checkpoint_dir = data_obj.checkpoint_path()
+    files, manifest = _stored_files(checkpoint_dir), read_checkpoint_manifest(checkpoint_dir)
+
+    data_obj.train_end_date = '2002-06-28'
+    data_obj.resplit_checkpoint('ck')
+    resplit_files, resplit_manifest = _stored_files(checkpoint_dir), read_checkpoint_manifest(checkpoint_dir)
+    # the panel is not rewritten: only the permno-ticker maps and the split row ranges change
+    map_files = {manifest['tables'][x]['file'] for x in TICKER_MAPS}
+    assert {x: h for x, h in resplit_files.items() if x not in map_files} == {x: h for x, h in files.items() if x not in map_files}
+    assert {x: e for x, e in resplit_manifest['tables'].items() if x not in TICKER_MAPS} == \
+           {x: e for x, e in manifest['tables'].items() if x not in TICKER_MAPS}
+    assert resplit_manifest['splits'] != manifest['splits']
+
+    rebuilt = Data_NN(train_end_date='2002-06-28', data_dir=str(tmp_path), **build_params)
+    rebuilt.retrieve_data('rebuilt')
+    resplit = LazyDataDic(checkpoint_dir)
+    for table_name in ['train_sp500', 'test_sp500', 'train_mkt', 'test_mkt']:
+        pd.testing.assert_frame_equal(resplit[table_name], rebuilt.data_dic[table_name], check_freq=False)
+    for table_name in TICKER_MAPS:
+        assert resplit[table_name] == rebuilt.data_dic[table_name]
@@ -0,0 +1,41 @@
+import numpy as np
+import pandas as pd
+
+from dsp_DL_ml_portf_data_retrieval import rolling_group_metrics
+
+
+def _panel(seed=0, n_permnos=6, n_days=80):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({'permno': np.repeat(np.arange(n_permnos), n_days).astype(float),
+                       'date': np.tile(pd.bdate_range('2020-01-01', periods=n_days), n_permnos),
+                       'return': rng.normal(0, 0.02, n_permnos * n_days)})
+    df.loc[rng.choice(len(df), 10, replace=False), 'return'] = np.nan
+    # total losses (delistings) in the middle of two permnos, and one right at the start of a permno
+    df.loc[[20, 2 * n_days + 50, 3 * n_days], 'return'] = -1.0
+    # shuffled: the metrics must not depend on the row order
+    return df.sample(frac=1, random_state=seed)
+
+
+def test_rolling_metrics_match_pandas():
+    df = _panel()
+    windows = {'5': 5, '30': 30}
+    rolling_group_metrics(df, windows, reducers=('sum', 'mean', 'std', 'compound'))
+    grouped = df.sort_values(['permno', 'date']).groupby('permno')['return']
+    for label, n in windows.items():
+        expected = {'': grouped.rolling(n).sum(),
+                    '_mean': grouped.rolling(n).mean(),
+                    '_std': grouped.rolling(n).std(),
+                    '_compound': grouped.rolling(n).apply(lambda x: (1 + x).prod() - 1, raw=True)}
+        for suffix, values in expected.items():
+            values = values.droplevel(0).sort_index()
+            assert np.allclose(df[f'ret_{label}_d{suffix}'].sort_index(), values, equal_nan=True, atol=1e-12), suffix
+
+
+def test_compound_total_loss_only_affects_its_windows():
+    df = _panel()
+    rolling_group_metrics(df, {'5': 5}, reducers=('compound',))
+    df = df.sort_index()
+    # the windows holding the -1 return compound to -1, the ones after it are finite again
+    assert (df.loc[20:24, 'ret_5_d_compound'] == -1).all()
+    assert np.isfinite(df.loc[25:79, 'ret_5_d_compound'].dropna()).all()
+    assert df.loc[25:79, 'ret_5_d_compound'].notna().any()
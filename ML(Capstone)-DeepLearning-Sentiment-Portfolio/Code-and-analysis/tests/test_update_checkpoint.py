@@ -0,0 +1,43 @@
+import glob
+import os
+import shutil
+
+import pandas as pd
+
+from dsp_DL_ml_portf_data_retrieval import Data_NN, LocalSource
+
+
+def _fixtures_until(fixture_dir, early_dir, last_date, last_eom):
+    '''the fixtures as they were on last_date: daily returns and market series up to last_date, characteristics
+    published up to last_eom'''
+    shutil.copytree(fixture_dir, early_dir)
+    dsf = pd.read_parquet(os.path.join(early_dir, 'crsp_dsf.parquet'))
+    dsf[dsf['date'] <= last_date].to_parquet(os.path.join(early_dir, 'crsp_dsf.parquet'))
+    gf = pd.read_parquet(os.path.join(early_dir, 'contrib_global_factor.parquet'))
+    gf[pd.to_datetime(gf['eom']) <= last_eom].to_parquet(os.path.join(early_dir, 'contrib_global_factor.parquet'))
+    for path in glob.glob(os.path.join(early_dir, 'yahoo', '*.parquet')):
+        series = pd.read_parquet(path)
+        series[series.index <= last_date].to_parquet(path)
+    return early_dir
+
+
+def test_refresh_matches_a_full_rebuild(tmp_path, fixture_dir, build_params):
+    full = Data_NN(train_end_date='2003-12-31', data_dir=str(tmp_path), **build_params)
+    full.retrieve_data('full')
+
+    early_dir = _fixtures_until(fixture_dir, str(tmp_path / 'early'), pd.Timestamp('2004-06-15'), pd.Timestamp('2004-04-30'))
+    refreshed = Data_NN(train_end_date='2003-12-31', data_dir=str(tmp_path),
+                        **{**build_params, 'end_date': '2004-06-16', 'source': LocalSource(early_dir)})
+    refreshed.retrieve_data('refreshed')
+    assert refreshed.data_dic['sp500_used']['date'].max() <= pd.Timestamp('2004-06-15')
+    refreshed.source = build_params['source']
+    refreshed.update_checkpoint('refreshed', end_date=build_params['end_date'])
+    assert refreshed.data_dic['sp500_used']['date'].max() > pd.Timestamp('2005-06-30')
+
+    for table_name in ['sp500_used', 'train_sp500', 'test_sp500']:
+        # the rolling sums of the refreshed rows start from the stored context, so they match up to rounding
+        pd.testing.assert_frame_equal(refreshed.data_dic[table_name], full.data_dic[table_name], check_exact=False, rtol=1e-12)
+    for table_name in ['mkt_daily', 'train_mkt', 'test_mkt']:
+        pd.testing.assert_frame_equal(refreshed.data_dic[table_name], full.data_dic[table_name], check_freq=False)
+    for table_name in ['ticker_permno_dic', 'permno_ticker_dic', 'data_useful_info_dic']:
+        assert refreshed.data_dic[table_name] == full.data_dic[table_name]